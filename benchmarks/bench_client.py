@@ -0,0 +1,204 @@
+#!/usr/bin/python
+""" End to end benchmark of iRWebStats against a local fake members site
+    (see fakeserver.py), no network access needed. Measures throughput and
+    p50/p99 latency of every method, including full paginated crawls and
+    bulk fetches, and prints the results as JSON so runs of different
+    commits can be compared (i.e with -o results-<commit>.json).
+    Usage: python benchmarks/bench_client.py [-n 50] [--latency 0.005]
+                                             [--only career] [-o out.json]
+"""
+
+import argparse as ap
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, '..')
+sys.path.insert(0, ROOT)
+
+from ir_webstats import constants as ct
+from ir_webstats.client import iRWebStats
+from ir_webstats.metrics import MetricsAggregator
+from ir_webstats.ratelimit import TokenBucket
+from ir_webstats.sessions import SessionStore
+from fakeserver import CUSTID, point_to
+
+# name: (function(client), number of calls relative to -n)
+CASES = [
+    ('driver_counts', lambda c: c.driver_counts(), 1),
+    ('career_stats', lambda c: c.career_stats(), 1),
+    ('yearly_stats', lambda c: c.yearly_stats(), 1),
+    ('cars_driven', lambda c: c.cars_driven(), 1),
+    ('personal_best', lambda c: c.personal_best(carid=1), 1),
+    ('driverdata', lambda c: c.driverdata('Driver 1'), 1),
+    ('lastrace_stats', lambda c: c.lastrace_stats(), 1),
+    ('iratingchart', lambda c: c.iratingchart(), 1),
+    ('driver_search', lambda c: c.driver_search(), 1),
+    ('driver_search_tuple',
+     lambda c: c.driver_search(rows=ct.ROWS_TUPLE), 1),
+    ('results_archive', lambda c: c.results_archive(), 1),
+    ('all_seasons', lambda c: c.all_seasons(), 1),
+    ('season_standings', lambda c: c.season_standings(1, 1), 1),
+    ('hosted_results', lambda c: c.hosted_results(), 1),
+    ('session_times',
+     lambda c: c.session_times(1, '2014-01-01', '2014-01-02'), 1),
+    ('series_raceresults', lambda c: c.series_raceresults(1, 1), 1),
+    ('event_results', lambda c: c.event_results(1), 1),
+    ('event_results_typed', lambda c: c.event_results(1, typed=True), 1),
+    ('iter_event_results',
+     lambda c: list(c.iter_event_results(1)[1]), 1),
+    # Full paginated crawls and bulk fetches, fewer calls
+    ('crawl_driver_search', lambda c: list(c.iter_driver_search()), 0.1),
+    ('crawl_results_archive', lambda c: list(c.iter_results_archive()), 0.1),
+    ('crawl_season_standings',
+     lambda c: list(c.iter_season_standings(1, 1)), 0.1),
+    ('crawl_hosted_results', lambda c: list(c.iter_hosted_results()), 0.1),
+    ('bulk_career_stats',
+     lambda c: c.bulk_career_stats(list(range(1000, 1050))), 0.1),
+]
+
+
+def percentile(values, p):
+    """ Nearest rank percentile of a sorted list """
+    k = max(int(round(p / 100.0 * len(values) + 0.5)) - 1, 0)
+    return values[min(k, len(values) - 1)]
+
+
+def measure(func, number):
+    """ Calls func number times. Returns a dict with throughput (calls/s)
+        and latency stats (ms) """
+    times = []
+    start = time.time()
+    for _ in range(number):
+        t = time.time()
+        res = func()
+        times.append(time.time() - t)
+        if res is None:
+            raise RuntimeError('Empty response')
+    total = time.time() - start
+    times.sort()
+    return {'calls': number, 'total_s': round(total, 4),
+            'throughput': round(number / total, 2),
+            'p50_ms': round(percentile(times, 50) * 1000, 3),
+            'p99_ms': round(percentile(times, 99) * 1000, 3),
+            'mean_ms': round(total / number * 1000, 3),
+            'rows': len(res) if isinstance(res, (list, tuple)) else None}
+
+
+def start_server(args):
+    """ Runs fakeserver.py in its own process (so it doesn't compete with
+        the client for the GIL). Returns (process, base url) """
+    p = subprocess.Popen([sys.executable, os.path.join(HERE, 'fakeserver.py'),
+                          '--latency', str(args.latency),
+                          '--total', str(args.total),
+                          '--catalog-size', str(args.catalog_size)],
+                         stdout=subprocess.PIPE)
+    port = int(p.stdout.readline())
+    return p, 'http://127.0.0.1:%d' % port
+
+
+def commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+            stderr=open(os.devnull, 'w')).decode().strip()
+    except Exception:
+        return None
+
+
+def run(args, base, observer=None):
+    point_to(base)
+    limiter = TokenBucket(args.rate, max(args.rate, 1)) if args.rate else \
+        TokenBucket(1e9, 1e9)
+    results = {}
+    sessions = SessionStore('sessions.json')  # In the temp dir, not ~
+
+    def login():
+        if os.path.exists(sessions.path):
+            os.remove(sessions.path)
+        c = iRWebStats(verbose=False, limiter=limiter, catalog_file=None,
+                       sessions=sessions)
+        ok = c.login('user', 'pass')
+        c.close()
+        return ok or None
+
+    if not args.only or 'login' in args.only:
+        results['login'] = measure(login, max(args.number // 5, 1))
+
+    c = iRWebStats(verbose=False, limiter=limiter, catalog_file=None,
+                   observer=observer, sessions=sessions)
+    if not c.login('user', 'pass'):
+        raise RuntimeError('Login to the fake server failed')
+    if c.custid != CUSTID:
+        raise RuntimeError('Wrong custid %r parsed from the login page' %
+                           c.custid)
+    for name, func, weight in CASES:
+        if args.only and not any(o in name for o in args.only):
+            continue
+        results[name] = measure(lambda: func(c),
+                                max(int(args.number * weight), 1))
+        if args.verbose:
+            r = results[name]
+            sys.stderr.write('%-24s %9.1f/s  p50 %8.3f ms  p99 %8.3f ms\n' %
+                             (name, r['throughput'], r['p50_ms'],
+                              r['p99_ms']))
+    c.close()
+    return results
+
+
+if __name__ == '__main__':
+    parser = ap.ArgumentParser(description="iRWebStats end to end benchmark")
+    parser.add_argument("-n", "--number", type=int, default=50,
+                        help='Calls per method (crawls do n/10)')
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help='Seconds added by the server to every response')
+    parser.add_argument("--total", type=int, default=1000,
+                        help='Rows of the paginated searches')
+    parser.add_argument("--catalog-size", type=int, default=500,
+                        help='Entries of each catalog table')
+    parser.add_argument("--rate", type=float, default=0,
+                        help='Rate limit (requests/s), 0 disables it')
+    parser.add_argument("--only", nargs='+',
+                        help='Only run the cases containing these names')
+    parser.add_argument("--metrics", action='store_true',
+                        help='Add the per phase timings of every method '
+                        '(see metrics.py)')
+    parser.add_argument("-o", "--output", help='Write the JSON to a file')
+    parser.add_argument("-v", "--verbose", action='store_true',
+                        help='Print a summary line per case to stderr')
+    args = parser.parse_args()
+
+    server, base = start_server(args)
+    cwd = os.getcwd()
+    tmp = tempfile.mkdtemp()  # Keeps sessions.json away from the real one
+    os.chdir(tmp)
+    agg = MetricsAggregator() if args.metrics else None
+    try:
+        results = run(args, base, agg)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp, ignore_errors=True)
+        server.terminate()
+        server.wait()
+
+    out = {'commit': commit(), 'timestamp': time.time(),
+           'python': platform.python_version(),
+           'params': {'number': args.number, 'latency': args.latency,
+                      'total': args.total,
+                      'catalog_size': args.catalog_size,
+                      'rate': args.rate},
+           'results': results}
+    if agg is not None:
+        out['metrics'] = agg.dump()
+    dump = json.dumps(out, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as o:
+            o.write(dump + '\n')
+    else:
+        print(dump)
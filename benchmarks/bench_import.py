@@ -0,0 +1,61 @@
+#!/usr/bin/python
+""" Import time benchmark of the client and shell.py. Each measure is the
+    best of several fresh interpreters. Exits with status 1 if importing
+    ir_webstats.client takes more than the threshold (ms) or pulls in
+    requests, so it can be used as a regression check.
+    Usage: python benchmarks/bench_import.py [threshold ms] """
+
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+THRESHOLD = 30.0  # ms, importing ir_webstats.client
+
+IMPORT = ("import sys, time; t = time.time(); import %s; "
+          "print('%%f %%d' %% ((time.time() - t) * 1000, "
+          "'requests' in sys.modules))")
+
+
+def import_time(module, repeat=7):
+    """ Returns (best import time in ms, whether requests got imported) """
+    best, heavy = None, False
+    for _ in range(repeat):
+        out = subprocess.check_output([sys.executable, '-c',
+                                       IMPORT % module], cwd=ROOT)
+        ms, req = out.split()
+        best = float(ms) if best is None else min(best, float(ms))
+        heavy = bool(int(req))
+    return best, heavy
+
+
+def run_time(argv, repeat=7):
+    """ Best wall time (ms) of running a command, including interpreter
+        startup """
+    best = None
+    for _ in range(repeat):
+        t = time.time()
+        subprocess.check_call(argv, cwd=ROOT, stdout=open(os.devnull, 'w'))
+        ms = (time.time() - t) * 1000
+        best = ms if best is None else min(best, ms)
+    return best
+
+
+if __name__ == '__main__':
+    threshold = float(sys.argv[1]) if len(sys.argv) > 1 else THRESHOLD
+    client_ms, heavy = import_time('ir_webstats.client')
+    for module in ('ir_webstats.constants', 'ir_webstats.util',
+                   'ir_webstats.endpoints', 'requests'):
+        print("import %-22s %8.2f ms" % (module, import_time(module)[0]))
+    print("import %-22s %8.2f ms (requests imported: %s)" %
+          ('ir_webstats.client', client_ms, heavy))
+    print("python -c pass              %8.2f ms" %
+          run_time([sys.executable, '-c', 'pass']))
+    print("python shell.py --list      %8.2f ms" %
+          run_time([sys.executable, 'shell.py', '--list']))
+    if heavy or client_ms > threshold:
+        print("FAIL: importing ir_webstats.client must take less than %.1f "
+              "ms and not import requests" % threshold)
+        sys.exit(1)
+    print("OK (threshold %.1f ms)" % threshold)
@@ -0,0 +1,90 @@
+#!/usr/bin/python
+""" Micro-benchmark of the @logged_in decorator: per call overhead and
+    decoration (import) time of the current wrapper against the previous
+    one, built with decorator.FunctionMaker (compile/exec) and calling
+    inspect on every call, plus the import time of util.
+    Usage: python benchmarks/bench_logged_in.py [number of calls] """
+
+import inspect
+import os
+import subprocess
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ir_webstats import decorator
+from ir_webstats.util import logged_in, pprint
+
+try:
+    _argspec = inspect.getargspec  # python2
+except AttributeError:
+    _argspec = inspect.getfullargspec  # python3 (getargspec was removed)
+
+
+def _legacy_caller(func, *args, **kw):
+    """ util.__logged_in before it was resolved at decoration time """
+    args2 = list(args)
+    irweb = args2[0]
+    if not irweb.logged:
+        pprint("Error, client is not logged in to iRacing Platform so\
+                operation couldn't be completed.", irweb.verbose)
+        return None
+
+    if 'custid' in _argspec(func).args:
+        args2[1] = args2[1] if args2[1] is not None else irweb.custid
+
+    return func(*args2, **kw)
+
+
+def legacy_logged_in(func):
+    return decorator.decorator(_legacy_caller, func)
+
+
+def career_stats(self, custid=None, cache='use'):
+    return custid
+
+
+def driver_counts(self, cache='use'):
+    return None
+
+
+class Client(object):
+    logged = True
+    verbose = False
+    custid = 1
+
+
+def bench(name, deco, number):
+    c = Client()
+    with_custid = deco(career_stats)
+    without_custid = deco(driver_counts)
+    t_custid = timeit.timeit(lambda: with_custid(c), number=number)
+    t_plain = timeit.timeit(lambda: without_custid(c), number=number)
+    t_deco = timeit.timeit(lambda: deco(career_stats), number=number // 10)
+    print("%-8s call (custid): %7.3f us  call (no custid): %7.3f us  "
+          "decorate: %7.3f us" % (name, t_custid / number * 1e6,
+                                  t_plain / number * 1e6,
+                                  t_deco / (number // 10) * 1e6))
+
+
+def import_time(module, repeat=5):
+    """ Best time (ms) to import module in a fresh interpreter """
+    code = ("import time; t = time.time(); import %s; "
+            "print(time.time() - t)" % module)
+    root = os.path.join(os.path.dirname(__file__), '..')
+    return min(float(subprocess.check_output([sys.executable, '-c', code],
+                                             cwd=root))
+               for _ in range(repeat)) * 1000
+
+
+if __name__ == '__main__':
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    c = Client()
+    baseline = timeit.timeit(lambda: career_stats(c, 1), number=number)
+    print("%-8s call: %7.3f us" % ('bare', baseline / number * 1e6))
+    bench('legacy', legacy_logged_in, number)
+    bench('current', logged_in, number)
+    print("import ir_webstats.util: %.2f ms (decorator module, no longer "
+          "imported: %.2f ms)" % (import_time('ir_webstats.util'),
+                                  import_time('ir_webstats.decorator')))
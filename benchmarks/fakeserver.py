@@ -0,0 +1,289 @@
+#!/usr/bin/python
+""" Local stand-in for the iRacing members site, used by the benchmarks. It
+    serves synthetic responses for every URL_* in ir_webstats.constants
+    (login, cookies, JSON, paginated searches, pages with embedded catalog
+    and CSV results) with a configurable latency. Tests can make it send
+    ETags (validators) and answer 429/5xx (fail).
+    Usage: python benchmarks/fakeserver.py [--port 0] [--latency 0.02]
+    It prints the port it listens on and serves until killed. """
+
+import argparse as ap
+import hashlib
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer  # python3
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qsl
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer  # python2
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qsl
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ir_webstats import constants as ct
+
+CUSTID = 123456
+SESSION_COOKIE = 'JSESSIONID=fake%s; Path=/'
+MEMBER_COOKIE = 'irsso_members=fake; Path=/'
+
+
+def point_to(base):
+    """ Rewrites the URL_* constants (and the ct.CACHE_TTL keys) to send the
+        requests to base (i.e 'http://127.0.0.1:8000') instead of
+        members.iracing.com """
+    urls = {}
+    for name in dir(ct):
+        if name.startswith('URL_'):
+            url = getattr(ct, name)
+            path = url.split('members.iracing.com', 1)[1]
+            urls[url] = base + path
+            setattr(ct, name, base + path)
+    ct.CACHE_TTL = dict((urls.get(url, url), ttl)
+                        for url, ttl in ct.CACHE_TTL.items())
+
+
+def _json_var(name, rows):
+    data = json.dumps(rows).replace(' ', '+')
+    return "var %s = extractJSON('%s');\n" % (name, data)
+
+
+class Data(object):
+
+    """ Synthetic data set. total is the number of rows of the paginated
+        searches and catalog_size the number of entries of each catalog
+        table (Home page size). """
+
+    def __init__(self, total=1000, catalog_size=500, csv_rows=40, seed=1):
+        rnd = random.Random(seed)
+        self.total = total
+        names = ['Driver %d' % i for i in range(total)]
+        self.drivers = [{'1': 1000 + i, '2': names[i],
+                         '3': rnd.randint(800, 6000), '4': rnd.random() * 5,
+                         '5': rnd.randint(1, 7), '6': 'US'}
+                        for i in range(total)]
+        self.drivers_header = {'1': 'custid', '2': 'displayname',
+                               '3': 'irating', '4': 'avgincidents',
+                               '5': 'licenselevel', '6': 'country'}
+        self.results = [{'1': 1000 + i, '2': 20000 + i, '3': 300 + i % 50,
+                         '4': 100 + i % 20, '5': 1400000000000 + i * 60000,
+                         '6': rnd.randint(1, 30), '7': rnd.randint(0, 30)}
+                        for i in range(total)]
+        self.results_header = {'1': 'custid', '2': 'subsessionid',
+                               '3': 'seasonid', '4': 'trackid',
+                               '5': 'start_time', '6': 'finishing_position',
+                               '7': 'incidents'}
+        catalog = ''
+        for var in ('TrackListing', 'CarListing', 'CarClassListing',
+                    'ClubListing', 'DivisionListing'):
+            catalog += _json_var(var, [{'id': i, 'name': '%s %d' % (var, i)}
+                                       for i in range(catalog_size)])
+        catalog += _json_var('YearAndQuarterListing',
+                             [{'year': 2014, 'quarters': [1, 2, 3, 4]}])
+        self.seasons = _json_var('SeasonListing',
+                                 [{'seasonid': i, 'seriesname': 'S%d' % i,
+                                   'carclasses': [{'id': i % 5, 'name':
+                                                   'Class %d' % (i % 5)}]}
+                                  for i in range(catalog_size)])
+        self.home = ('<html><script>\n' + catalog + self.seasons +
+                     '</script></html>')
+        header = ('"Fin Pos","Car ID","Car","Car Class ID","Car Class",'
+                  '"Team ID","Cust ID","Name","Start Pos","Car #",'
+                  '"Out ID","Out","Interval","Laps Led","Qualify Time",'
+                  '"Average Lap Time","Fastest Lap Time","Fast Lap#",'
+                  '"Laps Comp","Inc","Pts","Club Pts","Div","Club ID",'
+                  '"Club","Old iRating","New iRating"\r\n')
+        rows = ''.join('"%d","1","Car","1","Class","-1","%d","%s","%d",'
+                       '"%d","0","Running","-%d.%03d","0","","1:2%d.%03d",'
+                       '"1:2%d.%03d","%d","30","%d","%d","0","2","1",'
+                       '"Club","%d","%d"\r\n' %
+                       (i + 1, 1000 + i, names[i % total], i + 1, i, i,
+                        rnd.randint(0, 999), i % 10, rnd.randint(0, 999),
+                        i % 10, rnd.randint(0, 999), rnd.randint(2, 30),
+                        rnd.randint(0, 12), 100 - i, 2000 + i, 2010 + i)
+                       for i in range(csv_rows))
+        self.csv = ('"Start Time","Track","Series","Series ID","Season ID",'
+                    '"Race Week","Strength of Field"\r\n'
+                    '"2014-01-01 10:00:00","Spa","Series","1","1","1",'
+                    '"2500"\r\n\r\n' + header + rows)
+
+    def page(self, rows, low, high):
+        low = max(int(low), 1)
+        return rows[low - 1:int(high)]
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'  # keep-alive
+    # Headers and body are written separately, without this every response
+    # would wait for the client's delayed ACK (~40 ms)
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self._handle(dict(parse_qsl(urlparse(self.path).query)))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf8')
+        params = dict(parse_qsl(urlparse(self.path).query))
+        params.update(parse_qsl(body))
+        self._handle(params)
+
+    def _send(self, body, content_type='application/json', cookie=None):
+        if not isinstance(body, bytes):
+            body = body.encode('utf8')
+        if self.server.validators:
+            etag = '"%s"' % hashlib.sha1(body).hexdigest()[:16]
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+        self.send_response(200)
+        if self.server.validators:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if cookie is not None:
+            self.send_header('Set-Cookie', cookie)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _fail(self, status, retry_after=None):
+        body = b'<html>error</html>'
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        if retry_after is not None:
+            self.send_header('Retry-After', retry_after)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self, p):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            failure = server.failures.pop(0) if server.failures else None
+        if server.latency:
+            time.sleep(server.latency)
+        if failure is not None:
+            return self._fail(*failure)
+        d = server.data
+        path = urlparse(self.path).path.rsplit('/', 1)[-1]
+
+        if path == 'login.jsp':
+            return self._send('<html>login</html>', 'text/html',
+                              SESSION_COOKIE % server.requests)
+        if path == 'Login':
+            ok = p.get('username') and p.get('password')
+            body = d.home.replace('<script>', '<script>var js_custid = %d;'
+                                  % CUSTID) if ok else '<html>bad</html>'
+            return self._send(body, 'text/html',
+                              MEMBER_COOKIE if ok else None)
+        if 'irsso_members' not in (self.headers.get('Cookie') or ''):
+            return self._send('<html>login</html>', 'text/html')
+
+        if path == 'Home.do':
+            return self._send(d.home, 'text/html')
+        if path == 'statsseries.jsp':
+            return self._send('<html><script>' + d.seasons + '</script>',
+                              'text/html')
+        if path == 'SelectSeries.do':
+            return self._send('<html>series</html>', 'text/html')
+        if path == 'GetDriverCounts':
+            return self._send(json.dumps({'total': 1000, 'myracers': []}))
+        if path in ('GetCareerStats', 'GetYearlyStats'):
+            return self._send(json.dumps([{
+                'starts': 100, 'wins': 10, 'top5': 30, 'totalLaps': 5000,
+                'lapsLed': 300, 'category': 'Road', 'year': 2014}]))
+        if path == 'GetCarsDriven':
+            return self._send(json.dumps(list(range(20))))
+        if path in ('GetPersonalBests', 'GetLastRacesStats',
+                    'GetDriverStatus', 'GetSessionTimes'):
+            return self._send(json.dumps([{'id': i, 'value': i * 3}
+                                          for i in range(10)]))
+        if path == 'GetChartData':
+            return self._send(json.dumps([[1400000000000 + i * 86400000,
+                                           2000 + i] for i in range(300)]))
+        if path == 'GetDriverStats':
+            me = dict(d.drivers[0], **{'29': p.get('custid')})
+            rows = d.page(d.drivers, p['lowerbound'], p['upperbound'])
+            return self._send(json.dumps({'m': d.drivers_header, 'd': {
+                '32': d.total, 'r': [me] + rows}}))
+        if path == 'GetResults':
+            rows = d.results
+            if 'starttime_low' in p:
+                low, high = float(p['starttime_low']), \
+                    float(p['starttime_high'])
+                rows = [r for r in rows if low <= r['5'] < high]
+            if p.get('order') == 'desc':
+                rows = sorted(rows, key=lambda r: r['5'], reverse=True)
+            total = len(rows)
+            rows = d.page(rows, p['lowerbound'], p['upperbound'])
+            return self._send(json.dumps({'m': d.results_header, 'd': {
+                '46': total, 'r': rows}}))
+        if path == 'GetSeasonStandings':
+            rows = d.page(d.drivers, p['start'], p['end'])
+            return self._send(json.dumps({'m': d.drivers_header, 'd': {
+                '27': d.total, 'r': rows}}))
+        if path == 'GetPrivateSessionResults':
+            rows = d.page(d.results, p['lowerbound'], p['upperbound'])
+            return self._send(json.dumps({'rowcount': d.total,
+                                          'rows': rows}))
+        if path == 'GetSeriesRaceResults':
+            return self._send(json.dumps({'m': d.results_header,
+                                          'd': d.results[:200]}))
+        if path == 'GetEventResultsAsCSV':
+            return self._send(d.csv, 'text/csv')
+        self.send_error(404)
+
+
+class FakeServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.0, data=None):
+        HTTPServer.__init__(self, ('127.0.0.1', port), Handler)
+        self.latency = latency
+        self.data = data if data is not None else Data()
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.validators = False  # Send ETags, answer 304 if unchanged
+        self.failures = []  # (status, Retry-After) of the next requests
+
+    def fail(self, status, times=1, retry_after=None):
+        """ Answers the next times requests with status (i.e 429 or 503)
+            and the Retry-After header, if set, instead of the data """
+        with self.lock:
+            self.failures.extend([(status, retry_after)] * times)
+
+    @property
+    def base(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+
+if __name__ == '__main__':
+    parser = ap.ArgumentParser(description="Fake iRacing members site")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help='Seconds added to every response')
+    parser.add_argument("--total", type=int, default=1000,
+                        help='Rows of the paginated searches')
+    parser.add_argument("--catalog-size", type=int, default=500,
+                        help='Entries of each catalog table (Home page)')
+    args = parser.parse_args()
+    srv = FakeServer(args.port, args.latency,
+                     Data(args.total, args.catalog_size))
+    print(srv.server_address[1])
+    sys.stdout.flush()
+    srv.serve_forever()
@@ -0,0 +1,196 @@
+#!/usr/bin/python
+""" Pool of iRWebStats clients logged in with different member accounts.
+    Each account keeps its own session and rate limiter, the requests are
+    spread among them so the throughput of a crawl grows with the number
+    of accounts instead of being capped by the budget of one. """
+
+import threading
+import time
+
+from ir_webstats import constants as ct
+from ir_webstats import pool
+from ir_webstats import ratelimit
+from ir_webstats.client import iRWebStats
+from ir_webstats.util import pprint
+
+
+def _routed(name):
+    """ True if the iRWebStats method name sends one request (or a few in
+        a row, like driverdata) and can be routed to one account. iter_*
+        and bulk_* send many: they aren't routed as a whole (see
+        AccountPool.map). """
+    return not name.startswith(('_', 'iter_', 'bulk_')) and \
+        name not in ('login', 'logout', 'close', 'refresh_catalog') and \
+        callable(getattr(iRWebStats, name, None))
+
+
+class Account(object):
+
+    """ A client of the pool and its routing and health state """
+
+    def __init__(self, username, password, client):
+        self.username = username
+        self.password = password
+        self.client = client
+        self.inflight = 0  # Requests being sent
+        self.last_used = 0.0
+        self.failures = 0  # In a row
+        self.healthy = False  # Logged in and not evicted
+        self.evicted_at = None
+        self.requests, self.errors = 0, 0
+
+
+class AccountPool(object):
+
+    """ Logs in every account of accounts (list of (username, password))
+        and routes each call to one of them: the least loaded (fewest
+        requests in flight, then least recently used, ct.ROUTE_LEAST_LOADED)
+        or the least recently used (ct.ROUTE_LRU). An account whose calls
+        fail max_failures times in a row (exception, or no data because the
+        session expired) is evicted and logged in again retry_after seconds
+        later. limiter optionally caps the total rate of the pool on top of
+        the per account budget (rate, burst). Any stats method of iRWebStats
+        can be called on the pool (i.e pool.career_stats(custid)), the
+        bulk_* ones route every custid separately (see map). The iter_*
+        ones aren't available.
+        client_kw are passed to every iRWebStats (cache, observer, etc.),
+        they all share one connection pool. """
+
+    def __init__(self, accounts, strategy=ct.ROUTE_LEAST_LOADED,
+                 max_failures=ct.ACCOUNT_MAX_FAILURES,
+                 retry_after=ct.ACCOUNT_RETRY_AFTER, rate=ct.RATE_LIMIT,
+                 burst=ct.RATE_BURST, limiter=None, verbose=False,
+                 **client_kw):
+        if strategy not in (ct.ROUTE_LEAST_LOADED, ct.ROUTE_LRU):
+            raise ValueError("Unknown strategy %s" % strategy)
+        self.strategy = strategy
+        self.max_failures = max_failures
+        self.retry_after = retry_after
+        self.limiter = limiter
+        self.verbose = verbose
+        self._lock = threading.Lock()
+        client_kw.setdefault('session', pool.shared_session())
+        self.accounts = []
+        for username, password in accounts:
+            client = iRWebStats(
+                verbose=verbose, limiter=ratelimit.TokenBucket(rate, burst),
+                **client_kw)
+            self.accounts.append(Account(username, password, client))
+
+    def login(self):
+        """ Logs in every account. Returns the number of healthy accounts
+        """
+        for account in self.accounts:
+            self.__login(account)
+        return len(self.healthy())
+
+    def __login(self, account):
+        client = account.client
+        client.logged = False
+        ok = client.login(account.username, account.password)
+        with self._lock:
+            account.healthy = ok
+            account.failures = 0
+            account.evicted_at = None if ok else time.time()
+        if not ok:
+            pprint(("Account couldn't log in", account.username),
+                   self.verbose)
+        return ok
+
+    def healthy(self):
+        return [a for a in self.accounts if a.healthy]
+
+    def __pick(self):
+        """ Chooses the account for the next call and marks it as busy.
+            Evicted accounts are logged in again first if it's time. """
+        with self._lock:
+            now = time.time()
+            retry = [a for a in self.accounts if a.evicted_at is not None and
+                     now - a.evicted_at >= self.retry_after]
+            for a in retry:
+                a.evicted_at = now  # Only one thread retries it
+        for account in retry:
+            self.__login(account)
+
+        with self._lock:
+            candidates = self.healthy()
+            if not candidates:
+                raise RuntimeError("No healthy account in the pool")
+            if self.strategy == ct.ROUTE_LRU:
+                account = min(candidates, key=lambda a: a.last_used)
+            else:
+                account = min(candidates, key=lambda a: (a.inflight,
+                                                         a.last_used))
+            account.inflight += 1
+            account.last_used = time.time()
+            return account
+
+    def __done(self, account, ok):
+        with self._lock:
+            account.inflight -= 1
+            account.requests += 1
+            if ok:
+                account.failures = 0
+                return
+            account.errors += 1
+            account.failures += 1
+            if account.healthy and account.failures >= self.max_failures:
+                account.healthy = False
+                account.evicted_at = time.time()
+                pprint(("Account evicted", account.username), self.verbose)
+
+    def call(self, method, *args, **kw):
+        """ Calls the iRWebStats method (name) with one of the accounts """
+        if not _routed(method):
+            raise ValueError("%s can't be routed to one account" % method)
+        account = self.__pick()
+        ok = False
+        try:
+            if self.limiter is not None:
+                self.limiter.acquire()
+            res = getattr(account.client, method)(*args, **kw)
+            ok = res is not None and res != ''
+            return res
+        finally:
+            self.__done(account, ok)
+
+    def __getattr__(self, name):
+        if name.startswith('bulk_') and _routed(name[len('bulk_'):]):
+            return lambda custids, workers=None, **kw: self.map(
+                name[len('bulk_'):], custids, workers, **kw)
+        if not _routed(name):
+            raise AttributeError(name)
+        return lambda *args, **kw: self.call(name, *args, **kw)
+
+    def map(self, method, args, workers=None, **kw):
+        """ Calls method once per item of args (the first argument, i.e a
+            list of custids) spread among the accounts, with workers threads
+            (by default ct.BULK_WORKERS per healthy account). Results keep
+            the order of args; failed calls return their exception. """
+
+        def one(arg):
+            try:
+                return self.call(method, arg, **kw)
+            except Exception as e:
+                return e
+
+        if workers is None:
+            workers = ct.BULK_WORKERS * max(len(self.healthy()), 1)
+        from concurrent.futures import ThreadPoolExecutor  # lazy, slow import
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            return list(executor.map(one, args))
+        finally:
+            executor.shutdown()
+
+    def stats(self):
+        """ Requests, errors, requests in flight and health per account """
+        with self._lock:
+            return dict((a.username, {
+                'requests': a.requests, 'errors': a.errors,
+                'inflight': a.inflight, 'healthy': a.healthy})
+                for a in self.accounts)
+
+    def close(self):
+        for account in self.accounts:
+            account.client.close()
@@ -0,0 +1,506 @@
+#!/usr/bin/python
+""" AsyncIRWebStats class: asyncio version of iRWebStats. Requires Python 3
+    and aiohttp. Requests and parsing are shared with iRWebStats (see
+    endpoints.py) so both clients return the same data. """
+
+import asyncio
+import functools
+from urllib.parse import urlencode as encode
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None  # Optional dependency, only needed by this module
+
+from ir_webstats import constants as ct
+from ir_webstats import endpoints as ep
+from ir_webstats import metrics
+from ir_webstats import ratelimit
+from ir_webstats import retry
+from ir_webstats.catalog import load_catalog, save_catalog
+from ir_webstats.sessions import SessionStore
+from ir_webstats.singleflight import SingleFlight, key as flight_key
+from ir_webstats.util import *
+
+
+def logged_in(func):
+    """ Async counterpart of util.logged_in: returns None if the client is
+        not logged in and fills custid with the logged user if not set. """
+
+    fill = custid_filler(func)
+
+    @functools.wraps(func)
+    async def wrapper(self, *args, **kw):
+        if not self.logged:
+            pprint("Error, client is not logged in to iRacing Platform so\
+                    operation couldn't be completed.", self.verbose)
+            return None
+        if fill is not None:
+            args, kw = fill(self, args, kw)
+        return await func(self, *args, **kw)
+    return wrapper
+
+
+class _AsyncFlight(object):
+
+    def __init__(self):
+        self.future = asyncio.get_event_loop().create_future()
+        # Failures nobody waited for aren't logged as never retrieved
+        self.future.add_done_callback(
+            lambda f: f.cancelled() or f.exception())
+
+
+class AsyncSingleFlight(SingleFlight):
+
+    """ singleflight.SingleFlight for coroutines (of one event loop) """
+
+    async def do(self, key, func):
+        """ Returns (await func(), shared) """
+        flight, leader = self._join(key, _AsyncFlight)
+        if not leader:
+            try:
+                return await asyncio.shield(flight.future), True
+            except asyncio.CancelledError:
+                if not flight.future.cancelled():
+                    raise  # This waiter was cancelled
+            return await self.do(key, func)  # The sender was, send it
+        try:
+            result = await func()
+        except BaseException as e:  # Cancelled too, waiters must wake up
+            if isinstance(e, asyncio.CancelledError):
+                flight.future.cancel()
+            else:
+                flight.future.set_exception(e)
+            raise
+        finally:
+            self._land(key)
+        flight.future.set_result(result)
+        return result, False
+
+
+class AsyncIRWebStats:
+
+    """ Coroutine based client for iRacing stats. Same methods as iRWebStats
+        but they must be awaited. At most max_concurrency requests are in
+        flight at the same time and all of them go through the same rate
+        limiter used by iRWebStats (so sync and async clients in the same
+        process share the budget). observer gets the timings of every
+        request like in iRWebStats, connect is not measured (None). Login
+        sessions are kept in sessions (a sessions.SessionStore, shared with
+        iRWebStats by default) and the service catalog in catalog_file
+        (like iRWebStats, a catalog older than ct.CATALOG_MAX_AGE is
+        refreshed on login). With coalesce, identical requests made by
+        several coroutines at the same time are sent once. Failed requests
+        are retried and go through the circuit breaker like in iRWebStats
+        (retry_policy, breaker), timeout is the (connect, read) timeout of
+        every request in seconds. """
+
+    # Service catalog tables, decoded on first access (see util.ServiceInfo)
+    TRACKS = catalog_property('TRACKS')
+    CARS = catalog_property('CARS')
+    CARCLASS = catalog_property('CARCLASS')
+    CLUBS = CLUB = catalog_property('CLUBS')
+    DIVISION = catalog_property('DIVISION')
+    SEASON = catalog_property('SEASON')
+    YEARANDQUARTER = catalog_property('YEARANDQUARTER')
+
+    def __init__(self, verbose=True, limiter=None,
+                 max_concurrency=ct.ASYNC_MAX_CONCURRENCY, observer=None,
+                 sessions=None, coalesce=True, retry_policy=None,
+                 breaker=None, timeout=ct.REQUEST_TIMEOUT,
+                 catalog_file=ct.CATALOG_FILE):
+        if aiohttp is None:
+            raise RuntimeError("AsyncIRWebStats requires aiohttp")
+        self.last_cookie = ''
+        self.logged = False
+        self.custid = 0
+        self.verbose = verbose
+        self.limiter = ratelimit.shared_limiter() if limiter is None else \
+            limiter
+        self.max_concurrency = max_concurrency
+        self.observer = observer
+        self.sessions = SessionStore() if sessions is None else sessions
+        self.flights = AsyncSingleFlight() if coalesce else None
+        self.retry_policy = retry.RetryPolicy() if retry_policy is None \
+            else retry_policy
+        self.breaker = retry.shared_breaker() if breaker is None else breaker
+        self.timeout = timeout
+        self._sem = asyncio.Semaphore(max_concurrency)
+        self.session = None  # Created on first request (needs a loop)
+        self.catalog = ServiceInfo()
+        self.catalog_file = catalog_file
+        self.catalog_hash = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def login(self, username='', password=''):
+        """ Log in to iRacing members site. Uses the same saved sessions as
+            iRWebStats.login. Returns True if the login was succesful. """
+
+        if self.logged:
+            return True
+        try:
+            pprint("Loggin in...", self.verbose)
+            saved = await self._load_cookie(username)
+            if saved is not True:
+                # The login lock is waited for in a thread, not in the loop
+                lock = self.sessions.login_lock(username)
+                await asyncio.get_event_loop().run_in_executor(
+                    None, lock.__enter__)
+                try:
+                    # Maybe renewed by another process while we waited
+                    saved = await self._load_cookie(username, skip=saved)
+                    if saved is not True:
+                        return await self._login(username, password)
+                finally:
+                    lock.__exit__()
+            pprint("Previous cookie valid", self.verbose)
+            self.logged = True
+            if not self._load_catalog():
+                try:
+                    await self.refresh_catalog()
+                except Exception as e:
+                    pprint(("Couldn't refresh service info", e),
+                           self.verbose)
+
+        except Exception as e:
+            pprint(("Error on Login Request", e), self.verbose)
+            self.logged = False
+        return self.logged
+
+    async def _load_cookie(self, username, skip=None):
+        """ Like iRWebStats.__load_cookie: True if the saved session is
+            valid, else the session loaded (or None) """
+        saved = self.sessions.load(username)
+        if saved is None or saved == skip:
+            return saved
+        self.last_cookie, self.custid = saved
+        r = await self._req(ct.URL_DRIVER_COUNTS, raw=True)
+        if isinstance(parse(r, strict=False), dict):
+            return True
+        self.last_cookie = ''
+        return saved
+
+    async def _login(self, username, password):
+        """ Sends the login requests (with the login lock held) """
+        self.custid = ''
+        await self._req(ct.URL_IRACING_LOGIN, grab_cookie=True)
+        r = await self._req(ct.URL_IRACING_LOGIN2,
+                            ep.login_data(username, password),
+                            grab_cookie=True)
+
+        if 'irsso_members' in self.last_cookie:
+            self.custid = ep.parse_custid(r)
+            pprint(("CUSTID", self.custid), self.verbose)
+            self.logged = True
+            self._get_irservice_info(r)
+            self._save_catalog()
+            pprint("Saving cookie for future use", self.verbose)
+            self.sessions.save(username, self.last_cookie, self.custid)
+            pprint("Log in succesful", self.verbose)
+        else:
+            pprint("Invalid Login (user: %s). Please check your\
+                    credentials" % (username), self.verbose)
+            self.logged = False
+        return self.logged
+
+    def logout(self):
+        self.logged = False  # TODO proper logout
+
+    async def _req(self, url, data=None, grab_cookie=False, useget=False,
+                   record=None, raw=False):
+        """ Sends the request (see _request) unless the same one is in
+            flight, like iRWebStats.__req """
+
+        if self.flights is None or grab_cookie:
+            return await self._request(url, data, grab_cookie, useget,
+                                       record, raw)
+        key = flight_key(url, data, useget, raw, self.last_cookie)
+        html, shared = await self.flights.do(key, lambda: self._request(
+            url, data, grab_cookie, useget, record, raw))
+        if shared and (record is not None or self.observer is not None):
+            own = record is None
+            if own:
+                record = metrics.new_record(
+                    url.split('?')[0].rsplit('/', 1)[-1])
+            record.update(cache='coalesced', bytes=len(html or ''),
+                          connect=None, wire_bytes=None)
+            if own:
+                self._observe(record)
+        return html
+
+    async def _request(self, url, data=None, grab_cookie=False,
+                       useget=False, record=None, raw=False):
+        """ Sends the HTTP request to iRacing site and returns the body
+            (bytes with raw, else text).
+            record is the metrics record filled in for the observer; if
+            there's an observer and no record the request is reported on
+            its own. """
+
+        own = record is None and self.observer is not None
+        if own:
+            record = metrics.new_record(url.split('?')[0].rsplit('/', 1)[-1])
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                headers=ct.HEADERS, timeout=aiohttp.ClientTimeout(
+                    sock_connect=self.timeout[0], sock_read=self.timeout[1]))
+        wait = self.limiter.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        if record is not None:
+            record.update(wait=wait, connect=None, wire_bytes=None)
+        h = {}
+        if len(self.last_cookie):
+            h['Cookie'] = self.last_cookie
+
+        # Retries and circuit breaker like iRWebStats.__send
+        policy, attempt = self.retry_policy, 0
+        while True:
+            self.breaker.before()
+            error, after = None, None
+            try:
+                status, html, size, ttfb, download, after = \
+                    await self._send(url, data, h, useget, grab_cookie, raw)
+            except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError,
+                    asyncio.TimeoutError) as e:
+                self.breaker.failure()
+                error = e
+            except BaseException:  # Cancelled, invalid URL, etc.
+                self.breaker.abort()
+                raise
+            else:
+                if status >= 500:
+                    self.breaker.failure()
+                else:
+                    self.breaker.success()
+                if status not in policy.statuses:
+                    break
+            attempt += 1
+            if attempt > policy.retries:
+                if error is not None:
+                    raise RequestError("Request failed: %s" % error, url,
+                                       cause=error)
+                raise (RateLimitedError if status == 429 else ServerError)(
+                    "HTTP %s after %d attempts" % (status, attempt), url,
+                    status)
+            delay = policy.delay(attempt, after)
+            pprint(("Retrying request", url, error or status,
+                    "in %.2fs" % delay), self.verbose)
+            await asyncio.sleep(delay + max(self.limiter.reserve(), 0))
+            if record is not None:
+                record['retries'] += 1
+
+        if record is not None:
+            record.update(ttfb=ttfb, status=status, download=download,
+                          bytes=size)
+            if own:
+                self._observe(record)
+        return html
+
+    async def _send(self, url, data, h, useget, grab_cookie, raw):
+        """ Sends the request once. Returns (status, body, size, ttfb,
+            download, Retry-After), the body isn't read if the status is
+            retried """
+        async with self._sem:
+            start = metrics.now()
+            if (data is None) or useget:
+                resp = await self.session.get(url, headers=h, params=data)
+            else:
+                h['Content-Type'] = 'application/x-www-form-urlencoded;\
+                        charset=UTF-8'
+                resp = await self.session.post(url, data=encode(data),
+                                               headers=h)
+            headers = metrics.now()
+            async with resp:
+                if resp.status in self.retry_policy.statuses:
+                    return (resp.status, None, 0, headers - start, 0.0,
+                            retry.retry_after(
+                                resp.headers.get('Retry-After')))
+                if 'Set-Cookie' in resp.headers and grab_cookie:
+                    self.last_cookie = ', '.join(
+                        resp.headers.getall('Set-Cookie'))
+                    # Must get irsso_members from another header
+                    req_cookie = resp.request_info.headers.get('Cookie')
+                    if req_cookie:
+                        self.last_cookie += ';' + req_cookie
+                body = await resp.read()
+                html = body if raw else await resp.text()
+            return (resp.status, html, len(body), headers - start,
+                    metrics.now() - headers, None)
+
+    def _observe(self, record):
+        try:
+            self.observer.on_request(metrics.finish(record))
+        except Exception as e:
+            pprint(("Error in request observer", e), self.verbose)
+
+    async def _fetch(self, call):
+        """ Sends the request described by call (see endpoints.py) and
+            parses its response """
+        if self.observer is None:
+            return call.parse(await self._req(call.url, data=call.data,
+                                              useget=call.useget,
+                                              raw=call.raw))
+
+        record = metrics.new_record(call.name, call.endpoint)
+        try:
+            r = await self._req(call.url, data=call.data,
+                                useget=call.useget, record=record,
+                                raw=call.raw)
+            with metrics.measure(record, 'parse'):
+                return call.parse(r)
+        except Exception as e:
+            record['error'] = e.__class__.__name__
+            raise
+        finally:
+            self._observe(record)
+
+    def _get_irservice_info(self, resp):
+        pprint("Getting iRacing Service info (cars, tracks, etc.)",
+               self.verbose)
+        info, errors = irservice_info(resp)
+        for i in errors:
+            pprint(("Error ocurred. Couldn't get", i), self.verbose)
+        self.catalog = info
+
+    def _save_catalog(self):
+        if self.catalog_file is None or not self.catalog:
+            return
+        try:
+            self.catalog_hash = save_catalog(self.catalog,
+                                             self.catalog_file)
+        except (IOError, OSError) as e:
+            pprint(("Couldn't save service info", e), self.verbose)
+
+    def _load_catalog(self):
+        """ Loads the service info saved by a previous login (of either
+            client). Returns False if there's none or it's older than
+            ct.CATALOG_MAX_AGE (login refreshes it then). """
+        saved = None if self.catalog_file is None else \
+            load_catalog(self.catalog_file)
+        if saved is None:
+            return False
+        info, age, self.catalog_hash = saved
+        pprint("Using saved service info (cars, tracks, etc.)", self.verbose)
+        self.catalog = info
+        return age <= ct.CATALOG_MAX_AGE
+
+    @logged_in
+    async def refresh_catalog(self):
+        """ Same as iRWebStats.refresh_catalog """
+        old_hash = self.catalog_hash
+        info, errors = irservice_info(await self._req(ct.URL_IRACING_HOME))
+        if errors:
+            raise ParseError("Service info not found in Home page: %s" %
+                             ', '.join(errors))
+        self.catalog = info
+        self._save_catalog()
+        return self.catalog_hash != old_hash
+
+    @logged_in
+    async def iratingchart(self, custid=None, category=ct.IRATING_ROAD_CHART):
+        return await self._fetch(ep.iratingchart(custid, category))
+
+    @logged_in
+    async def driver_counts(self):
+        return await self._fetch(ep.driver_counts())
+
+    @logged_in
+    async def career_stats(self, custid=None):
+        return await self._fetch(ep.career_stats(custid))
+
+    @logged_in
+    async def yearly_stats(self, custid=None):
+        return await self._fetch(ep.yearly_stats(custid))
+
+    @logged_in
+    async def cars_driven(self, custid=None):
+        return await self._fetch(ep.cars_driven(custid))
+
+    @logged_in
+    async def personal_best(self, custid=None, carid=0):
+        return await self._fetch(ep.personal_best(custid, carid))
+
+    @logged_in
+    async def driverdata(self, drivername):
+        return await self._fetch(ep.driverdata(drivername))
+
+    @logged_in
+    async def lastrace_stats(self, custid=None):
+        return await self._fetch(ep.lastrace_stats(custid))
+
+    @logged_in
+    async def driver_search(self, race_type=ct.RACE_TYPE_ROAD,
+                            location=ct.LOC_ALL,
+                            license=(ct.LIC_ROOKIE, ct.ALL),
+                            irating=(0, ct.ALL), ttrating=(0, ct.ALL),
+                            avg_start=(0, ct.ALL), avg_finish=(0, ct.ALL),
+                            avg_points=(0, ct.ALL), avg_incs=(0, ct.ALL),
+                            active=False, sort=ct.SORT_IRATING, page=1,
+                            order=ct.ORDER_DESC, rows=ct.ROWS_DICT):
+        total_results, drivers = 0, {}
+        try:
+            drivers, total_results = await self._fetch(ep.driver_search(
+                self.custid, race_type, location, license, irating, ttrating,
+                avg_start, avg_finish, avg_points, avg_incs, active, sort,
+                page, order, rows))
+
+        except Exception as e:
+            pprint(("Error fetching driver search data. Error:", e),
+                   self.verbose)
+
+        return drivers, total_results
+
+    @logged_in
+    async def results_archive(self, custid=None, race_type=ct.RACE_TYPE_ROAD,
+                              event_types=ct.ALL, official=ct.ALL,
+                              license_level=ct.ALL, car=ct.ALL, track=ct.ALL,
+                              series=ct.ALL, season=(2014, 1, ct.ALL),
+                              date_range=ct.ALL, page=1, sort=ct.SORT_TIME,
+                              order=ct.ORDER_DESC, rows=ct.ROWS_DICT):
+        return await self._fetch(ep.results_archive(
+            custid, race_type, event_types, official, license_level, car,
+            track, series, season, date_range, page, sort, order, rows))
+
+    @logged_in
+    async def all_seasons(self):
+        pprint("Getting iRacing Seasons with Stats", self.verbose)
+        return await self._fetch(ep.all_seasons())
+
+    @logged_in
+    async def season_standings(self, season, carclass, club=ct.ALL,
+                               raceweek=ct.ALL, division=ct.ALL,
+                               sort=ct.SORT_POINTS, order=ct.ORDER_DESC,
+                               page=1, rows=ct.ROWS_DICT):
+        return await self._fetch(ep.season_standings(
+            season, carclass, club, raceweek, division, sort, order, page,
+            rows))
+
+    @logged_in
+    async def hosted_results(self, session_host=None, session_name=None,
+                             date_range=None, sort=ct.SORT_TIME,
+                             order=ct.ORDER_DESC, page=1):
+        return await self._fetch(ep.hosted_results(
+            session_host, session_name, date_range, sort, order, page))
+
+    @logged_in
+    async def session_times(self, series_season, start, end):
+        return await self._fetch(ep.session_times(series_season, start, end))
+
+    @logged_in
+    async def series_raceresults(self, season, raceweek, rows=ct.ROWS_DICT):
+        return await self._fetch(ep.series_raceresults(season, raceweek,
+                                                       rows))
+
+    @logged_in
+    async def event_results(self, subsession, sessnum=0, typed=False):
+        return await self._fetch(ep.event_results(subsession, sessnum, typed))
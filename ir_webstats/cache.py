@@ -0,0 +1,168 @@
+#!/usr/bin/python
+""" Persistent (SQLite) cache of iRacing responses. Entries are keyed on the
+    URL plus the normalized request parameters and expire after the TTL set
+    for their endpoint in ct.CACHE_TTL. Expired responses with validators
+    (ETag, Last-Modified) are kept to be revalidated with a conditional
+    request, a 304 answer renews them without downloading the body. """
+
+import sqlite3
+import threading
+import time
+
+try:
+    from urllib.parse import urlencode as encode  # python3
+except ImportError:
+    from urllib import urlencode as encode  # python2
+
+from ir_webstats import constants as ct
+
+
+class ResponseCache(object):
+
+    """ On disk response cache. path is the SQLite file, max_size the max.
+        total size (bytes) of the stored responses (least recently used
+        ones are evicted first) and ttls maps URL constants to their TTL in
+        seconds (0 disables the cache for that endpoint, ct.CACHE_FOREVER
+        never expires). Thread safe; the file can be shared by several
+        processes. """
+
+    def __init__(self, path=ct.CACHE_FILE, max_size=ct.CACHE_MAX_SIZE,
+                 ttls=None):
+        self.path = path
+        self.max_size = max_size
+        self.ttls = ct.CACHE_TTL if ttls is None else ttls
+        self.hits, self.misses = 0, 0
+        self.revalidated, self.bytes_saved = 0, 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False,
+                                   timeout=30)
+        self._db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT "
+                         "PRIMARY KEY, body TEXT, size INTEGER, expires REAL,"
+                         " accessed REAL, etag TEXT, modified TEXT)")
+        columns = [r[1] for r in
+                   self._db.execute("PRAGMA table_info(responses)")]
+        for column in ('etag', 'modified'):  # Files of older versions
+            if column not in columns:
+                self._db.execute("ALTER TABLE responses ADD COLUMN %s TEXT"
+                                 % column)
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON "
+                         "responses (accessed)")
+        self._db.commit()
+
+    @staticmethod
+    def key(url, data=None):
+        """ Cache key of a request: URL plus its parameters sorted by name """
+        if not data:
+            return url
+        return url + '#' + encode(sorted(data.items()))
+
+    def ttl(self, endpoint):
+        """ TTL (seconds) of an endpoint (URL constant) """
+        return self.ttls.get(endpoint, ct.CACHE_TTL_DEFAULT)
+
+    def get(self, key):
+        """ Returns the cached response or None if missing or expired """
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT body, expires FROM responses "
+                                   "WHERE key = ?", (key,)).fetchone()
+            if row is None or (row[1] is not None and row[1] < now):
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE responses SET accessed = ? WHERE "
+                             "key = ?", (now, key))
+            self._db.commit()
+            self.hits += 1
+            return row[0]
+
+    def validators(self, key):
+        """ Returns (ETag, Last-Modified) of the stored response, expired or
+            not, or None if there's none to revalidate """
+        with self._lock:
+            row = self._db.execute("SELECT etag, modified FROM responses "
+                                   "WHERE key = ?", (key,)).fetchone()
+        if row is None or (row[0] is None and row[1] is None):
+            return None
+        return row[0], row[1]
+
+    def revalidate(self, key):
+        """ The server answered 304 Not Modified: returns the stored
+            response (None if it was evicted meanwhile). It's renewed with
+            renew once the caller checked it. """
+        with self._lock:
+            row = self._db.execute("SELECT body FROM responses WHERE key = "
+                                   "?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.revalidated += 1
+            self.bytes_saved += len(row[0])
+            return row[0]
+
+    def renew(self, key, ttl):
+        """ Makes the stored response fresh for ttl seconds more """
+        now = time.time()
+        expires = None if ttl is ct.CACHE_FOREVER else now + ttl
+        with self._lock:
+            self._db.execute("UPDATE responses SET expires = ?, accessed = ?"
+                             " WHERE key = ?", (expires, now, key))
+            self._db.commit()
+
+    def set(self, key, body, ttl, etag=None, modified=None):
+        """ Stores a response for ttl seconds (ct.CACHE_FOREVER: no expire)
+            with its validators (ETag and Last-Modified headers). With ttl
+            0 it's only stored if it has validators, to be revalidated
+            next time. """
+        if ttl == 0 and etag is None and modified is None:
+            return
+        now = time.time()
+        expires = None if ttl is ct.CACHE_FOREVER else now + ttl
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO responses (key, body, "
+                             "size, expires, accessed, etag, modified) VALUES"
+                             " (?, ?, ?, ?, ?, ?, ?)",
+                             (key, body, len(body), expires, now, etag,
+                              modified))
+            self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        """ Removes expired entries and then the least recently used ones
+            until the cache fits in max_size. """
+        size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM "
+                                "responses").fetchone()[0]
+        if size <= self.max_size:
+            return
+        self._db.execute("DELETE FROM responses WHERE expires < ?",
+                         (time.time(),))
+        size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM "
+                                "responses").fetchone()[0]
+        rows = self._db.execute("SELECT key, size FROM responses ORDER BY "
+                                "accessed")
+        remove = []
+        for key, s in rows:
+            if size <= self.max_size:
+                break
+            remove.append((key,))
+            size -= s
+        self._db.executemany("DELETE FROM responses WHERE key = ?", remove)
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM responses")
+            self._db.commit()
+
+    def stats(self):
+        """ Returns hits, misses, revalidated (304) responses and the
+            bytes they saved, number of entries and total size """
+        with self._lock:
+            entries, size = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses")\
+                .fetchone()
+            return {'hits': self.hits, 'misses': self.misses,
+                    'revalidated': self.revalidated,
+                    'bytes_saved': self.bytes_saved, 'entries': entries,
+                    'size': size}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,50 @@
+#!/usr/bin/python
+""" Persistence of the iRacing service catalog (tracks, cars, car classes,
+    clubs, divisions, seasons) so it doesn't have to be downloaded from the
+    members Home page on every login. """
+
+import json
+import os
+import time
+
+from ir_webstats import constants as ct
+from ir_webstats.util import ServiceInfo
+
+_replace = getattr(os, 'replace', os.rename)  # python2 has no os.replace
+
+
+def catalog_hash(info):
+    """ Content hash of a catalog (ServiceInfo), used to detect changes """
+    import hashlib  # lazy, it's only needed when saving
+    dump = json.dumps(info.raw, sort_keys=True).encode('utf8')
+    return hashlib.sha1(dump).hexdigest()
+
+
+def save_catalog(info, path=ct.CATALOG_FILE):
+    """ Saves the catalog (ServiceInfo) to path with the current timestamp
+        and its content hash. Tables are kept as raw JSON so they are still
+        decoded lazily after loading. The file is replaced atomically so
+        concurrent readers never see a partial write. """
+
+    path = os.path.expanduser(path)
+    data = {'timestamp': time.time(), 'hash': catalog_hash(info),
+            'raw': info.raw}
+    tmp = '%s.%s.tmp' % (path, os.getpid())
+    with open(tmp, 'w') as o:
+        json.dump(data, o)
+    _replace(tmp, path)
+    return data['hash']
+
+
+def load_catalog(path=ct.CATALOG_FILE):
+    """ Loads a catalog saved with save_catalog. Returns a tuple
+        (ServiceInfo, age in seconds, hash) or None if there's no valid
+        catalog. """
+
+    try:
+        with open(os.path.expanduser(path), 'r') as o:
+            data = json.load(o)
+        return ServiceInfo(data['raw']), time.time() - data['timestamp'], \
+            data['hash']
+    except Exception:
+        return None
@@ -5,20 +5,19 @@ __email__ = "jjmc82@gmail.com"
 __version__ = "1.0"
 
 
-import urllib
-
-try:
-    import urllib.parse
-    encode = urllib.parse.urlencode  # python3
-except:
-    encode = urllib.urlencode  # python2
+import codecs
+import threading
+import time
 
-from io import StringIO
-import requests
 from ir_webstats import constants as ct
-import datetime
-import csv
-import time
+from ir_webstats import endpoints as ep
+from ir_webstats import metrics
+from ir_webstats import pool
+from ir_webstats import ratelimit
+from ir_webstats import retry
+from ir_webstats import singleflight
+from ir_webstats.catalog import load_catalog, save_catalog
+from ir_webstats.sessions import SessionStore
 from ir_webstats.util import *
 
 
@@ -30,13 +29,63 @@ class iRWebStats:
         are required. Most  data is returned in JSON format and
         converted to python dicts. """
 
-    def __init__(self, verbose=True):
+    # Service catalog tables, decoded on first access (see util.ServiceInfo)
+    TRACKS = catalog_property('TRACKS')
+    CARS = catalog_property('CARS')
+    CARCLASS = catalog_property('CARCLASS')
+    CLUBS = CLUB = catalog_property('CLUBS')
+    DIVISION = catalog_property('DIVISION')
+    SEASON = catalog_property('SEASON')
+    YEARANDQUARTER = catalog_property('YEARANDQUARTER')
+
+    def __init__(self, verbose=True, session=None, limiter=None,
+                 cache=None, catalog_file=ct.CATALOG_FILE, observer=None,
+                 sessions=None, coalesce=True, retry_policy=None,
+                 breaker=None, timeout=ct.REQUEST_TIMEOUT):
+        """ session is an optional requests Session used to send the
+            requests. By default every client owns a connection pool (see
+            pool.make_session); pass pool.shared_session() to share one
+            pool between several clients. timeout is the (connect, read)
+            timeout of every request in seconds. limiter is the rate limiter
+            (see ratelimit.py), by default the one shared by every client
+            in the process. cache is an optional cache.ResponseCache used
+            by the stats methods (see their cache argument). catalog_file
+            is where the service catalog (self.TRACKS, self.CARS, etc.) is
+            kept between logins, None disables it. observer gets the
+            timings, size, status, etc. of every request (see
+            metrics.Observer and metrics.MetricsAggregator). sessions is
+            the sessions.SessionStore where the login cookie of each account
+            is kept to be reused, by default the one at ct.SESSION_FILE
+            (shared by every process of the host). With coalesce, identical
+            requests made at the same time by several threads are sent
+            once (see singleflight.py and self.flights.stats()).
+            retry_policy (retry.RetryPolicy) sets how connection errors,
+            429 and 5xx answers are retried, retry.NO_RETRY disables it.
+            breaker is the retry.CircuitBreaker that stops the requests
+            when the site is failing, by default the one shared by every
+            client in the process. Requests that fail after their retries
+            raise util.RequestError (or its subclasses), the ones stopped
+            by the breaker util.CircuitOpenError. """
         self.last_cookie = ''
         self.logged = False
         self.custid = 0
         self.verbose = verbose
-        self.TRACKS, self.CARS, self.DIVISION, self.CARCLASS, self.CLUB = {},\
-            {}, {}, {}, {}
+        self._session = session  # Created on first request if None
+        self._own_session = session is None
+        self.timeout = timeout
+        self.limiter = ratelimit.shared_limiter() if limiter is None else \
+            limiter
+        self.cache = cache
+        self.catalog_file = catalog_file
+        self.sessions = SessionStore() if sessions is None else sessions
+        self.username = ''
+        self.catalog_hash = None
+        self.observer = observer
+        self.flights = singleflight.SingleFlight() if coalesce else None
+        self.retry_policy = retry.RetryPolicy() if retry_policy is None \
+            else retry_policy
+        self.breaker = retry.shared_breaker() if breaker is None else breaker
+        self.catalog = ServiceInfo()
 
     def __save_cookie(self):
         """ Saves the current cookie to disk from a successful login to avoid 
@@ -44,204 +93,444 @@ class iRWebStats:
             at least a couple of hours """
 
         pprint("Saving cookie for future use", self.verbose)
-        o = open('cookie.tmp', 'w')
-        o.write(self.last_cookie)
-        o.write('\n' + str(self.custid))
-        o.close()
-
-    def __load_cookie(self):
-        """ Loads a previously saved cookie """
-        try:
-            o = open('cookie.tmp', 'r')
-            self.last_cookie, self.custid = o.read().split('\n')
-            o.close()
+        self.sessions.save(self.username, self.last_cookie, self.custid)
+
+    def __load_cookie(self, skip=None):
+        """ Loads the saved session of the account, unless it's skip (known
+            to be invalid), and checks it. Returns True if it's valid, else
+            the session loaded (None if there's none). """
+        saved = self.sessions.load(self.username)
+        if saved is None or saved == skip:
+            return saved
+        self.last_cookie, self.custid = saved
+        if self.__check_cookie():
             return True
-        except:
-            return False
+        self.last_cookie = ''
+        return saved
 
     def login(self, username='', password=''):
         """ Log in to iRacing members site. If there is a valid cookie saved 
             then it tries to use it to avoid a new login request. Returns 
             True is the login was succesful and stores the customer id 
-            (custid) of the current login in self.custid. """
+            (custid) of the current login in self.custid. When the saved
+            session of the account expired, only one of the processes
+            sharing it logs in again, the others wait and reuse the new
+            session. """
 
         if self.logged:
             return True
-        data = {"username": username, "password": password, 'utcoffset': 300,
-                'todaysdate': ''}
+        self.username = username
         try:
             pprint("Loggin in...", self.verbose)
             # Check if there's a previous cookie
-            if (self.__load_cookie() and self.__check_cookie()):
-                #  If previous cookie is valid
-                pprint("Previous cookie valid", self.verbose)
-                self.logged = True
-                # Load iracing info
-                self.__get_irservice_info(self.__req(ct.URL_IRACING_HOME,
-                                                     cookie=self.last_cookie))
-                # TODO Should we cache this?
-                return self.logged
-            self.custid = ''
-            r = self.__req(ct.URL_IRACING_LOGIN, grab_cookie=True)
-            r = self.__req(ct.URL_IRACING_LOGIN2, data,
-                           cookie=self.last_cookie, grab_cookie=True)
-
-            if 'irsso_members' in self.last_cookie:
-                ind = r.index('js_custid')
-                custid = int(r[ind + 11: r.index(';', ind)])
-                self.custid = custid
-                pprint(("CUSTID", self.custid), self.verbose)
-                self.logged = True
-                self.__get_irservice_info(r)
-                self.__save_cookie()
-                pprint("Log in succesful", self.verbose)
-            else:
-                pprint("Invalid Login (user: %s). Please check your\
-                        credentials" % (username), self.verbose)
-                self.logged = False
+            saved = self.__load_cookie()
+            if saved is not True:
+                with self.sessions.login_lock(username):
+                    # Maybe renewed by another process while we waited
+                    saved = self.__load_cookie(skip=saved)
+                    if saved is not True:
+                        return self.__login(username, password)
+            #  If previous cookie is valid
+            pprint("Previous cookie valid", self.verbose)
+            self.logged = True
+            # Load iracing info, from disk if we have it
+            if not self.__load_catalog():
+                self.__refresh_saved_catalog()
 
         except Exception as e:
             pprint(("Error on Login Request", e), self.verbose)
             self.logged = False
         return self.logged
 
+    def __login(self, username, password):
+        """ Sends the login requests (with the login lock held) """
+        self.custid = ''
+        r = self.__req(ct.URL_IRACING_LOGIN, grab_cookie=True)
+        r = self.__req(ct.URL_IRACING_LOGIN2,
+                       ep.login_data(username, password),
+                       cookie=self.last_cookie, grab_cookie=True)
+
+        if 'irsso_members' in self.last_cookie:
+            self.custid = ep.parse_custid(r)
+            pprint(("CUSTID", self.custid), self.verbose)
+            self.logged = True
+            self.__get_irservice_info(r)
+            self.__save_catalog()
+            self.__save_cookie()
+            pprint("Log in succesful", self.verbose)
+        else:
+            pprint("Invalid Login (user: %s). Please check your\
+                    credentials" % (username), self.verbose)
+            self.logged = False
+        return self.logged
+
     def logout(self):
         self.logged = False  # TODO proper logout
 
+    def close(self):
+        """ Closes the pooled connections if the session is owned by this
+            client. Shared sessions are left open. """
+        if self._own_session and self._session is not None:
+            self._session.close()
+            self._session = None
+
+    @property
+    def session(self):
+        """ requests Session used to send the requests. It's created on
+            first use so requests isn't imported until it's needed. """
+        if self._session is None:
+            self._session = pool.make_session()
+        return self._session
+
     def __check_cookie(self):
         """ Checks the cookie by testing a request response"""
 
-        r = parse(self.__req(ct.URL_DRIVER_COUNTS, cookie=self.last_cookie))
+        r = parse(self.__req(ct.URL_DRIVER_COUNTS, cookie=self.last_cookie,
+                             raw=True), strict=False)
         if isinstance(r, dict):
             return True
         return False
 
     def __req(self, url, data=None, cookie=None, grab_cookie=False,
-              useget=False):
-        """ Creates and sends the HTTP requests to iRacing site """
+              useget=False, endpoint=None, cache=ct.CACHE_BYPASS,
+              stream=False, record=None, raw=False, store=None):
+        """ Sends the request (see __request), unless the same one is
+            already in flight: then it waits for it and returns its body.
+            Streamed requests and logins (grab_cookie) are always sent. """
+
+        if self.flights is None or stream or grab_cookie:
+            return self.__request(url, data, cookie, grab_cookie, useget,
+                                  endpoint, cache, stream, record, raw,
+                                  store)
+        key = singleflight.key(url, data, useget, raw, cache,
+                               self.last_cookie if cookie is None else cookie)
+        html, shared = self.flights.do(key, lambda: self.__request(
+            url, data, cookie, grab_cookie, useget, endpoint, cache, stream,
+            record, raw, store))
+        if shared and (record is not None or self.observer is not None):
+            own = record is None
+            if own:
+                record = metrics.new_record(
+                    url.split('?')[0].rsplit('/', 1)[-1], endpoint)
+            record.update(cache='coalesced', bytes=len(html or ''))
+            if own:
+                self.__observe(record)
+        return html
 
-        # Sleep/wait to avoid flooding the service with requests
-        time.sleep(ct.WAIT_TIME)  # 0.3 seconds
-        h = ct.HEADERS.copy()
+    def __request(self, url, data=None, cookie=None, grab_cookie=False,
+                  useget=False, endpoint=None, cache=ct.CACHE_BYPASS,
+                  stream=False, record=None, raw=False, store=None):
+        """ Creates and sends the HTTP requests to iRacing site. If
+            endpoint (URL constant) and store (a dict) are set the response
+            cache is used according to cache (ct.CACHE_USE,
+            ct.CACHE_REFRESH or ct.CACHE_BYPASS); an expired response is
+            revalidated with a conditional request and reused if the server
+            answers 304. Responses aren't stored here, store is filled in
+            for __store to do it once the response parsed fine. With
+            stream the response object is returned before reading its body
+            (GET only, never cached) and with raw the body is returned as
+            bytes instead of text. record is the metrics record filled in
+            for the observer; if there's an observer and no record the
+            request is reported on its own. """
+
+        own = record is None and self.observer is not None
+        if own:
+            record = metrics.new_record(url.split('?')[0].rsplit('/', 1)[-1],
+                                        endpoint)
+        h = {}  # ct.HEADERS are already set in the session
+        if self.cache is None or endpoint is None or stream or store is None:
+            cache = ct.CACHE_BYPASS
+        if cache != ct.CACHE_BYPASS:
+            key = self.cache.key(url, data)
+            if cache == ct.CACHE_USE:
+                html = self.cache.get(key)
+                if html is not None:
+                    if record is not None:
+                        record.update(cache='hit', bytes=len(html))
+                        if own:
+                            self.__observe(record)
+                    return html
+            validators = self.cache.validators(key)
+            if validators is not None:  # Only download it if it changed
+                if validators[0] is not None:
+                    h['If-None-Match'] = validators[0]
+                if validators[1] is not None:
+                    h['If-Modified-Since'] = validators[1]
+
+        # Wait (only if the rate budget is exhausted) to avoid flooding the
+        # service with requests
+        wait = self.limiter.acquire()
         if cookie is not None:  # Send the cookie
             h['Cookie'] = cookie
         elif len(self.last_cookie):
             h['Cookie'] = self.last_cookie
 
-        if (data is None) or useget:
-            resp = requests.get(url, headers=h, params=data)
+        if record is None:
+            resp = self.__send(url, data, h, useget, stream, record)
+            html = None if stream else resp.content if raw else resp.text
         else:
-            h['Content-Type'] = 'application/x-www-form-urlencoded;\
-                    charset=UTF-8'
-            resp = requests.post(url, data=data, headers=h)
+            record['wait'] = wait
+            timed = pool.measures_connect(self.session, url)
+            pool.connect_time()  # Clears a previous measure
+            start = metrics.now()
+            # Streamed so the headers and the body are timed apart
+            resp = self.__send(url, data, h, useget, True, record)
+            headers = metrics.now()
+            record['connect'] = pool.connect_time() if timed else None
+            record['ttfb'] = headers - start - (record['connect'] or 0)
+            record['status'] = resp.status_code
+            html = None
+            if not stream:
+                html = resp.content if raw else resp.text
+                record['download'] = metrics.now() - headers
+                record['bytes'] = len(resp.content)
+                record['wire_bytes'] = pool.wire_bytes(resp)
+                if cache != ct.CACHE_BYPASS:
+                    record['cache'] = 'miss'
         if 'Set-Cookie' in resp.headers and grab_cookie:
             self.last_cookie = resp.headers['Set-Cookie']
             # Must get irsso_members from another header
             if 'cookie' in resp.request.headers:
                 resp_req_cookie = resp.request.headers['cookie']
                 self.last_cookie += ';' + resp_req_cookie
-        html = resp.text
-        return html
+
+        if cache != ct.CACHE_BYPASS and resp.status_code == 304:
+            html = self.cache.revalidate(key)
+            if html is None:  # Evicted meanwhile, request the whole body
+                html = self.__req(url, data, cookie, grab_cookie, useget,
+                                  endpoint, ct.CACHE_REFRESH, record=record,
+                                  raw=raw, store=store)
+            else:
+                store['key'] = key
+                if record is not None:
+                    record.update(cache='revalidated', bytes=len(html))
+        elif cache != ct.CACHE_BYPASS and resp.status_code == 200:
+            store.update(key=key, body=html, etag=resp.headers.get('ETag'),
+                         modified=resp.headers.get('Last-Modified'))
+        if own:
+            self.__observe(record)
+        return resp if stream else html
+
+    def __send(self, url, data, headers, useget, stream, record=None):
+        """ Sends the request through the circuit breaker and retries it
+            (see retry.py) on connection errors and retryable statuses.
+            Only connection errors and 5xx count as breaker failures.
+            Every retry waits for the rate limiter too. """
+
+        import requests  # Already loaded by the session
+        policy, attempt = self.retry_policy, 0
+        while True:
+            self.breaker.before()
+            resp, error, after = None, None, None
+            try:
+                resp = self.__send_once(url, data, headers, useget, stream)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.breaker.failure()
+                error = e
+            except BaseException:
+                # Not the site's fault (i.e invalid URL, KeyboardInterrupt):
+                # not a failure, but if it was the trial let another one in
+                self.breaker.abort()
+                raise
+            else:
+                if resp.status_code >= 500:
+                    self.breaker.failure()
+                else:
+                    self.breaker.success()
+                if resp.status_code not in policy.statuses:
+                    return resp
+                after = retry.retry_after(resp.headers.get('Retry-After'))
+                resp.close()  # Back to the pool, the body isn't needed
+            attempt += 1
+            if attempt > policy.retries:
+                if error is not None:
+                    raise RequestError("Request failed: %s" % error, url,
+                                       cause=error)
+                status = resp.status_code
+                raise (RateLimitedError if status == 429 else ServerError)(
+                    "HTTP %s after %d attempts" % (status, attempt), url,
+                    status)
+            delay = policy.delay(attempt, after)
+            pprint(("Retrying request", url, error or resp.status_code,
+                    "in %.2fs" % delay), self.verbose)
+            time.sleep(delay)
+            self.limiter.acquire()
+            if record is not None:
+                record['retries'] += 1
+
+    def __send_once(self, url, data, headers, useget, stream):
+        if (data is None) or useget:
+            return self.session.get(url, headers=headers, params=data,
+                                    stream=stream, timeout=self.timeout)
+        headers['Content-Type'] = 'application/x-www-form-urlencoded;\
+                charset=UTF-8'
+        return self.session.post(url, data=data, headers=headers,
+                                 stream=stream, timeout=self.timeout)
+
+    def __observe(self, record):
+        try:
+            self.observer.on_request(metrics.finish(record))
+        except Exception as e:
+            pprint(("Error in request observer", e), self.verbose)
+
+    def __fetch(self, call, cache=ct.CACHE_USE):
+        """ Sends the request described by call (see endpoints.py) and
+            parses its response, which is cached only if it parsed fine """
+        store = {}
+        if self.observer is None:
+            r = self.__req(call.url, data=call.data, cookie=self.last_cookie,
+                           useget=call.useget, endpoint=call.endpoint,
+                           cache=cache, raw=call.raw, store=store)
+            res = call.parse(r)
+            self.__store(call, store, res)
+            return res
+
+        record = metrics.new_record(call.name, call.endpoint)
+        try:
+            r = self.__req(call.url, data=call.data, cookie=self.last_cookie,
+                           useget=call.useget, endpoint=call.endpoint,
+                           cache=cache, record=record, raw=call.raw,
+                           store=store)
+            with metrics.measure(record, 'parse'):
+                res = call.parse(r)
+            self.__store(call, store, res)
+            return res
+        except Exception as e:
+            record['error'] = e.__class__.__name__
+            raise
+        finally:
+            self.__observe(record)
+
+    def __store(self, call, store, res):
+        """ Caches the response described by store (see __request), res is
+            the response parsed """
+        if 'key' not in store or res == '':  # Not JSON, i.e the login page
+            return
+        ttl = self.cache.ttl(call.endpoint)
+        if ttl is ct.CACHE_FOREVER and call.final is not None and \
+                not call.final(res):
+            ttl = 0  # May change (i.e unfinished subsession), revalidate it
+        if 'body' in store:
+            self.cache.set(store['key'], store['body'], ttl, store['etag'],
+                           store['modified'])
+        else:  # Revalidated
+            self.cache.renew(store['key'], ttl)
 
     def __get_irservice_info(self, resp):
         """ Gets general information from iracing service like current tracks, 
             cars, series, etc. Check self.TRACKS, self.CARS, self.DIVISION 
-            , self.CARCLASS, self.CLUB. """
+            , self.CARCLASS, self.CLUBS. """
 
         pprint("Getting iRacing Service info (cars, tracks, etc.)",
                self.verbose)
-        items = {"TRACKS":  "TrackListing", "CARS": "CarListing",
-                 "CARCLASS":  "CarClassListing", "CLUBS": "ClubListing",
-                 "SEASON": "SeasonListing", "DIVISION": "DivisionListing",
-                 "YEARANDQUARTER": "YearAndQuarterListing"}
-        for i in items:
-            str2find = "var " + items[i] + " = extractJSON('"
-            try:
-                ind1 = resp.index(str2find)
-                json_o = resp[ind1 + len(str2find): resp.index("');", ind1)]\
-                    .replace('+', ' ')
-                o = json.loads(json_o)
-                if i not in ("SEASON", "YEARANDQUARTER"):
-                    o = {ele['id']: ele for ele in o}
-                setattr(self, i, o)  # i.e self.TRACKS = o
+        info, errors = irservice_info(resp)
+        for i in errors:
+            pprint(("Error ocurred. Couldn't get", i), self.verbose)
+        self.catalog = info
+
+    def __save_catalog(self):
+        if self.catalog_file is None or not self.catalog:
+            return
+        try:
+            self.catalog_hash = save_catalog(self.catalog,
+                                             self.catalog_file)
+        except (IOError, OSError) as e:
+            pprint(("Couldn't save service info", e), self.verbose)
+
+    def __load_catalog(self):
+        """ Loads the service info saved by a previous login. If it's older
+            than ct.CATALOG_MAX_AGE it's still used but refreshed in
+            background (a non daemon thread, so the process finishes it
+            before exiting), and older than ct.CATALOG_HARD_MAX_AGE it's
+            refreshed right away. Returns False if there's no saved info. """
+
+        if self.catalog_file is None:
+            return False
+        saved = load_catalog(self.catalog_file)
+        if saved is None:
+            return False
+        info, age, self.catalog_hash = saved
+        pprint("Using saved service info (cars, tracks, etc.)", self.verbose)
+        self.catalog = info
+        if age > ct.CATALOG_HARD_MAX_AGE:
+            self.__refresh_saved_catalog()
+        elif age > ct.CATALOG_MAX_AGE:
+            threading.Thread(target=self.__refresh_saved_catalog).start()
+        return True
+
+    def __refresh_saved_catalog(self):
+        """ refresh_catalog keeping the current info if it fails """
+        try:
+            self.refresh_catalog()
+        except Exception as e:
+            pprint(("Couldn't refresh service info", e), self.verbose)
 
-            except Exception as e:
-                pprint(("Error ocurred. Couldn't get", i), self.verbose)
+    @logged_in
+    def refresh_catalog(self):
+        """ Downloads the service info (self.TRACKS, self.CARS, etc.) from
+            iRacing Home page and saves it for future logins. Returns True
+            if it changed. If the page lacks any table (i.e the login page,
+            the session expired) the current info is kept and ParseError is
+            raised. """
+
+        old_hash = self.catalog_hash
+        info, errors = irservice_info(self.__req(ct.URL_IRACING_HOME,
+                                                 cookie=self.last_cookie))
+        if errors:
+            raise ParseError("Service info not found in Home page: %s" %
+                             ', '.join(errors))
+        self.catalog = info
+        self.__save_catalog()
+        return self.catalog_hash != old_hash
 
     def _load_irservice_var(self, varname, resp, appear=1):
-        str2find = "var " + varname + " = extractJSON('"
-        ind1 = -1
-        for _ in range(appear):
-            ind1 = resp.index(str2find, ind1+1)
-        json_o = resp[ind1 + len(str2find): resp.index("');", ind1)]\
-            .replace('+', ' ')
-        o = json.loads(json_o)
-        if varname not in ("SeasonListing", "YEARANDQUARTER"):
-            o = {ele['id']: ele for ele in o}
-        return o
+        return load_irservice_var(varname, resp, appear)
 
     @logged_in
-    def iratingchart(self, custid=None, category=ct.IRATING_ROAD_CHART):
+    def iratingchart(self, custid=None, category=ct.IRATING_ROAD_CHART,
+                     cache=ct.CACHE_USE):
         """ Gets the irating data of a driver using its custom id (custid) 
             that generates the chart located in the driver's profile. """
 
-        r = self.__req(ct.URL_STATS_CHART % (custid, category),
-                       cookie=self.last_cookie)
-        return parse(r)
+        return self.__fetch(ep.iratingchart(custid, category), cache)
 
     @logged_in
-    def driver_counts(self):
+    def driver_counts(self, cache=ct.CACHE_USE):
         """ Gets list of connected myracers and notifications. """
-        r = self.__req(ct.URL_DRIVER_COUNTS, cookie=self.last_cookie)
-        return parse(r)
+        return self.__fetch(ep.driver_counts(), cache)
 
     @logged_in
-    def career_stats(self, custid=None):
+    def career_stats(self, custid=None, cache=ct.CACHE_USE):
         """ Gets career stats (top5, top 10, etc.) of driver (custid)."""
-        r = self.__req(ct.URL_CAREER_STATS % (custid),
-                       cookie=self.last_cookie)
-        return parse(r)[0]
+        return self.__fetch(ep.career_stats(custid), cache)
 
     @logged_in
-    def yearly_stats(self, custid=None):
+    def yearly_stats(self, custid=None, cache=ct.CACHE_USE):
         """ Gets yearly stats (top5, top 10, etc.) of driver (custid)."""
-        r = self.__req(ct.URL_YEARLY_STATS % (custid),
-                       cookie=self.last_cookie)
-        # tofile(r)
-        return parse(r)
+        return self.__fetch(ep.yearly_stats(custid), cache)
 
     @logged_in
-    def cars_driven(self, custid=None):
+    def cars_driven(self, custid=None, cache=ct.CACHE_USE):
         """ Gets list of cars driven by driver (custid)."""
-        r = self.__req(ct.URL_CARS_DRIVEN % (custid),
-                       cookie=self.last_cookie)
-        # tofile(r)
-        return parse(r)
+        return self.__fetch(ep.cars_driven(custid), cache)
 
     @logged_in
-    def personal_best(self, custid=None, carid=0):
+    def personal_best(self, custid=None, carid=0, cache=ct.CACHE_USE):
         """ Personal best times of driver (custid) using car 
             (carid. check self.CARS) set in official events."""
-        r = self.__req(ct.URL_PERSONAL_BEST % (carid, custid),
-                       cookie=self.last_cookie)
-        return parse(r)
+        return self.__fetch(ep.personal_best(custid, carid), cache)
 
     @logged_in
-    def driverdata(self, drivername):
+    def driverdata(self, drivername, cache=ct.CACHE_USE):
         """ Personal data of driver  using its name in the request 
             (i.e drivername="Victor Beltran"). """
 
-        r = self.__req(ct.URL_DRIVER_STATUS % (encode({
-            'searchTerms': drivername})), cookie=self.last_cookie)
-        # tofile(r)
-        return parse(r)
+        return self.__fetch(ep.driverdata(drivername), cache)
 
     @logged_in
-    def lastrace_stats(self, custid=None):
+    def lastrace_stats(self, custid=None, cache=ct.CACHE_USE):
         """ Gets stats of last races (10 max?) of driver (custid)."""
-        r = self.__req(ct.URL_LASTRACE_STATS % (custid),
-                       cookie=self.last_cookie)
-        return parse(r)
+        return self.__fetch(ep.lastrace_stats(custid), cache)
 
     @logged_in
     def driver_search(self, race_type=ct.RACE_TYPE_ROAD, location=ct.LOC_ALL,
@@ -249,52 +538,24 @@ class iRWebStats:
                       ttrating=(0, ct.ALL), avg_start=(0, ct.ALL),
                       avg_finish=(0, ct.ALL), avg_points=(0, ct.ALL),
                       avg_incs=(0, ct.ALL), active=False,
-                      sort=ct.SORT_IRATING, page=1, order=ct.ORDER_DESC):
+                      sort=ct.SORT_IRATING, page=1, order=ct.ORDER_DESC,
+                      rows=ct.ROWS_DICT, cache=ct.CACHE_USE):
         """Search drivers using several search fields. A tuple represent a 
            range (i.e irating=(1000, 2000) gets drivers with irating 
            between 1000 and 2000). Use ct.ALL used in the lower or 
            upperbound of a range disables that limit. Returns a tuple 
            (results, total_results) so if you want all results you should 
            request different pages (using page) until you gather all
-           total_results. Each page has 25 (ct.NUM_ENTRIES) results max."""
-
-        lowerbound = ct.NUM_ENTRIES * (page - 1) + 1
-        upperbound = lowerbound + ct.NUM_ENTRIES - 1
-        search = 'null'
-        friend = ct.ALL  # TODO
-        studied = ct.ALL  # TODO
-        recent = ct.ALL  # TODO
-
-        active = int(active)
-        # Data to POST
-        data = {'custid': self.custid, 'search': search, 'friend': friend,
-                'watched': studied, 'country': location, 'recent': recent,
-                'category': race_type, 'classlow': license[0],
-                'classhigh': license[1], 'iratinglow': irating[0],
-                'iratinghigh': irating[1], 'ttratinglow': ttrating[0],
-                'ttratinghigh': ttrating[1], 'avgstartlow': avg_start[0],
-                'avgstarthigh': avg_start[1], 'avgfinishlow': avg_finish[0],
-                'avgfinishhigh': avg_finish[1], 'avgpointslow': avg_points[0],
-                'avgpointshigh': avg_points[1], 'avgincidentslow':
-                avg_incs[0], 'avgincidentshigh': avg_incs[1],
-                'lowerbound': lowerbound, 'upperbound': upperbound,
-                'sort': sort, 'order': order, 'active': active}
+           total_results. Each page has 25 (ct.NUM_ENTRIES) results max.
+           rows selects the format of the results (ct.ROWS_DICT,
+           ct.ROWS_TUPLE or ct.ROWS_COLUMNS, see util.format_results)."""
 
         total_results, drivers = 0, {}
-
         try:
-            r = self.__req(ct.URL_DRIVER_STATS, data=data,
-                           cookie=self.last_cookie)
-            res = parse(r)
-            total_results = res['d']['32']
-
-            header = res['m']
-            f = res['d']['r'][0]
-            if int(f['29']) == int(self.custid):  # 29 is custid
-                drivers = res['d']['r'][1:]
-            else:
-                drivers = res['d']['r']
-            drivers = format_results(drivers, header)
+            drivers, total_results = self.__fetch(ep.driver_search(
+                self.custid, race_type, location, license, irating, ttrating,
+                avg_start, avg_finish, avg_points, avg_incs, active, sort,
+                page, order, rows), cache)
 
         except Exception as e:
             pprint(("Error fetching driver search data. Error:", e),
@@ -302,6 +563,12 @@ class iRWebStats:
 
         return drivers, total_results
 
+    @logged_in
+    def __driver_search_page(self, cache=ct.CACHE_USE, **kw):
+        """ driver_search raising its errors, so iter_driver_search isn't
+            cut short silently by a failed page """
+        return self.__fetch(ep.driver_search(self.custid, **kw), cache)
+
     def test(self, a, b=2, c=3):
         return a, b, c
 
@@ -311,182 +578,200 @@ class iRWebStats:
                         license_level=ct.ALL, car=ct.ALL, track=ct.ALL,
                         series=ct.ALL, season=(2014, 1, ct.ALL),
                         date_range=ct.ALL, page=1, sort=ct.SORT_TIME,
-                        order= ct.ORDER_DESC):
+                        order= ct.ORDER_DESC, rows=ct.ROWS_DICT,
+                        cache=ct.CACHE_USE):
         """ Search race results using various fields. Returns a tuple 
             (results, total_results) so if you want all results you should 
             request different pages (using page). Each page has 25 
-            (ct.NUM_ENTRIES) results max."""
-
-        format_ = 'json'
-        lowerbound = ct.NUM_ENTRIES * (page - 1) + 1
-        upperbound = lowerbound + ct.NUM_ENTRIES - 1
-        #  TODO carclassid, seriesid in constants
-        data = {'format': format_, 'custid': custid, 'seriesid': series,
-                'carid': car, 'trackid': track, 'lowerbound': lowerbound,
-                'upperbound': upperbound, 'sort': sort, 'order': order,
-                'category': race_type, 'showtts': 0, 'showraces': 0,
-                'showquals': 0, 'showops': 0, 'showofficial': 0,
-                'showunofficial': 0, 'showrookie': 0, 'showclassa': 0,
-                'showclassb': 0, 'showclassc': 0, 'showclassd': 0,
-                'showpro': 0, 'showprowc': 0, }
-        # Events
-        ev_vars = {ct.EVENT_RACE: 'showraces', ct.EVENT_QUALY: 'showquals',
-                   ct.EVENT_PRACTICE: 'showops', ct.EVENT_TTRIAL: 'showtts'}
-        if event_types == ct.ALL:
-            event_types = (ct.EVENT_RACE, ct.EVENT_QUALY, ct.EVENT_PRACTICE,
-                           ct.EVENT_TTRIAL)
-
-        for v in event_types:
-            data[ev_vars[v]] = 1
-        # Official, unofficial
-        if official == ct.ALL:
-            data['showofficial'] = 1
-            data['showunoofficial'] = 1
-        else:
-            if ct.EVENT_UNOFFICIAL in official:
-                data['showunofficial'] = 1
-            if ct.EVENT_OFFICIAL in official:
-                data['showofficial'] = 1
-
-        # Season
-        if date_range == ct.ALL:
-            data['seasonyear'] = season[0]
-            data['seasonquarter'] = season[1]
-            if season[2] != ct.ALL:
-                data['raceweek'] = season[2]
-        else:
-            # Date range
-            tc = lambda s:\
-                time.mktime(datetime.datetime.strptime(s, "%Y-%m-%d").
-                            timetuple()) * 1000
-            data['starttime_low'] = tc(date_range[0])  # multiplied by 1000
-            data['starttime_high'] = tc(date_range[1])
-
-        # License levels
-        lic_vars = {ct.LIC_ROOKIE: 'showrookie', ct.LIC_A: 'showclassa',
-                    ct.LIC_B: 'showclassb', ct.LIC_C: 'showclassc',
-                    ct.LIC_D: 'showclassd', ct.LIC_PRO: 'showpro',
-                    ct.LIC_PRO_WC: 'showprowc'}
-
-        if license_level == ct.ALL:
-            license_level = (ct.LIC_ROOKIE, ct.LIC_A, ct.LIC_B, ct.LIC_C,
-                             ct.LIC_D, ct.LIC_PRO, ct.LIC_PRO_WC)
-        for v in license_level:
-            data[lic_vars[v]] = 1
-        r = self.__req(ct.URL_RESULTS_ARCHIVE, data=data,
-                       cookie=self.last_cookie)
-        res = parse(r)
-        total_results, results = 0, []
-        if len(res['d']):
-            total_results = res['d']['46']
-            results = res['d']['r']
-            header = res['m']
-            results = format_results(results, header)
-
-        return results, total_results
+            (ct.NUM_ENTRIES) results max. rows selects the format of the
+            results (see driver_search)."""
+
+        return self.__fetch(ep.results_archive(
+            custid, race_type, event_types, official, license_level, car,
+            track, series, season, date_range, page, sort, order, rows),
+            cache)
 
     @logged_in
-    def all_seasons(self):
+    def all_seasons(self, cache=ct.CACHE_USE):
         """ Get All season data available at Series Stats page
         """
-        pprint("Getting iRacing Seasons with Stats")
-        resp = self.__req(ct.URL_SEASON_STANDINGS2)
-        return self._load_irservice_var("SeasonListing", resp)
+        pprint("Getting iRacing Seasons with Stats", self.verbose)
+        return self.__fetch(ep.all_seasons(), cache)
 
     @logged_in
     def season_standings(self, season, carclass, club=ct.ALL, raceweek=ct.ALL,
                          division=ct.ALL, sort=ct.SORT_POINTS,
-                         order=ct.ORDER_DESC, page=1):
+                         order=ct.ORDER_DESC, page=1, rows=ct.ROWS_DICT,
+                         cache=ct.CACHE_USE):
         """ Search season standings using various fields. season, carclass 
             and club are ids.  Returns a tuple (results, total_results) so 
             if you want all results you should request different pages 
             (using page)  until you gather all total_results. Each page has
-            25 results max."""
-
-        lowerbound = ct.NUM_ENTRIES * (page - 1) + 1
-        upperbound = lowerbound + ct.NUM_ENTRIES - 1
-
-        data = {'sort': sort, 'order': order, 'seasonid': season,
-                'carclassid': carclass, 'clubid': club, 'raceweek': raceweek,
-                'division': division, 'start': lowerbound, 'end': upperbound}
-        r = self.__req(ct.URL_SEASON_STANDINGS, data=data)
-        res = parse(r)
-        total_results = res['d']['27']
-        results = res['d']['r']
-        header = res['m']
-        results = format_results(results, header)
+            25 results max. rows selects the format of the results (see
+            driver_search)."""
 
-        return results, total_results
+        return self.__fetch(ep.season_standings(
+            season, carclass, club, raceweek, division, sort, order, page,
+            rows), cache)
 
     @logged_in
     def hosted_results(self, session_host=None, session_name=None,
                        date_range=None, sort=ct .SORT_TIME,
-                       order=ct.ORDER_DESC, page=1):
+                       order=ct.ORDER_DESC, page=1, cache=ct.CACHE_USE):
         """ Search hosted races results using various fields. Returns a tuple
             (results, total_results) so if you want all results you should 
             request different pages (using page) until you gather all 
             total_results. Each page has 25 (ct.NUM_ENTRIES) results max."""
 
-        lowerbound = ct.NUM_ENTRIES * (page - 1) + 1
-        upperbound = lowerbound + ct.NUM_ENTRIES - 1
-
-        data = {'sort': sort, 'order': order, 'lowerbound': lowerbound,
-                'upperbound': upperbound}
-        if session_host is not None:
-            data['sessionhost'] = session_host
-        if session_name is not None:
-            data['sessionname'] = session_name
-
-        if date_range is not None:
-            # Date range
-            tc = lambda s:\
-                time.mktime(datetime.datetime.strptime(s, "%Y-%m-%d").
-                            timetuple()) * 1000
-            data['starttime_lowerbound'] = tc(date_range[0])
-            # multiplied by 1000
-            data['starttime_upperbound'] = tc(date_range[1])
-
-        r = self.__req(ct.URL_HOSTED_RESULTS, data=data)
-        # tofile(r)
-        res = parse(r)
-        total_results = res['rowcount']
-        results = res['rows']  # doesn't need format_results
-        return results, total_results
+        return self.__fetch(ep.hosted_results(
+            session_host, session_name, date_range, sort, order, page),
+            cache)
+
+    def __iter_pages(self, method, max_rows, kw):
+        """ Yields the rows of every page of a paginated method (the ones
+            returning (results, total_results)). Page N+1 is requested in
+            background while page N is consumed. Stops after max_rows rows
+            if set. """
+
+        if kw.get('rows') == ct.ROWS_COLUMNS:
+            raise ValueError("ct.ROWS_COLUMNS results can't be iterated")
+        from concurrent.futures import ThreadPoolExecutor  # lazy, slow import
+        executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            page, count = 1, 0
+            pending = executor.submit(method, page=page, **kw)
+            while pending is not None:
+                res = pending.result()
+                if res is None:  # Not logged in
+                    return
+                rows, total_results = res
+                limit = int(total_results)
+                if max_rows is not None:
+                    limit = min(limit, max_rows)
+                pending = None
+                if rows and page * ct.NUM_ENTRIES < limit:
+                    page += 1
+                    pending = executor.submit(method, page=page, **kw)
+                for row in rows:
+                    if max_rows is not None and count >= max_rows:
+                        return
+                    count += 1
+                    yield row
+        finally:
+            executor.shutdown(wait=False)
+
+    def iter_driver_search(self, max_rows=None, **kw):
+        """ Same as driver_search (same arguments but page) but yields the
+            drivers of all the pages. """
+        return self.__iter_pages(self.__driver_search_page, max_rows, kw)
+
+    def iter_results_archive(self, max_rows=None, **kw):
+        """ Same as results_archive (same arguments but page) but yields the
+            results of all the pages. """
+        return self.__iter_pages(self.results_archive, max_rows, kw)
+
+    def iter_season_standings(self, season, carclass, max_rows=None, **kw):
+        """ Same as season_standings (same arguments but page) but yields
+            the standings of all the pages. """
+        kw.update(season=season, carclass=carclass)
+        return self.__iter_pages(self.season_standings, max_rows, kw)
+
+    def iter_hosted_results(self, max_rows=None, **kw):
+        """ Same as hosted_results (same arguments but page) but yields the
+            results of all the pages. """
+        return self.__iter_pages(self.hosted_results, max_rows, kw)
+
+    def __bulk(self, method, custids, workers, kw):
+        """ Calls method for every custid using a pool of workers threads
+            (all of them share the client's rate limiter). Returns the
+            results in the same order as custids; if a call fails its
+            result is the exception raised, the rest of the batch goes on.
+        """
+
+        def call(custid):
+            try:
+                return method(custid, **kw)
+            except Exception as e:
+                pprint(("Error fetching data of custid", custid, e),
+                       self.verbose)
+                return e
+
+        from concurrent.futures import ThreadPoolExecutor  # lazy, slow import
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            return list(executor.map(call, custids))
+        finally:
+            executor.shutdown()
+
+    def bulk_career_stats(self, custids, workers=ct.BULK_WORKERS, **kw):
+        """ career_stats of every driver in custids, requested in parallel
+            by workers threads under the shared rate limit. Results keep
+            the order of custids; failed calls return their exception. """
+        return self.__bulk(self.career_stats, custids, workers, kw)
+
+    def bulk_yearly_stats(self, custids, workers=ct.BULK_WORKERS, **kw):
+        """ yearly_stats of every driver in custids (see bulk_career_stats)
+        """
+        return self.__bulk(self.yearly_stats, custids, workers, kw)
+
+    def bulk_cars_driven(self, custids, workers=ct.BULK_WORKERS, **kw):
+        """ cars_driven of every driver in custids (see bulk_career_stats)
+        """
+        return self.__bulk(self.cars_driven, custids, workers, kw)
+
+    def bulk_lastrace_stats(self, custids, workers=ct.BULK_WORKERS, **kw):
+        """ lastrace_stats of every driver in custids (see bulk_career_stats)
+        """
+        return self.__bulk(self.lastrace_stats, custids, workers, kw)
+
+    def bulk_iratingchart(self, custids, workers=ct.BULK_WORKERS, **kw):
+        """ iratingchart of every driver in custids (see bulk_career_stats)
+        """
+        return self.__bulk(self.iratingchart, custids, workers, kw)
 
     @logged_in
-    def session_times(self, series_season, start, end):
+    def session_times(self, series_season, start, end, cache=ct.CACHE_USE):
         """ Gets Current and future sessions (qualy, practice, race) 
             of series_season """
-        r = self.__req(ct.URL_SESSION_TIMES, data={'start': start, 'end': end,
-                       'season': series_season}, useget=True)
-        return parse(r)
+        return self.__fetch(ep.session_times(series_season, start, end),
+                            cache)
 
     @logged_in
-    def series_raceresults(self, season, raceweek):
-        """ Gets races results of all races of season in specified raceweek """
+    def series_raceresults(self, season, raceweek, rows=ct.ROWS_DICT,
+                           cache=ct.CACHE_USE):
+        """ Gets races results of all races of season in specified raceweek.
+            rows selects the format of the results (see driver_search). """
 
-        r = self.__req(ct.URL_SERIES_RACERESULTS, data={'seasonid': season,
-                       'raceweek': raceweek})  # TODO no bounds?
-        res = parse(r)
-        header = res['m']
-        results = res['d']
-        results = format_results(results, header)
-        return results
+        return self.__fetch(ep.series_raceresults(season, raceweek, rows),
+                            cache)
 
     @logged_in
-    def event_results(self, subsession, sessnum=0):
+    def event_results(self, subsession, sessnum=0, typed=False,
+                      cache=ct.CACHE_USE):
         """ Gets the event results (table of positions, times, etc.). The
-            event is identified by a subsession id. """
+            event is identified by a subsession id. With typed, numbers and
+            lap times are converted to int/float (seconds). """
 
-        r = self.__req(ct.URL_GET_EVENTRESULTS % (subsession, sessnum))\
-                .encode('utf8')
-        data = [x for x in csv.reader(StringIO(r), delimiter=',',
-                                      quotechar='"')]
-        header_ev, header_res = data[0], data[3]
-        event_info = dict(list(zip(header_ev, data[1])))
-        results = [dict(list(zip(header_res, x))) for x in data[4:]]
+        return self.__fetch(ep.event_results(subsession, sessnum, typed),
+                            cache)
 
-        return event_info, results
+    @logged_in
+    def iter_event_results(self, subsession, sessnum=0, typed=False):
+        """ Same as event_results but the results are parsed straight
+            from the response stream as they arrive. Returns (event_info,
+            results) where results is a generator of rows; consume it or
+            close it to release the connection. Not cached. """
+
+        call = ep.event_results(subsession, sessnum)
+        resp = self.__req(call.url, cookie=self.last_cookie, stream=True)
+        try:
+            resp.raw.decode_content = True  # gzip
+            f = codecs.getreader(resp.encoding or 'utf-8')(resp.raw)
+            event_info, results = ep.read_event_results(f, typed)
+        except Exception:
+            resp.close()
+            raise
+        return event_info, closing_iter(results, resp)
 
 if __name__ == '__main__':
     irw = iRWebStats()
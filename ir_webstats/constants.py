@@ -4,6 +4,57 @@ ALL = -1
 NUM_ENTRIES = 25  # Entries per page. This is the ammount set in iRacing site. We shouldn't increase it.
 WAIT_TIME = 0.3  # Minimum time in seconds between two consecutive requests to iRacing site (we don't want to flood/abuse the service). I'm not sure about the minimum value for this, I'll have to ask a dev.
 
+# HTTP connection pool (see pool.py)
+POOL_CONNECTIONS = 4  # Number of per-host pools kept (members.iracing.com over http and https)
+POOL_MAXSIZE = 10  # Max. open connections kept alive per host
+POOL_BLOCK = False  # If True, wait for a free connection instead of opening a throwaway one when the pool is full
+KEEP_ALIVE = True  # Reuse connections between requests
+REQUEST_TIMEOUT = (10, 60)  # seconds (connect, read). A hanging site raises a timeout, retried and counted by the circuit breaker
+
+# Rate limit (see ratelimit.py)
+RATE_LIMIT = 1 / WAIT_TIME  # Requests per second allowed on average
+RATE_BURST = 3  # Requests that can be sent back to back after being idle
+RATE_LIMIT_FILE = '/tmp/ir_webstats.ratelimit'  # State of FileTokenBucket, shared between processes
+ASYNC_MAX_CONCURRENCY = 4  # Max. requests in flight at the same time in AsyncIRWebStats
+BULK_WORKERS = 4  # Threads used by the bulk_* methods of iRWebStats
+
+# Retries and circuit breaker (see retry.py)
+RETRIES = 3  # Times a failed request (connection error, RETRY_STATUSES) is retried
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RETRY_BACKOFF = 0.5  # seconds. Base of the exponential backoff, the wait is random (full jitter)
+RETRY_MAX_BACKOFF = 30  # seconds
+RETRY_AFTER_MAX = 120  # seconds. Longest Retry-After honored
+BREAKER_THRESHOLD = 5  # Failed requests in a row (connection errors, 5xx) that open the circuit
+BREAKER_COOLDOWN = 30  # seconds. Time the circuit stays open before a trial request
+
+# Login sessions (see sessions.py)
+SESSION_FILE = '~/.ir_webstats.sessions'  # Sessions of every account, shared by the processes of the host
+
+# Multiple accounts (see accounts.py)
+ROUTE_LEAST_LOADED = 'least_loaded'  # Fewest requests in flight, then least recently used
+ROUTE_LRU = 'lru'  # Least recently used
+ACCOUNT_MAX_FAILURES = 3  # Failed requests in a row before an account is evicted from the pool
+ACCOUNT_RETRY_AFTER = 300  # seconds. An evicted account logs in again after this time
+
+# Service catalog: tracks, cars, etc. (see catalog.py)
+CATALOG_FILE = '~/.ir_webstats.catalog'  # Shared by the processes of the host, like SESSION_FILE
+CATALOG_MAX_AGE = 24 * 3600  # seconds. An older catalog is used but refreshed in background
+CATALOG_HARD_MAX_AGE = 7 * 24 * 3600  # seconds. An older catalog is refreshed before being used
+
+# Incremental results sync (see sync.py)
+SYNC_FILE = 'sync.json'  # Watermarks and checkpoints of the synced queries
+WAREHOUSE_FILE = 'results.db'  # Local results store (see warehouse.py)
+
+# Season standings crawl (see crawler.py)
+CRAWL_FILE = 'standings_crawl.db'  # Work queue and checkpoints
+CRAWL_MAX_ATTEMPTS = 3  # Times a page is tried before it's marked as failed
+
+# Request metrics (see metrics.py)
+METRICS_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)  # Histogram bucket upper bounds (ms)
+
+# JSON decoders used by util.parse, the first one installed is used
+JSON_BACKENDS = ('orjson', 'ujson', 'json')
+
 IRATING_OVAL_CHART = 1
 IRATING_ROAD_CHART = 2
 
@@ -61,10 +112,43 @@ URL_SERIES_RACERESULTS = 'http://members.iracing.com/memberstats/member/GetSerie
 URL_GET_EVENTRESULTS = 'http://members.iracing.com/membersite/member/GetEventResultsAsCSV?subsessionid=%s&simsesnum=%s&includeSummary=1' #simsesnum 0 race, -1 qualy or practice, -2 practice
 
 
+# Response cache (see cache.py)
+CACHE_FILE = 'ir_webstats_cache.sqlite'
+CACHE_MAX_SIZE = 256 * 1024 * 1024  # bytes
+CACHE_FOREVER = None  # TTL of responses that never change
+CACHE_TTL_DEFAULT = 0  # Endpoints not listed in CACHE_TTL aren't cached
+CACHE_TTL = {  # seconds
+    URL_STATS_CHART: 6 * 3600,
+    URL_DRIVER_COUNTS: 5,
+    URL_CAREER_STATS: 6 * 3600,
+    URL_YEARLY_STATS: 6 * 3600,
+    URL_CARS_DRIVEN: 6 * 3600,
+    URL_PERSONAL_BEST: 6 * 3600,
+    URL_DRIVER_STATUS: 60,
+    URL_DRIVER_STATS: 3600,
+    URL_LASTRACE_STATS: 600,
+    URL_RESULTS_ARCHIVE: 600,
+    URL_SEASON_STANDINGS: 3600,
+    URL_SEASON_STANDINGS2: 24 * 3600,
+    URL_HOSTED_RESULTS: 600,
+    URL_SESSION_TIMES: 300,
+    URL_SERIES_RACERESULTS: 600,
+    URL_GET_EVENTRESULTS: CACHE_FOREVER,  # Results of a finished subsession
+}
+# Cache modes (cache argument of the client methods)
+CACHE_USE = 'use'  # Return cached response if fresh, store new ones
+CACHE_REFRESH = 'refresh'  # Always request, store the new response
+CACHE_BYPASS = 'bypass'  # Don't read nor write the cache
+
+# Row formats of paginated results (rows argument)
+ROWS_DICT = 'dict'  # A dict per row
+ROWS_TUPLE = 'tuple'  # A namedtuple per row, fields named after the columns
+ROWS_COLUMNS = 'columns'  # A dict column -> list of values
+
 
 HEADERS = { 'User-Agent' : 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.17 (KHTML, like Gecko) Chrome/24.0.1312.52 Safari/537.17'
         , 'Referer': 'https://members.iracing.com/membersite/login.jsp', 'Connection': 'keep-alive',
-        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8','Accept-Charset': 'ISO-8859-1,utf-8;q=0.7,*;q=0.3','Cache-Control': 'max-age=0', 'Host': 'members.iracing.com','Accept-Encoding': 'gzip,deflate,sdch', 'Origin': 'members.iracing.com', 'Accept-Language': 'en-US,en;q=0.8'}
+        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8','Accept-Charset': 'ISO-8859-1,utf-8;q=0.7,*;q=0.3','Cache-Control': 'max-age=0', 'Host': 'members.iracing.com','Accept-Encoding': 'gzip, deflate', 'Origin': 'members.iracing.com', 'Accept-Language': 'en-US,en;q=0.8'}
 
 
 
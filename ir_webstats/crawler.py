@@ -0,0 +1,243 @@
+#!/usr/bin/python
+""" Resumable crawl of the standings of whole seasons. Every season x car
+    class (x club x division) page is a task of a persistent work queue
+    (SQLite) ordered by priority, pages are requested in parallel and
+    checkpointed one by one as soon as they're handed to the sink, so an
+    interrupted crawl goes on where it stopped. """
+
+import json
+import sqlite3
+import threading
+import time
+
+from ir_webstats import constants as ct
+from ir_webstats.util import CircuitOpenError, pprint
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS tasks (seasonid INTEGER, carclass INTEGER, "
+    "club INTEGER, division INTEGER, raceweek INTEGER, page INTEGER, "
+    "priority REAL, state TEXT, attempts INTEGER DEFAULT 0, error TEXT, "
+    "PRIMARY KEY (seasonid, carclass, club, division, raceweek, page))",
+    "CREATE INDEX IF NOT EXISTS tasks_next ON tasks (state, priority, "
+    "page)",
+)
+KEY = ('seasonid', 'carclass', 'club', 'division', 'raceweek', 'page')
+
+PENDING, RUNNING, DONE, FAILED = 'pending', 'running', 'done', 'failed'
+
+
+def season_classes(season):
+    """ Car class ids of an all_seasons() season """
+    return [c['id'] for c in season.get('carclasses') or []]
+
+
+class JSONLSink(object):
+
+    """ Sink that appends every row to the file path as a JSON line, with
+        the task fields (seasonid, carclass, etc., see StandingsCrawler)
+        added. A page in progress when the crawl was interrupted is
+        written again on resume, dedupe by task fields + custid. """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, 'a')
+
+    def __call__(self, task, rows):
+        lines = ''.join(json.dumps(dict(row, **task)) + '\n' for row in rows)
+        with self._lock:
+            self._file.write(lines)
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class StandingsCrawler(object):
+
+    """ Crawls season_standings with client (an iRWebStats, logged in)
+        keeping the work queue in path. Add the seasons to crawl with
+        add_seasons and call run(sink): workers threads (sharing the
+        client's rate limiter) take the pending pages with the highest
+        priority, first page of every standings first, the rest are queued
+        once its total is known. sink(task, rows) gets the rows of every
+        page, task being a dict with seasonid, carclass, club, division,
+        raceweek and page. One process should run a queue at a time. """
+
+    def __init__(self, client, path=ct.CRAWL_FILE, workers=ct.BULK_WORKERS,
+                 max_attempts=ct.CRAWL_MAX_ATTEMPTS, verbose=False):
+        self.client = client
+        self.path = path
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.verbose = verbose
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._running = 0
+        self._db = sqlite3.connect(path, check_same_thread=False,
+                                   timeout=30)
+        for sql in SCHEMA:
+            self._db.execute(sql)
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+    def add_seasons(self, seasons, clubs=(ct.ALL,), divisions=(ct.ALL,),
+                    raceweek=ct.ALL, classes=season_classes, priority=None):
+        """ Queues the standings of seasons (all_seasons() output, or
+            seasonids with classes giving their car class ids) for every
+            club and division. priority(season) sets the order (higher
+            first), by default newer seasons (higher seasonid) first.
+            Standings already queued are kept as they are. Returns the
+            number of standings added. """
+
+        tasks = []
+        for season in seasons:
+            seasonid = season['seasonid'] if isinstance(season, dict) \
+                else season
+            prio = seasonid if priority is None else priority(season)
+            for carclass in classes(season):
+                for club in clubs:
+                    for division in divisions:
+                        tasks.append((seasonid, carclass, club, division,
+                                      raceweek, 1, prio, PENDING))
+        with self._lock:
+            before = self._db.total_changes
+            self._db.executemany("INSERT OR IGNORE INTO tasks (%s, "
+                                 "priority, state) VALUES (?, ?, ?, ?, ?, "
+                                 "?, ?, ?)" % ', '.join(KEY), tasks)
+            self._db.commit()
+            return self._db.total_changes - before
+
+    def stats(self):
+        """ Number of pages per state (pending, running, done, failed) """
+        with self._lock:
+            counts = dict(self._db.execute(
+                "SELECT state, COUNT(*) FROM tasks GROUP BY state"))
+        return dict((s, counts.get(s, 0))
+                    for s in (PENDING, RUNNING, DONE, FAILED))
+
+    def failed(self):
+        """ Failed pages, with their last error """
+        with self._lock:
+            cur = self._db.execute("SELECT %s, attempts, error FROM tasks "
+                                   "WHERE state = ?" % ', '.join(KEY),
+                                   (FAILED,))
+            return [dict(zip(KEY + ('attempts', 'error'), r)) for r in cur]
+
+    def retry_failed(self):
+        """ Queues the failed pages again """
+        with self._lock:
+            self._db.execute("UPDATE tasks SET state = ?, attempts = 0 "
+                             "WHERE state = ?", (PENDING, FAILED))
+            self._db.commit()
+
+    def stop(self):
+        """ Makes run return after the pages in progress """
+        self._stop.set()
+
+    def __claim(self):
+        """ Next pending page (marked as running) or None """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT %s FROM tasks WHERE state = ? ORDER BY priority DESC,"
+                " page LIMIT 1" % ', '.join(KEY), (PENDING,)).fetchone()
+            if row is None:
+                return None
+            self._db.execute("UPDATE tasks SET state = ? WHERE %s" %
+                             ' AND '.join('%s = ?' % k for k in KEY),
+                             (RUNNING,) + tuple(row))
+            self._db.commit()
+            self._running += 1
+            return dict(zip(KEY, row))
+
+    def __finish(self, task, state, error=None, pages=0, attempt=1):
+        """ Checkpoints a page and, for first pages, queues the rest of the
+            pages (up to pages) """
+        where = ' AND '.join('%s = ?' % k for k in KEY)
+        key = tuple(task[k] for k in KEY)
+        with self._lock:
+            self._db.execute("UPDATE tasks SET state = ?, error = ?, "
+                             "attempts = attempts + ? WHERE %s" % where,
+                             (state, error, attempt) + key)
+            if pages > 1:
+                self._db.executemany(
+                    "INSERT OR IGNORE INTO tasks (%s, priority, state) "
+                    "SELECT %s, ?, priority, ? FROM tasks WHERE %s" %
+                    (', '.join(KEY), ', '.join(KEY[:-1]), where),
+                    [(page, PENDING) + key for page in range(2, pages + 1)])
+            self._db.commit()
+            self._running -= 1
+
+    def __attempts(self, task):
+        with self._lock:
+            return self._db.execute(
+                "SELECT attempts FROM tasks WHERE %s" %
+                ' AND '.join('%s = ?' % k for k in KEY),
+                tuple(task[k] for k in KEY)).fetchone()[0]
+
+    def __crawl(self, task, sink):
+        """ Requests a page and hands it to the sink """
+        res = self.client.season_standings(
+            task['seasonid'], task['carclass'], task['club'],
+            task['raceweek'], task['division'], page=task['page'])
+        if res is None:
+            raise RuntimeError("season_standings failed, is the client "
+                               "logged in?")
+        rows, total_results = res
+        if rows:
+            sink(dict(task), rows)
+        pages = 0
+        if task['page'] == 1:
+            pages = -(-int(total_results) // ct.NUM_ENTRIES)  # Ceil
+        return pages
+
+    def __work(self, sink):
+        while not self._stop.is_set():
+            task = self.__claim()
+            if task is None:
+                with self._lock:
+                    if not self._running:
+                        return  # Nothing left and nobody can queue more
+                time.sleep(0.05)  # Others may queue pages, wait for them
+                continue
+            try:
+                pages = self.__crawl(task, sink)
+            except CircuitOpenError as e:
+                # The site is failing, not this page: wait, don't count it
+                self.__finish(task, PENDING, str(e), attempt=0)
+                time.sleep(max(e.retry_in, 0.5))  # 0 while a trial is sent
+                continue
+            except Exception as e:
+                error = "%s: %s" % (e.__class__.__name__, e)
+                pprint(("Standings page failed", task, error), self.verbose)
+                state = FAILED if self.__attempts(task) + 1 >= \
+                    self.max_attempts else PENDING
+                self.__finish(task, state, error)
+                continue
+            self.__finish(task, DONE, pages=pages)
+
+    def run(self, sink, workers=None):
+        """ Crawls the pending pages (and the ones of an interrupted run)
+            handing their rows to sink, until there are none left or stop()
+            is called. A page that fails max_attempts times is marked as
+            failed and the crawl goes on (see failed and retry_failed).
+            A page whose sink call completed but wasn't checkpointed (the
+            process died in between) is crawled again on resume, so sink
+            should be idempotent. Returns stats(). """
+
+        self._stop.clear()
+        with self._lock:  # Left running by an interrupted run
+            self._db.execute("UPDATE tasks SET state = ? WHERE state = ?",
+                             (PENDING, RUNNING))
+            self._db.commit()
+        workers = self.workers if workers is None else workers
+        threads = [threading.Thread(target=self.__work, args=(sink,))
+                   for _ in range(workers)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+        return self.stats()
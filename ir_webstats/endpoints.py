@@ -0,0 +1,334 @@
+#!/usr/bin/python
+""" Request construction (URL, parameters) and response parsing of every
+    iRacing stats request. Shared by iRWebStats and AsyncIRWebStats so both
+    clients send exactly the same requests. Each function returns a Call
+    that the clients send and then parse with call.parse(response). """
+
+import csv
+import datetime
+import time
+from collections import namedtuple
+from functools import partial
+from io import StringIO
+
+try:
+    from urllib.parse import urlencode as encode  # python3
+except ImportError:
+    from urllib import urlencode as encode  # python2
+
+from ir_webstats import constants as ct
+from ir_webstats.util import parse, format_results, load_irservice_var, \
+    typed_rows, ParseError
+
+# name: client method name, endpoint: URL constant (unformatted), url: final
+# URL, data: POST data or GET params (None for a plain GET), useget: send
+# data as GET params, parse: callable applied to the response, raw: the
+# response is passed to parse as bytes (JSON) instead of text, final:
+# callable telling if a parsed response won't change anymore, required to
+# cache it forever (ct.CACHE_FOREVER), None if it's always final.
+Call = namedtuple('Call', 'name endpoint url data useget parse raw final')
+
+
+def _call(name, endpoint, url=None, data=None, useget=False, parse=parse,
+          raw=True, final=None):
+    return Call(name, endpoint, endpoint if url is None else url, data,
+                useget, parse, raw, final)
+
+
+def _date_ms(s):
+    """ 'YYYY-MM-DD' to a timestamp in milliseconds (as used by iRacing) """
+    return time.mktime(datetime.datetime.strptime(s, "%Y-%m-%d").
+                       timetuple()) * 1000
+
+
+def _first(r):
+    return parse(r)[0]
+
+
+def login_data(username, password):
+    return {"username": username, "password": password, 'utcoffset': 300,
+            'todaysdate': ''}
+
+
+def parse_custid(r):
+    """ Gets the custid of the logged user from the login response """
+    ind = r.index('js_custid')
+    return int(r[ind + 11: r.index(';', ind)])
+
+
+def iratingchart(custid, category=ct.IRATING_ROAD_CHART):
+    return _call('iratingchart', ct.URL_STATS_CHART,
+                 ct.URL_STATS_CHART % (custid, category))
+
+
+def driver_counts():
+    return _call('driver_counts', ct.URL_DRIVER_COUNTS)
+
+
+def career_stats(custid):
+    return _call('career_stats', ct.URL_CAREER_STATS,
+                 ct.URL_CAREER_STATS % (custid), parse=_first)
+
+
+def yearly_stats(custid):
+    return _call('yearly_stats', ct.URL_YEARLY_STATS,
+                 ct.URL_YEARLY_STATS % (custid))
+
+
+def cars_driven(custid):
+    return _call('cars_driven', ct.URL_CARS_DRIVEN,
+                 ct.URL_CARS_DRIVEN % (custid))
+
+
+def personal_best(custid, carid=0):
+    return _call('personal_best', ct.URL_PERSONAL_BEST,
+                 ct.URL_PERSONAL_BEST % (carid, custid))
+
+
+def driverdata(drivername):
+    return _call('driverdata', ct.URL_DRIVER_STATUS,
+                 ct.URL_DRIVER_STATUS % (encode({'searchTerms': drivername})))
+
+
+def lastrace_stats(custid):
+    return _call('lastrace_stats', ct.URL_LASTRACE_STATS,
+                 ct.URL_LASTRACE_STATS % (custid))
+
+
+def _parse_driver_search(mycustid, rows, r):
+    res = parse(r)
+    total_results = res['d']['32']
+    header = res['m']
+    f = res['d']['r'][0]
+    if int(f['29']) == int(mycustid):  # 29 is custid
+        drivers = res['d']['r'][1:]
+    else:
+        drivers = res['d']['r']
+    return format_results(drivers, header, rows), total_results
+
+
+def driver_search(mycustid, race_type=ct.RACE_TYPE_ROAD, location=ct.LOC_ALL,
+                  license=(ct.LIC_ROOKIE, ct.ALL), irating=(0, ct.ALL),
+                  ttrating=(0, ct.ALL), avg_start=(0, ct.ALL),
+                  avg_finish=(0, ct.ALL), avg_points=(0, ct.ALL),
+                  avg_incs=(0, ct.ALL), active=False, sort=ct.SORT_IRATING,
+                  page=1, order=ct.ORDER_DESC, rows=ct.ROWS_DICT):
+    """ mycustid is the custid of the logged user. iRacing returns it as
+        the first row so it's removed from the results. """
+
+    lowerbound = ct.NUM_ENTRIES * (page - 1) + 1
+    upperbound = lowerbound + ct.NUM_ENTRIES - 1
+    search = 'null'
+    friend = ct.ALL  # TODO
+    studied = ct.ALL  # TODO
+    recent = ct.ALL  # TODO
+
+    active = int(active)
+    # Data to POST
+    data = {'custid': mycustid, 'search': search, 'friend': friend,
+            'watched': studied, 'country': location, 'recent': recent,
+            'category': race_type, 'classlow': license[0],
+            'classhigh': license[1], 'iratinglow': irating[0],
+            'iratinghigh': irating[1], 'ttratinglow': ttrating[0],
+            'ttratinghigh': ttrating[1], 'avgstartlow': avg_start[0],
+            'avgstarthigh': avg_start[1], 'avgfinishlow': avg_finish[0],
+            'avgfinishhigh': avg_finish[1], 'avgpointslow': avg_points[0],
+            'avgpointshigh': avg_points[1], 'avgincidentslow': avg_incs[0],
+            'avgincidentshigh': avg_incs[1], 'lowerbound': lowerbound,
+            'upperbound': upperbound, 'sort': sort, 'order': order,
+            'active': active}
+    return _call('driver_search', ct.URL_DRIVER_STATS, data=data,
+                 parse=partial(_parse_driver_search, mycustid, rows))
+
+
+def _parse_results_archive(rows, r):
+    res = parse(r)
+    total_results, results = 0, format_results([], {}, rows)
+    if len(res['d']):
+        total_results = res['d']['46']
+        results = res['d']['r']
+        header = res['m']
+        results = format_results(results, header, rows)
+    return results, total_results
+
+
+def results_archive(custid, race_type=ct.RACE_TYPE_ROAD, event_types=ct.ALL,
+                    official=ct.ALL, license_level=ct.ALL, car=ct.ALL,
+                    track=ct.ALL, series=ct.ALL, season=(2014, 1, ct.ALL),
+                    date_range=ct.ALL, page=1, sort=ct.SORT_TIME,
+                    order=ct.ORDER_DESC, rows=ct.ROWS_DICT):
+    format_ = 'json'
+    lowerbound = ct.NUM_ENTRIES * (page - 1) + 1
+    upperbound = lowerbound + ct.NUM_ENTRIES - 1
+    #  TODO carclassid, seriesid in constants
+    data = {'format': format_, 'custid': custid, 'seriesid': series,
+            'carid': car, 'trackid': track, 'lowerbound': lowerbound,
+            'upperbound': upperbound, 'sort': sort, 'order': order,
+            'category': race_type, 'showtts': 0, 'showraces': 0,
+            'showquals': 0, 'showops': 0, 'showofficial': 0,
+            'showunofficial': 0, 'showrookie': 0, 'showclassa': 0,
+            'showclassb': 0, 'showclassc': 0, 'showclassd': 0,
+            'showpro': 0, 'showprowc': 0, }
+    # Events
+    ev_vars = {ct.EVENT_RACE: 'showraces', ct.EVENT_QUALY: 'showquals',
+               ct.EVENT_PRACTICE: 'showops', ct.EVENT_TTRIAL: 'showtts'}
+    if event_types == ct.ALL:
+        event_types = (ct.EVENT_RACE, ct.EVENT_QUALY, ct.EVENT_PRACTICE,
+                       ct.EVENT_TTRIAL)
+
+    for v in event_types:
+        data[ev_vars[v]] = 1
+    # Official, unofficial
+    if official == ct.ALL:
+        data['showofficial'] = 1
+        data['showunoofficial'] = 1
+    else:
+        if ct.EVENT_UNOFFICIAL in official:
+            data['showunofficial'] = 1
+        if ct.EVENT_OFFICIAL in official:
+            data['showofficial'] = 1
+
+    # Season
+    if date_range == ct.ALL:
+        data['seasonyear'] = season[0]
+        data['seasonquarter'] = season[1]
+        if season[2] != ct.ALL:
+            data['raceweek'] = season[2]
+    else:
+        # Date range
+        data['starttime_low'] = _date_ms(date_range[0])  # multiplied by 1000
+        data['starttime_high'] = _date_ms(date_range[1])
+
+    # License levels
+    lic_vars = {ct.LIC_ROOKIE: 'showrookie', ct.LIC_A: 'showclassa',
+                ct.LIC_B: 'showclassb', ct.LIC_C: 'showclassc',
+                ct.LIC_D: 'showclassd', ct.LIC_PRO: 'showpro',
+                ct.LIC_PRO_WC: 'showprowc'}
+
+    if license_level == ct.ALL:
+        license_level = (ct.LIC_ROOKIE, ct.LIC_A, ct.LIC_B, ct.LIC_C,
+                         ct.LIC_D, ct.LIC_PRO, ct.LIC_PRO_WC)
+    for v in license_level:
+        data[lic_vars[v]] = 1
+    return _call('results_archive', ct.URL_RESULTS_ARCHIVE, data=data,
+                 parse=partial(_parse_results_archive, rows))
+
+
+def all_seasons():
+    return _call('all_seasons', ct.URL_SEASON_STANDINGS2,
+                 parse=partial(load_irservice_var, "SeasonListing"),
+                 raw=False)
+
+
+def _parse_season_standings(rows, r):
+    res = parse(r)
+    total_results = res['d']['27']
+    results = res['d']['r']
+    header = res['m']
+    return format_results(results, header, rows), total_results
+
+
+def season_standings(season, carclass, club=ct.ALL, raceweek=ct.ALL,
+                     division=ct.ALL, sort=ct.SORT_POINTS, order=ct.ORDER_DESC,
+                     page=1, rows=ct.ROWS_DICT):
+    lowerbound = ct.NUM_ENTRIES * (page - 1) + 1
+    upperbound = lowerbound + ct.NUM_ENTRIES - 1
+
+    data = {'sort': sort, 'order': order, 'seasonid': season,
+            'carclassid': carclass, 'clubid': club, 'raceweek': raceweek,
+            'division': division, 'start': lowerbound, 'end': upperbound}
+    return _call('season_standings', ct.URL_SEASON_STANDINGS, data=data,
+                 parse=partial(_parse_season_standings, rows))
+
+
+def _parse_hosted_results(r):
+    res = parse(r)
+    total_results = res['rowcount']
+    results = res['rows']  # doesn't need format_results
+    return results, total_results
+
+
+def hosted_results(session_host=None, session_name=None, date_range=None,
+                   sort=ct.SORT_TIME, order=ct.ORDER_DESC, page=1):
+    lowerbound = ct.NUM_ENTRIES * (page - 1) + 1
+    upperbound = lowerbound + ct.NUM_ENTRIES - 1
+
+    data = {'sort': sort, 'order': order, 'lowerbound': lowerbound,
+            'upperbound': upperbound}
+    if session_host is not None:
+        data['sessionhost'] = session_host
+    if session_name is not None:
+        data['sessionname'] = session_name
+
+    if date_range is not None:
+        # Date range
+        data['starttime_lowerbound'] = _date_ms(date_range[0])
+        # multiplied by 1000
+        data['starttime_upperbound'] = _date_ms(date_range[1])
+    return _call('hosted_results', ct.URL_HOSTED_RESULTS, data=data,
+                 parse=_parse_hosted_results)
+
+
+def session_times(series_season, start, end):
+    return _call('session_times', ct.URL_SESSION_TIMES,
+                 data={'start': start, 'end': end, 'season': series_season},
+                 useget=True)
+
+
+def _parse_series_raceresults(rows, r):
+    res = parse(r)
+    header = res['m']
+    results = res['d']
+    return format_results(results, header, rows)
+
+
+def series_raceresults(season, raceweek, rows=ct.ROWS_DICT):
+    # TODO no bounds?
+    return _call('series_raceresults', ct.URL_SERIES_RACERESULTS,
+                 data={'seasonid': season, 'raceweek': raceweek},
+                 parse=partial(_parse_series_raceresults, rows))
+
+
+def _id_columns(header):
+    """ Indexes of the id and car number columns (kept as strings) """
+    return frozenset(i for i, name in enumerate(header)
+                     if name.endswith(' ID') or name == 'Car #')
+
+
+def read_event_results(f, typed=False):
+    """ Parses the event results CSV incrementally from f (a text file or
+        any iterable of lines). Returns (event_info, results) where results
+        is a generator of result rows (dicts). With typed, numeric and lap
+        time values are converted (see util.typed_rows), except ids and car
+        numbers. Raises ParseError if the CSV is incomplete. """
+
+    reader = csv.reader(f, delimiter=',', quotechar='"')
+    try:
+        header_ev, values_ev = next(reader), next(reader)
+        next(reader)  # Blank line between event info and results
+        header_res = next(reader)
+    except StopIteration:
+        raise ParseError("Incomplete event results CSV")
+    if typed:
+        values_ev = next(typed_rows([values_ev], _id_columns(header_ev)))
+        reader = typed_rows(reader, _id_columns(header_res))
+    event_info = dict(list(zip(header_ev, values_ev)))
+    results = (dict(list(zip(header_res, x))) for x in reader)
+    return event_info, results
+
+
+def _parse_event_results(typed, r):
+    event_info, results = read_event_results(StringIO(r), typed)
+    return event_info, list(results)
+
+
+def _event_finished(res):
+    """ A subsession has results once it's finished """
+    return len(res[1]) > 0
+
+
+def event_results(subsession, sessnum=0, typed=False):
+    return _call('event_results', ct.URL_GET_EVENTRESULTS,
+                 ct.URL_GET_EVENTRESULTS % (subsession, sessnum),
+                 parse=partial(_parse_event_results, typed), raw=False,
+                 final=_event_finished)
@@ -0,0 +1,208 @@
+#!/usr/bin/python
+""" Request instrumentation. An observer passed to the client (i.e
+    iRWebStats(observer=MetricsAggregator())) gets a record per request
+    with the time spent in each phase (rate limiter, connection, server,
+    download, parsing), so a slow crawl can be blamed on the throttle, the
+    site or the client itself. """
+
+import threading
+import time
+from bisect import bisect_left
+
+from ir_webstats import constants as ct
+
+try:
+    now = time.perf_counter  # python3
+except AttributeError:
+    now = time.time  # python2
+
+# Timed phases of a request, in seconds
+PHASES = ('wait', 'connect', 'ttfb', 'download', 'parse', 'format', 'total')
+
+_local = threading.local()
+
+
+class Observer(object):
+
+    """ Interface of the request observers. on_request is called by the
+        client after every request, from the thread that sent it, with a
+        record (dict):
+            method: client method, or the last part of the URL for requests
+                not sent by a stats method (login, cookie check, etc.)
+            endpoint: URL constant of the stats method, None otherwise
+            status: HTTP status, None on cache hits
+            bytes: size of the (decompressed) response body
+            wire_bytes: size of the body as transferred (compressed), 0 on
+                cache hits and 304 answers, None if unknown
+            cache: 'hit', 'miss' (requested and stored), 'revalidated'
+                (expired but the server answered 304 Not Modified),
+                'coalesced' (got the response of the same request sent by
+                another thread at the time, see singleflight.py) or 'bypass'
+            error: name of the exception raised, None if it succeeded
+            retries: times the request was retried (see retry.py)
+            wait: time waiting for the rate limiter
+            connect: time opening a new connection, 0 if a pooled one was
+                reused. None if it can't be measured (sessions not created
+                by pool.make_session, AsyncIRWebStats); ttfb includes it
+            ttfb: from sending the request to receiving the headers
+            download: reading and decoding the body
+            parse: parsing the response, not counting format_results
+            format: time spent in util.format_results
+            total: whole call, including all of the above
+        Exceptions raised by an observer are logged and ignored. """
+
+    def on_request(self, record):
+        pass
+
+
+def new_record(method, endpoint=None):
+    """ Returns a record (see Observer) to be filled in by the client """
+    record = dict.fromkeys(PHASES, 0.0)
+    record.update(method=method, endpoint=endpoint, status=None, bytes=0,
+                  wire_bytes=0, cache='bypass', error=None, retries=0,
+                  start=now())
+    return record
+
+
+def finish(record):
+    """ Completes the record before passing it to the observer """
+    record['total'] = now() - record.pop('start')
+    # format_results runs inside the parsing, its time was counted twice
+    record['parse'] = max(record['parse'] - record['format'], 0.0)
+    return record
+
+
+def active():
+    """ Record of the request being parsed in this thread, if any """
+    return getattr(_local, 'record', None)
+
+
+class measure(object):
+
+    """ Context manager that adds the time spent in the block to
+        record[phase]. While it runs, record is the active record of the
+        thread so nested code (util.format_results) can time its part. """
+
+    def __init__(self, record, phase):
+        self.record = record
+        self.phase = phase
+
+    def __enter__(self):
+        self.previous = active()
+        _local.record = self.record
+        self.start = now()
+        return self.record
+
+    def __exit__(self, *exc):
+        self.record[self.phase] += now() - self.start
+        _local.record = self.previous
+
+
+def _percentile(hist, bounds, p):
+    """ Estimates the p percentile (ms) of a histogram as the upper bound of
+        the bucket where it falls (the max. for the overflow bucket) """
+    if not hist['count']:
+        return 0.0
+    rank = p / 100.0 * hist['count']
+    seen = 0
+    for i, n in enumerate(hist['buckets']):
+        seen += n
+        if seen >= rank and n:
+            return min(bounds[i], hist['max']) if i < len(bounds) else \
+                hist['max']
+    return hist['max']
+
+
+class MetricsAggregator(Observer):
+
+    """ Observer that aggregates the records in process, per method: number
+        of requests, errors, retries, bytes (and as transferred,
+        wire_bytes), status codes, cache hits/misses/revalidations and a
+        histogram per phase (bucket upper bounds in ms, see
+        ct.METRICS_BUCKETS). Thread safe, it can be shared by several
+        clients. """
+
+    def __init__(self, buckets=ct.METRICS_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._methods = {}
+
+    def _new_method(self):
+        n = len(self.buckets) + 1  # last one is the overflow bucket
+        return {'requests': 0, 'errors': 0, 'retries': 0, 'bytes': 0,
+                'wire_bytes': 0,
+                'status': {}, 'cache': {}, 'phases': dict(
+                    (p, {'count': 0, 'sum': 0.0, 'max': 0.0,
+                         'buckets': [0] * n}) for p in PHASES)}
+
+    def on_request(self, record):
+        with self._lock:
+            m = self._methods.get(record['method'])
+            if m is None:
+                m = self._methods[record['method']] = self._new_method()
+            m['requests'] += 1
+            m['bytes'] += record['bytes'] or 0
+            # Unknown wire size: assume it was transferred uncompressed
+            m['wire_bytes'] += record['bytes'] if record['wire_bytes'] is \
+                None else record['wire_bytes']
+            if record['error'] is not None:
+                m['errors'] += 1
+            m['retries'] += record.get('retries', 0)
+            status = str(record['status'])
+            m['status'][status] = m['status'].get(status, 0) + 1
+            m['cache'][record['cache']] = \
+                m['cache'].get(record['cache'], 0) + 1
+            for phase in PHASES:
+                if record[phase] is None:
+                    continue
+                ms = record[phase] * 1000
+                h = m['phases'][phase]
+                h['count'] += 1
+                h['sum'] += ms
+                h['max'] = max(h['max'], ms)
+                h['buckets'][bisect_left(self.buckets, ms)] += 1
+
+    def dump(self):
+        """ Returns the aggregated metrics as a dict method -> stats (JSON
+            serializable). Every phase has its histogram and the mean, p50,
+            p99 and max in ms. """
+        with self._lock:
+            out = {}
+            for method, m in self._methods.items():
+                phases = {}
+                for phase, h in m['phases'].items():
+                    phases[phase] = {
+                        'count': h['count'], 'max': h['max'],
+                        'mean': h['sum'] / h['count'] if h['count'] else 0.0,
+                        'p50': _percentile(h, self.buckets, 50),
+                        'p99': _percentile(h, self.buckets, 99),
+                        'buckets': list(h['buckets'])}
+                out[method] = {'requests': m['requests'],
+                               'errors': m['errors'],
+                               'retries': m['retries'], 'bytes': m['bytes'],
+                               'wire_bytes': m['wire_bytes'],
+                               'status': dict(m['status']),
+                               'cache': dict(m['cache']), 'phases': phases}
+            out_buckets = list(self.buckets)
+        return {'buckets_ms': out_buckets, 'methods': out}
+
+    def report(self):
+        """ Text table with the mean time (ms) of each phase per method """
+        methods = self.dump()['methods']
+        lines = ['%-22s %6s %9s %9s %5s %5s' % ('method', 'reqs', 'KB',
+                                               'wire KB', 'hits', '304') +
+                 ''.join('%9s' % p for p in PHASES) + '%9s' % 'p99']
+        for name in sorted(methods):
+            m = methods[name]
+            ph = m['phases']
+            lines.append('%-22s %6d %9.1f %9.1f %5d %5d' % (
+                name[:22], m['requests'], m['bytes'] / 1024.0,
+                m['wire_bytes'] / 1024.0, m['cache'].get('hit', 0),
+                m['cache'].get('revalidated', 0)) +
+                ''.join('%9.2f' % ph[p]['mean'] for p in PHASES) +
+                '%9.2f' % ph['total']['p99'])
+        return '\n'.join(lines)
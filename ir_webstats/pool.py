@@ -0,0 +1,123 @@
+#!/usr/bin/python
+""" Persistent HTTP connection pool used by iRWebStats. Reusing connections
+    avoids paying a new TCP/TLS handshake on every request to iRacing
+    site. requests is only imported when the first session is created. """
+
+import threading
+
+from ir_webstats import constants as ct
+from ir_webstats.metrics import now
+
+_shared = None
+_shared_lock = threading.Lock()
+_adapter = None
+_connect = threading.local()
+
+
+def connect_time():
+    """ Returns and clears the time (seconds) the last request sent from
+        this thread spent opening a new connection, 0.0 if it reused one
+        from the pool. Only measured by sessions created with make_session.
+    """
+    t = getattr(_connect, 'time', 0.0)
+    _connect.time = 0.0
+    return t
+
+
+def measures_connect(session, url):
+    """ True if session times its connections (see connect_time) """
+    return _adapter is not None and isinstance(session.get_adapter(url),
+                                                _adapter)
+
+
+def wire_bytes(resp):
+    """ Size of the body of a (read) response as it was transferred, i.e
+        compressed. None if it can't be known. """
+    try:
+        return resp.raw.tell()
+    except Exception:
+        return None
+
+
+def _timed_pool(base):
+    """ Subclass of a urllib3 connection pool whose connections record how
+        long they take to connect (TCP and TLS handshakes) """
+
+    class TimedConnection(base.ConnectionCls):
+        def connect(self):
+            t = now()
+            try:
+                return base.ConnectionCls.connect(self)
+            finally:
+                _connect.time = now() - t
+
+    return type(base.__name__, (base,), {'ConnectionCls': TimedConnection})
+
+
+def _adapter_class():
+    """ HTTPAdapter using _timed_pool pools, created on first use """
+    global _adapter
+    if _adapter is None:
+        from requests.adapters import HTTPAdapter
+        from requests.packages.urllib3 import connectionpool
+        pools = {'http': _timed_pool(connectionpool.HTTPConnectionPool),
+                 'https': _timed_pool(connectionpool.HTTPSConnectionPool)}
+
+        class TimedAdapter(HTTPAdapter):
+            def init_poolmanager(self, *args, **kw):
+                HTTPAdapter.init_poolmanager(self, *args, **kw)
+                self.poolmanager.pool_classes_by_scheme = pools
+
+        _adapter = TimedAdapter
+    return _adapter
+
+
+def make_session(pool_connections=ct.POOL_CONNECTIONS,
+                 pool_maxsize=ct.POOL_MAXSIZE, pool_block=ct.POOL_BLOCK,
+                 keep_alive=ct.KEEP_ALIVE):
+    """ Creates a requests Session backed by a connection pool.
+        pool_connections is the number of hosts to keep pools for,
+        pool_maxsize the max. number of connections kept per host and
+        pool_block makes the caller wait for a free connection instead of
+        opening an extra one when the pool is exhausted. """
+
+    # requests is imported here so importing the client stays cheap until
+    # the first request
+    import requests
+    try:
+        from http.cookiejar import DefaultCookiePolicy  # python3
+    except ImportError:
+        from cookielib import DefaultCookiePolicy  # python2
+
+    s = requests.Session()
+    adapter = _adapter_class()(pool_connections=pool_connections,
+                          pool_maxsize=pool_maxsize, pool_block=pool_block)
+    s.mount('http://', adapter)
+    s.mount('https://', adapter)
+    s.headers.update(ct.HEADERS)
+    try:
+        # Every encoding urllib3 can decode: adds br if brotli is installed
+        from requests.packages.urllib3.util.request import ACCEPT_ENCODING
+        s.headers['Accept-Encoding'] = ACCEPT_ENCODING
+    except ImportError:
+        pass
+    if not keep_alive:
+        s.headers['Connection'] = 'close'
+    # Cookies are handled by the client itself (see iRWebStats.last_cookie),
+    # the session must not store them or they would leak between clients
+    # sharing the pool.
+    s.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    return s
+
+
+def shared_session(**kw):
+    """ Returns a process wide session so several iRWebStats instances can
+        share the same connection pool (i.e iRWebStats(session=
+        shared_session())). The keyword arguments of make_session are only
+        used the first time it's called. """
+
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = make_session(**kw)
+        return _shared
@@ -0,0 +1,136 @@
+#!/usr/bin/python
+""" Rate limiting of the requests sent to iRacing site. A token bucket lets
+    short bursts through without waiting and only delays requests once the
+    budget (ct.RATE_LIMIT requests per second) is exhausted. """
+
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows, FileTokenBucket is not available
+
+from ir_webstats import constants as ct
+
+try:
+    _now = time.monotonic  # python3
+except AttributeError:
+    _now = time.time  # python2
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+class TokenBucket(object):
+
+    """ Thread safe token bucket. rate is the number of requests allowed per
+        second and burst the max. number of requests that can be sent back
+        to back after some idle time. A single instance can be shared by
+        several clients (see shared_limiter). """
+
+    def __init__(self, rate=ct.RATE_LIMIT, burst=ct.RATE_BURST):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self._tokens = self.burst
+        self._last = _now()
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.reset_stats()
+
+    def _take(self, n):
+        """ Takes n tokens and returns the delay (seconds) until they are
+            available. Tokens may go negative so concurrent callers queue
+            up instead of all waking at once. """
+        with self._lock:
+            now = _now()
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= n
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def reserve(self, n=1):
+        """ Reserves n requests and returns how long (seconds) the caller
+            has to wait before sending them. Doesn't sleep, useful for
+            asynchronous callers. """
+        wait = self._take(n)
+        with self._stats_lock:
+            self.requests += n
+            if wait > 0:
+                self.delayed += n
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+        return wait
+
+    def acquire(self, n=1):
+        """ Blocks until n requests can be sent. Returns the time waited. """
+        wait = self.reserve(n)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def stats(self):
+        """ Returns the wait time statistics: number of requests, how many
+            of them were delayed and the total, max and average wait. """
+        with self._stats_lock:
+            avg = self.total_wait / self.requests if self.requests else 0.0
+            return {'requests': self.requests, 'delayed': self.delayed,
+                    'total_wait': self.total_wait, 'max_wait': self.max_wait,
+                    'avg_wait': avg}
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self.requests, self.delayed = 0, 0
+            self.total_wait, self.max_wait = 0.0, 0.0
+
+
+class FileTokenBucket(TokenBucket):
+
+    """ Token bucket whose state lives in a local file so the budget is
+        shared by every process using the same path (i.e several crawlers
+        in the same host). Requires fcntl (POSIX). Wait statistics are kept
+        per process. """
+
+    def __init__(self, path=ct.RATE_LIMIT_FILE, rate=ct.RATE_LIMIT,
+                 burst=ct.RATE_BURST):
+        if fcntl is None:
+            raise RuntimeError("FileTokenBucket requires fcntl (POSIX only)")
+        TokenBucket.__init__(self, rate, burst)
+        self.path = path
+
+    def _take(self, n):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            now = time.time()  # wall clock, it's compared across processes
+            try:
+                tokens, last = [float(x) for x in
+                                os.read(fd, 64).decode('ascii').split()]
+            except ValueError:  # New or corrupted file
+                tokens, last = self.burst, now
+            tokens = min(self.burst, tokens + max(now - last, 0) * self.rate)
+            tokens -= n
+            state = ('%r %r' % (tokens, now)).encode('ascii')
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, state)
+        finally:
+            os.close(fd)  # Releases the lock
+        if tokens >= 0:
+            return 0.0
+        return -tokens / self.rate
+
+
+def shared_limiter():
+    """ Returns the process wide limiter used by default by every client so
+        several instances running in parallel respect the same budget. """
+
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = TokenBucket()
+        return _shared
@@ -0,0 +1,142 @@
+#!/usr/bin/python
+""" Retries and circuit breaker of the requests sent to iRacing site.
+    Connection errors, 429 and 5xx answers are retried with exponential
+    backoff (full jitter) or after the time asked by Retry-After. When the
+    site keeps failing the circuit breaker opens and requests fail at once
+    (util.CircuitOpenError) instead of piling up, until a trial request
+    succeeds. """
+
+import calendar
+import random
+import threading
+import time
+from email.utils import parsedate_tz
+
+from ir_webstats import constants as ct
+from ir_webstats.util import CircuitOpenError
+
+try:
+    _now = time.monotonic  # python3
+except AttributeError:
+    _now = time.time  # python2
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def retry_after(value):
+    """ Seconds asked by a Retry-After header (a delay or an HTTP date),
+        None if it's missing or invalid """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    date = parsedate_tz(value)
+    if date is None:
+        return None
+    return max(calendar.timegm(date[:9]) - (date[9] or 0) - time.time(), 0.0)
+
+
+class RetryPolicy(object):
+
+    """ How failed requests are retried: up to retries times, waiting a
+        random time between 0 and backoff * 2 ** (attempt - 1) seconds
+        (capped to max_backoff), or what Retry-After asks (capped to
+        max_retry_after). statuses are the HTTP status retried. """
+
+    def __init__(self, retries=ct.RETRIES, backoff=ct.RETRY_BACKOFF,
+                 max_backoff=ct.RETRY_MAX_BACKOFF,
+                 max_retry_after=ct.RETRY_AFTER_MAX,
+                 statuses=ct.RETRY_STATUSES):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_retry_after = max_retry_after
+        self.statuses = frozenset(statuses)
+
+    def delay(self, attempt, after=None):
+        """ Seconds to wait before the retry number attempt (1, 2, ...).
+            after is the Retry-After of the last answer, if any. """
+        if after is not None:
+            return min(after, self.max_retry_after)
+        return random.uniform(0, min(self.max_backoff,
+                                     self.backoff * 2 ** (attempt - 1)))
+
+
+NO_RETRY = RetryPolicy(retries=0)
+
+
+class CircuitBreaker(object):
+
+    """ Opens after threshold failed requests in a row (connection errors
+        and 5xx): while open, before() raises CircuitOpenError. After
+        cooldown seconds one trial request is let through (half open), it
+        closes the circuit if it succeeds or opens it again if it fails.
+        Thread safe, one instance can be shared by several clients (see
+        shared_breaker). """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, threshold=ct.BREAKER_THRESHOLD,
+                 cooldown=ct.BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0  # In a row
+        self.opened_at = None
+        self.trips, self.rejected = 0, 0
+
+    def before(self):
+        """ Called before sending a request, raises CircuitOpenError if it
+            mustn't be sent """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            retry_in = self.opened_at + self.cooldown - _now()
+            if self.state == self.OPEN and retry_in <= 0:
+                self.state = self.HALF_OPEN  # This request is the trial
+                return
+            self.rejected += 1
+        raise CircuitOpenError("Circuit open, iRacing site is failing",
+                               max(retry_in, 0.0))
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.state = self.CLOSED
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or \
+                    self.failures >= self.threshold:
+                if self.state != self.OPEN:
+                    self.trips += 1
+                self.state = self.OPEN
+                self.opened_at = _now()
+
+    def abort(self):
+        """ The request let through wasn't completed (i.e cancelled), if
+            it was the trial another one is let through """
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+
+    def stats(self):
+        with self._lock:
+            return {'state': self.state, 'failures': self.failures,
+                    'trips': self.trips, 'rejected': self.rejected}
+
+
+def shared_breaker():
+    """ Returns the process wide circuit breaker used by default by every
+        client, so all of them stop when the site is failing. """
+
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = CircuitBreaker()
+        return _shared
@@ -0,0 +1,90 @@
+#!/usr/bin/python
+""" Login sessions (cookie and custid) shared by every client and process of
+    a host, per account. Writes are atomic and serialized with file locks,
+    and logins are too: when a session expires only one process logs in
+    again, the rest wait for it and reuse the new session. """
+
+import json
+import os
+import re
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows, no locking: concurrent logins may happen
+
+from ir_webstats import constants as ct
+
+_replace = getattr(os, 'replace', os.rename)  # python2 has no os.replace
+
+
+class FileLock(object):
+
+    """ Exclusive lock (flock) held by the process while the with block
+        runs. Released by the OS if the process dies. """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        if fcntl is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        os.close(self.fd)  # Releases the lock
+
+
+class SessionStore(object):
+
+    """ Sessions saved in path (JSON, readable only by the user) keyed by
+        account (username). The default location doesn't depend on the
+        working directory so every worker of the host shares it. """
+
+    def __init__(self, path=ct.SESSION_FILE):
+        self.path = os.path.expanduser(path)
+
+    def __read(self):
+        try:
+            with open(self.path, 'r') as o:
+                return json.load(o)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def load(self, username):
+        """ Returns (cookie, custid) of the account or None. With an empty
+            username, the last session saved of any account. """
+        sessions = self.__read()
+        if not username and sessions:
+            username = max(sessions, key=lambda u: sessions[u]['time'])
+        s = sessions.get(username)
+        return None if s is None else (s['cookie'], s['custid'])
+
+    def __write(self, sessions):
+        """ Replaces the file atomically (called with the write lock) """
+        tmp = '%s.%s.tmp' % (self.path, os.getpid())
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as o:
+            json.dump(sessions, o)
+        _replace(tmp, self.path)
+
+    def save(self, username, cookie, custid):
+        with FileLock(self.path + '.lock'):
+            sessions = self.__read()
+            sessions[username] = {'cookie': cookie, 'custid': custid,
+                                  'time': time.time()}
+            self.__write(sessions)
+
+    def delete(self, username):
+        with FileLock(self.path + '.lock'):
+            sessions = self.__read()
+            if sessions.pop(username, None) is not None:
+                self.__write(sessions)
+
+    def login_lock(self, username):
+        """ Lock to hold while logging in the account, so only one process
+            (or thread) at a time does it """
+        name = re.sub(r'[^\w.@-]', '_', username or '')
+        return FileLock('%s.%s.login' % (self.path, name))
@@ -0,0 +1,81 @@
+#!/usr/bin/python
+""" Single-flight coalescing of identical requests. While a request is in
+    flight, the same request made by other threads isn't sent again: they
+    wait for it and get the same response, so a burst of lookups of a
+    popular driver costs one request and one rate limiter slot. """
+
+import threading
+
+try:
+    from urllib.parse import urlencode as encode  # python3
+except ImportError:
+    from urllib import urlencode as encode  # python2
+
+
+def key(url, data=None, *extra):
+    """ Key of a request: URL, parameters sorted by name and anything else
+        that changes the response (method, cookie, etc.) """
+    return (url + '#' + encode(sorted(data.items())) if data else url,) + \
+        extra
+
+
+class _Flight(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+
+    """ Runs a function once per key at a time: calls with the key of a
+        call in progress wait for it and share its result (or exception).
+        Counts the calls, the functions actually run (flights) and the
+        calls served by another one (coalesced). Thread safe. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.calls, self.flights, self.coalesced = 0, 0, 0
+
+    def _join(self, key, new):
+        """ Returns (flight of key, True if the caller must run it) """
+        with self._lock:
+            self.calls += 1
+            flight = self._flights.get(key)
+            if flight is not None:
+                self.coalesced += 1
+                return flight, False
+            self.flights += 1
+            flight = self._flights[key] = new()
+            return flight, True
+
+    def _land(self, key):
+        with self._lock:
+            del self._flights[key]
+
+    def do(self, key, func):
+        """ Returns (func(), shared): shared is True if the result comes
+            from a call made by another thread """
+        flight, leader = self._join(key, _Flight)
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+        try:
+            flight.result = func()
+        except BaseException as e:  # Interrupted too, waiters must wake up
+            flight.error = e
+            raise
+        finally:
+            self._land(key)
+            flight.done.set()
+        return flight.result, False
+
+    def stats(self):
+        with self._lock:
+            return {'calls': self.calls, 'flights': self.flights,
+                    'coalesced': self.coalesced,
+                    'in_flight': len(self._flights)}
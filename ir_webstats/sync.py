@@ -0,0 +1,168 @@
+#!/usr/bin/python
+""" Incremental download of results_archive. Instead of requesting whole
+    seasons again, every query (custid + filters) keeps a watermark, the
+    newest result seen, and only the results newer than it are requested.
+    Progress is checkpointed after every page so an interrupted run is
+    resumed where it stopped. """
+
+import datetime
+import json
+import os
+import threading
+import time
+
+from ir_webstats import constants as ct
+
+_replace = getattr(os, 'replace', os.rename)  # python2 has no os.replace
+
+
+def _day(start_time):
+    """ 'YYYY-MM-DD' (as taken by date_range) of a start time, either a
+        timestamp in ms or a date string """
+    try:
+        return datetime.datetime.fromtimestamp(
+            float(start_time) / 1000).strftime('%Y-%m-%d')
+    except ValueError:
+        return str(start_time)[:10]
+
+
+class ResultsSync(object):
+
+    """ Syncs results_archive queries of client (an iRWebStats, logged in)
+        keeping their state in path (JSON). Results are requested newest
+        first and the paging stops at the first result already seen, so a
+        run costs one request per page of new results. The watermark of a
+        result is (start_time, subsessionid), see time_field and id_field.
+        A query shouldn't be synced by two threads at the same time. """
+
+    time_field = 'start_time'
+    id_field = 'subsessionid'
+
+    def __init__(self, client, path=ct.SYNC_FILE):
+        self.client = client
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path, 'r') as o:
+                self.state = json.load(o)
+        except (IOError, OSError, ValueError):
+            self.state = {}
+
+    def __save(self):
+        """ Replaces the state file atomically (called with the lock) """
+        tmp = '%s.%s.tmp' % (self.path, os.getpid())
+        with open(tmp, 'w') as o:
+            json.dump(self.state, o)
+        _replace(tmp, self.path)
+
+    def __key(self, custid, kw):
+        custid = self.client.custid if custid is None else custid
+        return custid, json.dumps({'custid': custid, 'query': kw},
+                                  sort_keys=True)
+
+    def watermark(self, custid=None, **kw):
+        """ (start_time, subsessionid) of the newest result synced for the
+            query, None if it was never synced """
+        entry = self.state.get(self.__key(custid, kw)[1])
+        return None if entry is None else entry['watermark']
+
+    def reset(self, custid=None, **kw):
+        """ Forgets the watermark and checkpoint of the query """
+        with self._lock:
+            if self.state.pop(self.__key(custid, kw)[1], None) is not None:
+                self.__save()
+
+    def sync(self, custid=None, since=None, callback=None, **kw):
+        """ Returns the results of the query (custid and any other argument
+            of results_archive but season, date_range, page, sort and order)
+            newer than its watermark, newest first, and moves the watermark.
+            Results are selected by date: since ('YYYY-MM-DD') is required
+            by the first sync of a query, later ones start at the watermark
+            (results_archive ignores season with a date range). callback(rows)
+            is called with the new rows of every page before it's
+            checkpointed: after a crash the rows of the page in progress
+            can be delivered again, so it should be idempotent (i.e keyed
+            by subsessionid). """
+
+        for arg in ('season', 'date_range', 'page', 'sort', 'order'):
+            if arg in kw:
+                raise ValueError("%s can't be used by sync" % arg)
+        if kw.get('rows') == ct.ROWS_COLUMNS:
+            raise ValueError("sync needs a row per result, use ROWS_DICT or "
+                             "ROWS_TUPLE")
+        custid, key = self.__key(custid, kw)
+
+        with self._lock:
+            entry = self.state.get(key, {'watermark': None, 'run': None})
+            if entry['run'] is None:  # New run, else resume the last one
+                low = since
+                if entry['watermark'] is not None:
+                    low = _day(entry['watermark'][0])
+                if low is None:
+                    raise ValueError("since is required by the first sync "
+                                     "of a query")
+                # The upper bound is fixed for the run so pages don't shift
+                # if it's resumed later (newer results go to the next run)
+                high = _day((time.time() + 24 * 3600) * 1000)
+                entry['run'] = {'range': [low, high], 'page': 0,
+                                'newest': None}
+                self.state[key] = entry
+                self.__save()
+            run = entry['run']
+        mark = entry['watermark']
+        date_range = tuple(run['range'])
+
+        new = []
+        page = run['page']
+        while True:
+            page += 1
+            res = self.client.results_archive(
+                custid, date_range=date_range, page=page, sort=ct.SORT_TIME,
+                order=ct.ORDER_DESC, **kw)
+            if res is None:
+                raise RuntimeError("results_archive failed, is the client "
+                                   "logged in?")
+            rows, total_results = res
+            fresh, done = [], False
+            for row in rows:
+                wm = [row[self.time_field], row[self.id_field]]
+                if mark is not None and wm <= mark:
+                    done = True  # Already seen, so is the rest
+                    break
+                if run['newest'] is None:
+                    run['newest'] = wm
+                fresh.append(row)
+            if fresh and callback is not None:
+                callback(fresh)
+            new.extend(fresh)
+            done = done or len(rows) < ct.NUM_ENTRIES or \
+                page * ct.NUM_ENTRIES >= int(total_results)
+
+            with self._lock:
+                run['page'] = page
+                if done:
+                    if run['newest'] is not None:
+                        entry['watermark'] = run['newest']
+                    entry['run'] = None
+                self.__save()
+            if done:
+                return new
+
+    def sync_all(self, custids, since=None, workers=ct.BULK_WORKERS, **kw):
+        """ Syncs the same query for every custid using workers threads
+            (sharing the client's rate limiter). Returns a dict custid ->
+            new results, or the exception raised if its sync failed (its
+            checkpoint is kept for the next run). """
+
+        def one(custid):
+            try:
+                return self.sync(custid, since, **kw)
+            except Exception as e:
+                return e
+
+        from concurrent.futures import ThreadPoolExecutor  # lazy, slow import
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            return dict(zip(custids, executor.map(one, custids)))
+        finally:
+            executor.shutdown()
@@ -1,7 +1,10 @@
-import inspect
+import functools
 import json
+import re
+from collections import namedtuple
 
-from ir_webstats import decorator
+from ir_webstats import constants as ct
+from ir_webstats import metrics
 
 try:
     from urllib.parse import unquote  # python3
@@ -15,32 +18,185 @@ def tofile(data):
     a.close()
 
 
-def format_results(results, header):
-    newres = []
-    for row in results:
-        newr = {}
-        for k, v in row.items():
-            newr[header[k]] = v
-        newres.append(newr)
-    return newres
+def format_results(results, header, rows=ct.ROWS_DICT):
+    """ Maps the coded columns of iRacing results to their readable names
+        (header). rows selects the output: ct.ROWS_DICT a dict per row,
+        ct.ROWS_TUPLE a namedtuple per row (fields named after the header)
+        or ct.ROWS_COLUMNS a dict column -> list of values. """
 
+    record = metrics.active()
+    if record is None:
+        return _format_results(results, header, rows)
+    with metrics.measure(record, 'format'):
+        return _format_results(results, header, rows)
+
+
+def _format_results(results, header, rows):
+    if rows == ct.ROWS_DICT:
+        newres = []
+        for row in results:
+            newr = {}
+            for k, v in row.items():
+                newr[header[k]] = v
+            newres.append(newr)
+        return newres
+
+    keys = sorted(header)
+    if rows == ct.ROWS_COLUMNS:
+        return {header[k]: [row.get(k) for row in results] for k in keys}
+    row_type = _row_type(tuple(header[k] for k in keys))
+    return [row_type._make([row.get(k) for k in keys]) for row in results]
+
+
+_row_types = {}
+
+
+def _row_type(names):
+    """ Row class (namedtuple) for a header, created once per distinct
+        header. Columns can be read as attributes (row.displayname) or by
+        name (row['displayname']), which also works for columns that
+        aren't valid identifiers. """
+    try:
+        return _row_types[names]
+    except KeyError:
+        index = {n: i for i, n in enumerate(names)}
+
+        def __getitem__(self, k):
+            if not isinstance(k, (int, slice)):
+                k = index[k]
+            return tuple.__getitem__(self, k)
+
+        t = type('Row', (namedtuple('Row', names, rename=True),),
+                 {'__slots__': (), '__getitem__': __getitem__,
+                  'columns': names})
+        _row_types[names] = t
+        return t
+
+
+_TIME = re.compile(r'^(\d+:)?\d+:\d\d(\.\d+)?$')  # [h:]m:ss[.fff]
+
+
+def laptime(s):
+    """ Lap/race time ('1:23.456' or '1:02:03.456') to seconds """
+    secs = 0.0
+    for part in s.split(':'):
+        secs = secs * 60 + float(part)
+    return secs
+
+
+def _converter(value):
+    """ Chooses the type of a column from one of its values """
+    for conv in (int, float):
+        try:
+            conv(value)
+            return conv
+        except ValueError:
+            pass
+    if _TIME.match(value):
+        return laptime
+    return str
+
+
+def typed_rows(rows, keep=()):
+    """ Converts the numeric and lap time cells of rows (lists of strings,
+        i.e from csv.reader) to int, float or seconds. The type of each
+        column is chosen once, from its first non empty value. Empty cells
+        become None and cells that don't match their column's type are left
+        as strings (int columns become float if a float value shows up).
+        Columns in keep (indexes, i.e ids and car numbers like "07") are
+        always left as strings. """
+
+    convs = []
+    for row in rows:
+        if len(convs) < len(row):
+            convs.extend(str if i in keep else None
+                         for i in range(len(convs), len(row)))
+        out = []
+        for i, v in enumerate(row):
+            if v == '':
+                out.append(None)
+                continue
+            conv = convs[i]
+            if conv is None:
+                conv = convs[i] = _converter(v)
+            try:
+                out.append(conv(v))
+            except ValueError:
+                if conv is int:  # i.e 1, 2, 2.5: the column is float
+                    try:
+                        out.append(float(v))
+                        convs[i] = float
+                        continue
+                    except ValueError:
+                        pass
+                out.append(v)
+        yield out
 
-def __logged_in(func, *args, **kw):
-    args2 = list(args)
-    irweb = args2[0]
-    if not irweb.logged:
-        pprint("Error, client is not logged in to iRacing Platform so\
-                operation couldn't be completed.", irweb.verbose)
-        return None
 
-    if 'custid' in inspect.getargspec(func).args:
-        args2[1] = args2[1] if args2[1] is not None else irweb.custid
+def closing_iter(iterable, resource):
+    """ Yields from iterable and closes resource when done (or when the
+        generator is closed) """
+    try:
+        for x in iterable:
+            yield x
+    finally:
+        resource.close()
+
+
+def argnames(func):
+    """ Names of the positional arguments of func (including self). Reads
+        the code object directly, importing inspect is slow. """
+    code = func.__code__
+    return list(code.co_varnames[:code.co_argcount])
+
+
+def custid_filler(func):
+    """ Returns a function fill(irweb, args, kw) that sets the custid
+        argument of func to the logged user (irweb.custid) when it's None or
+        missing, or None if func has no custid argument. Resolved once so
+        the per call cost is a couple of comparisons. """
 
-    return func(*args2, **kw)
+    names = argnames(func)
+    if 'custid' not in names:
+        return None
+    pos = names.index('custid') - 1  # Position in args (without self)
+
+    def fill(irweb, args, kw):
+        if len(args) > pos:
+            if args[pos] is None:
+                args = args[:pos] + (irweb.custid,) + args[pos + 1:]
+        elif kw.get('custid') is None:
+            kw['custid'] = irweb.custid
+        return args, kw
+    return fill
 
 
 def logged_in(func):
-    return decorator.decorator(__logged_in, func)
+    """ Decorator of client methods: they return None (and print an error)
+        if the client isn't logged in, and custid defaults to the logged
+        user. """
+
+    fill = custid_filler(func)
+
+    if fill is None:
+        @functools.wraps(func)
+        def wrapper(irweb, *args, **kw):
+            if not irweb.logged:
+                pprint("Error, client is not logged in to iRacing Platform so\
+                        operation couldn't be completed.", irweb.verbose)
+                return None
+            return func(irweb, *args, **kw)
+    else:
+        @functools.wraps(func)
+        def wrapper(irweb, *args, **kw):
+            if not irweb.logged:
+                pprint("Error, client is not logged in to iRacing Platform so\
+                        operation couldn't be completed.", irweb.verbose)
+                return None
+            args, kw = fill(irweb, args, kw)
+            return func(irweb, *args, **kw)
+    wrapper.__wrapped__ = func  # python2's wraps doesn't set it
+    return wrapper
 
 
 def pprint(string, v=True):
@@ -48,14 +204,213 @@ def pprint(string, v=True):
         print(' '.join(str(string).split()))
 
 
-def parse(data):
-    res = ''
+class IRWebStatsError(Exception):
+
+    """ Base of the errors raised by the clients """
+
+
+class ParseError(IRWebStatsError, ValueError):
+
+    """ Raised by parse in strict mode when a response isn't valid JSON (i.e
+        the login page returned instead of the data when the session
+        expired), or when a CSV response is incomplete. data holds the start
+        of the response. """
+
+    def __init__(self, message, data=None):
+        ValueError.__init__(self, message)
+        self.data = data
+
+
+class RequestError(IRWebStatsError):
+
+    """ A request failed after its retries (see retry.RetryPolicy). url is
+        the URL requested, status the HTTP status of the last answer (None
+        if there was none, i.e connection errors) and cause the exception
+        of the last attempt, if any. """
+
+    def __init__(self, message, url=None, status=None, cause=None):
+        IRWebStatsError.__init__(self, message)
+        self.url = url
+        self.status = status
+        self.cause = cause
+
+
+class RateLimitedError(RequestError):
+
+    """ The site kept answering 429 Too Many Requests """
+
+
+class ServerError(RequestError):
+
+    """ The site kept answering 5xx errors """
+
+
+class CircuitOpenError(IRWebStatsError):
+
+    """ The request wasn't sent because the site is failing (see
+        retry.CircuitBreaker). retry_in is the time (seconds) until a
+        request is tried again. """
+
+    def __init__(self, message, retry_in=0.0):
+        IRWebStatsError.__init__(self, message)
+        self.retry_in = retry_in
+
+
+_json = {'name': None, 'loads': None, 'strict': True}
+
+
+def use_json_backend(name=None):
+    """ Selects the JSON decoder used by parse: 'orjson', 'ujson' or 'json'
+        (stdlib). With None the first one installed of ct.JSON_BACKENDS is
+        used. The module is imported here, not when util is. Returns the
+        name of the backend. """
+
+    import importlib
+    for candidate in ct.JSON_BACKENDS if name is None else (name,):
+        try:
+            module = importlib.import_module(candidate)
+        except ImportError:
+            if name is not None:
+                raise
+            continue
+        _json['name'], _json['loads'] = candidate, module.loads
+        return candidate
+
+
+def strict_parsing(strict=True):
+    """ Sets the default mode of parse: strict (the default) raises
+        ParseError on invalid responses, else they return '' """
+    _json['strict'] = strict
+
+
+def parse(data, strict=None):
+    """ Decodes a JSON response, given as bytes (preferred, the fast
+        backends decode UTF-8 themselves) or str. Invalid responses raise
+        ParseError, or return '' if not strict (strict=None: the mode set
+        with strict_parsing). """
+
+    loads = _json['loads']
+    if loads is None:
+        use_json_backend()
+        loads = _json['loads']
     try:
-        res = json.loads(data)  # iRacing responses are generally in JSON
-    except:
-        pass  # TODO raise error?
+        return loads(data)  # iRacing responses are generally in JSON
+    except (ValueError, TypeError) as e:
+        error = e
+    if isinstance(data, bytes):
+        # Not UTF-8: the site may send Latin-1 when it doesn't say otherwise
+        try:
+            return loads(data.decode('latin-1'))
+        except (ValueError, TypeError):
+            pass
+    if _json['strict'] if strict is None else strict:
+        raise ParseError("Invalid JSON response (%s): %s" %
+                         (_json['name'], error), data[:200] if data else data)
+    return ''
+
+
+# Service catalog tables: client attribute -> page variable
+IRSERVICE_VARS = {"TRACKS":  "TrackListing", "CARS": "CarListing",
+                  "CARCLASS":  "CarClassListing", "CLUBS": "ClubListing",
+                  "SEASON": "SeasonListing", "DIVISION": "DivisionListing",
+                  "YEARANDQUARTER": "YearAndQuarterListing"}
+# Variables kept as lists, the rest are indexed by id
+LIST_VARS = ("SeasonListing", "YearAndQuarterListing")
+
+_EXTRACT_JSON = re.compile(r"var (\w+) = extractJSON\('")
+
+
+def extract_vars(resp, varnames):
+    """ Walks resp (an iRacing page) once and returns the raw JSON of every
+        occurrence of the variables in varnames (var X = extractJSON('...'))
+        as a dict varname -> [json, ...] in order of appearance. The walk
+        stops at an unterminated variable (i.e a truncated page). """
+
+    found = {}
+    pos = 0
+    while True:
+        m = _EXTRACT_JSON.search(resp, pos)
+        if m is None:
+            break
+        end = resp.find("');", m.end())
+        if end == -1:
+            break
+        if m.group(1) in varnames:
+            found.setdefault(m.group(1), []).append(
+                resp[m.end(): end].replace('+', ' '))
+        pos = end + 3
+    return found
+
+
+def decode_var(varname, json_o):
+    """ Decodes the raw JSON of a variable, indexing it by id if needed """
+    o = json.loads(json_o)
+    if varname not in LIST_VARS:
+        o = {ele['id']: ele for ele in o}
+    return o
+
+
+def load_irservice_var(varname, resp, appear=1):
+    """ Loads the JSON of a variable (var varname = extractJSON('...')) 
+        embedded in an iRacing page. appear selects the occurrence. """
+    return decode_var(varname, extract_vars(resp, (varname,))[varname]
+                      [appear - 1])
+
+
+class ServiceInfo(object):
+
+    """ Service catalog (tracks, cars, etc.). raw maps each table (TRACKS,
+        CARS, ...) to its raw JSON, which is only decoded the first time the
+        table is accessed. """
+
+    def __init__(self, raw=None):
+        self.raw = raw if raw is not None else {}
+        self._tables = {}
+
+    def get(self, name):
+        if name not in self._tables:
+            try:
+                self._tables[name] = decode_var(IRSERVICE_VARS[name],
+                                                self.raw[name])
+            except Exception:
+                self._tables[name] = {}
+        return self._tables[name]
+
+    def set(self, name, table):
+        """ Replaces a table with a decoded one (as returned by get) """
+        values = table if IRSERVICE_VARS[name] in LIST_VARS else \
+            list(table.values())
+        self.raw[name] = json.dumps(values)
+        self._tables[name] = table
+
+    def __contains__(self, name):
+        return name in self.raw
+
+    def __bool__(self):
+        return bool(self.raw)
+    __nonzero__ = __bool__  # python2
+
+
+def catalog_property(name):
+    """ Client attribute (i.e self.TRACKS) backed by its ServiceInfo """
+    return property(lambda self: self.catalog.get(name),
+                    lambda self, table: self.catalog.set(name, table))
+
+
+def irservice_info(resp):
+    """ Gets general information from iracing service like current tracks, 
+        cars, series, etc. embedded in iRacing pages. Returns a tuple (info,
+        errors) where info is a ServiceInfo and errors lists the tables that
+        couldn't be found."""
 
-    return res
+    found = extract_vars(resp, set(IRSERVICE_VARS.values()))
+    raw, errors = {}, []
+    for i in IRSERVICE_VARS:
+        if IRSERVICE_VARS[i] in found:
+            raw[i] = found[IRSERVICE_VARS[i]][0]
+        else:
+            errors.append(i)
+    return ServiceInfo(raw), errors
 
 
 def clean(string):
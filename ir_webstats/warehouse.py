@@ -0,0 +1,246 @@
+#!/usr/bin/python
+""" Local results store (SQLite) for offline queries. It ingests the output
+    of results_archive, series_raceresults and event_results so analysis
+    doesn't have to request the site again. The columns used for lookups
+    are indexed, the whole row is kept as JSON. """
+
+import calendar
+import json
+import sqlite3
+import threading
+import time
+
+from ir_webstats import constants as ct
+
+SCHEMA = (
+    # A row per driver and subsession (results_archive, event_results)
+    "CREATE TABLE IF NOT EXISTS results (subsessionid INTEGER, custid "
+    "INTEGER, seasonid INTEGER, trackid INTEGER, carid INTEGER, start_time "
+    "REAL, finishing_position INTEGER, incidents INTEGER, old_irating "
+    "INTEGER, new_irating INTEGER, data TEXT, PRIMARY KEY (subsessionid, "
+    "custid))",
+    # A row per subsession (series_raceresults, event_results info)
+    "CREATE TABLE IF NOT EXISTS races (subsessionid INTEGER PRIMARY KEY, "
+    "seasonid INTEGER, seriesid INTEGER, raceweek INTEGER, trackid INTEGER, "
+    "track TEXT, start_time REAL, sof INTEGER, data TEXT)",
+    "CREATE INDEX IF NOT EXISTS results_custid ON results (custid, "
+    "start_time)",
+    "CREATE INDEX IF NOT EXISTS results_seasonid ON results (seasonid)",
+    "CREATE INDEX IF NOT EXISTS results_trackid ON results (trackid, "
+    "start_time)",
+    "CREATE INDEX IF NOT EXISTS results_start_time ON results (start_time)",
+    "CREATE INDEX IF NOT EXISTS races_seasonid ON races (seasonid, "
+    "raceweek)",
+    "CREATE INDEX IF NOT EXISTS races_trackid ON races (trackid)",
+    "CREATE INDEX IF NOT EXISTS races_start_time ON races (start_time)",
+)
+
+# Table column -> names it can have in the responses (results_archive,
+# series_raceresults, event_results CSV)
+RESULT_FIELDS = (
+    ('subsessionid', ('subsessionid',)),
+    ('custid', ('custid', 'Cust ID')),
+    ('seasonid', ('seasonid', 'Season ID')),
+    ('trackid', ('trackid',)),
+    ('carid', ('carid', 'Car ID')),
+    ('start_time', ('start_time', 'starttime', 'Start Time')),
+    ('finishing_position', ('finishing_position', 'Fin Pos')),
+    ('incidents', ('incidents', 'Inc')),
+    ('old_irating', ('oldirating', 'Old iRating')),
+    ('new_irating', ('newirating', 'New iRating')),
+)
+RACE_FIELDS = (
+    ('subsessionid', ('subsessionid',)),
+    ('seasonid', ('seasonid', 'Season ID')),
+    ('seriesid', ('seriesid', 'Series ID')),
+    ('raceweek', ('raceweek', 'race_week_num', 'Race Week')),
+    ('trackid', ('trackid',)),
+    ('track', ('track', 'trackname', 'Track')),
+    ('start_time', ('start_time', 'starttime', 'Start Time')),
+    ('sof', ('strengthoffield', 'sof', 'Strength of Field')),
+)
+
+
+def _ms(value):
+    """ Start time as a timestamp in ms: numbers are kept, date strings
+        ('YYYY-MM-DD[ HH:MM[:SS]]', GMT) are converted """
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    value = value.replace(' GMT', '').strip()
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return calendar.timegm(time.strptime(value, fmt)) * 1000.0
+        except ValueError:
+            continue
+    return None
+
+
+def _num(value):
+    """ Numbers stay as they are, numeric strings (CSV) are converted """
+    if value == '':
+        return None
+    if value is None or isinstance(value, (int, float)):
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return float(value)
+        except ValueError:
+            return value
+
+
+def _rows(results):
+    """ Rows of any of the formats of the rows argument, as dicts """
+    if isinstance(results, dict):  # ct.ROWS_COLUMNS
+        names = list(results)
+        return [dict(zip(names, values))
+                for values in zip(*[results[n] for n in names])]
+    return [dict(zip(r.columns, r)) if hasattr(r, 'columns') else r
+            for r in results]
+
+
+def _extract(row, fields, defaults=None):
+    """ Values of the table columns (fields) found in a response row """
+    values = {}
+    for column, names in fields:
+        value = None
+        for name in names:
+            if row.get(name) not in (None, ''):
+                value = row[name]
+                break
+        if value is None and defaults:
+            value = defaults.get(column)
+        values[column] = _ms(value) if column == 'start_time' else \
+            value if column == 'track' else _num(value)
+    return values
+
+
+class Warehouse(object):
+
+    """ Results store in the SQLite file path. Rows added again (same
+        subsession and driver) are merged: a stored column is only replaced
+        by a value, so i.e a results_archive row can be completed with the
+        iRatings of event_results. Thread safe.
+        To keep it up to date with the site feed it from sync.ResultsSync:
+        sync.sync(custid, since, callback=lambda r: wh.add_results(r, custid))
+        """
+
+    def __init__(self, path=ct.WAREHOUSE_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False,
+                                   timeout=30)
+        self._db.row_factory = sqlite3.Row
+        for sql in SCHEMA:
+            self._db.execute(sql)
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+    def __merge(self, table, fields, keys, rows, defaults):
+        """ Upserts rows (response rows) into table, keys are the columns
+            of its primary key """
+        columns = [c for c, _ in fields if c not in keys]
+        values = [_extract(r, fields, defaults) for r in rows]
+        self._db.executemany(
+            "INSERT OR IGNORE INTO %s (%s) VALUES (%s)" %
+            (table, ', '.join(keys), ', '.join('?' * len(keys))),
+            [[v[k] for k in keys] for v in values])
+        self._db.executemany(
+            "UPDATE %s SET %s, data = ? WHERE %s" %
+            (table, ', '.join('%s = COALESCE(?, %s)' % (c, c)
+                              for c in columns),
+             ' AND '.join('%s = ?' % k for k in keys)),
+            [[v[c] for c in columns] + [json.dumps(r)] + [v[k] for k in keys]
+             for r, v in zip(rows, values)])
+
+    def add_results(self, results, custid=None):
+        """ Stores results_archive results (any rows format). custid is
+            the driver of the query, used if the rows don't include it.
+            Returns the number of rows stored. """
+        rows = _rows(results)
+        with self._lock:
+            self.__merge('results', RESULT_FIELDS, ('subsessionid', 'custid'),
+                         rows, {'custid': custid})
+            self._db.commit()
+        return len(rows)
+
+    def add_races(self, races, season=None, raceweek=None):
+        """ Stores series_raceresults races (any rows format) of season and
+            raceweek. Returns the number of races stored. """
+        rows = _rows(races)
+        with self._lock:
+            self.__merge('races', RACE_FIELDS, ('subsessionid',), rows,
+                         {'seasonid': season, 'raceweek': raceweek})
+            self._db.commit()
+        return len(rows)
+
+    def add_event(self, subsession, event_info, results):
+        """ Stores an event_results subsession: its info in races and every
+            driver in results """
+        info = dict(event_info, subsessionid=subsession)
+        with self._lock:
+            self.__merge('races', RACE_FIELDS, ('subsessionid',), [info], {})
+            # The merged race (i.e trackid from series_raceresults) fills in
+            # the columns missing in the CSV
+            race = dict(self._db.execute("SELECT * FROM races WHERE "
+                                         "subsessionid = ?",
+                                         (subsession,)).fetchone())
+            self.__merge('results', RESULT_FIELDS, ('subsessionid', 'custid'),
+                         _rows(results), race)
+            self._db.commit()
+
+    def query(self, sql, params=()):
+        """ Runs a SELECT and returns its rows as dicts """
+        with self._lock:
+            cur = self._db.execute(sql, params)
+            return [dict(r) for r in cur.fetchall()]
+
+    def driver_results(self, custid, trackid=None, seasonid=None,
+                       date_range=None):
+        """ Results of a driver, newest first, optionally at a track, in a
+            season or within date_range ('YYYY-MM-DD', 'YYYY-MM-DD'; GMT,
+            end excluded). i.e all results of driver X at track Y this
+            year: driver_results(X, Y, date_range=('2014-01-01',
+            '2015-01-01')). Each row is the stored response row plus the
+            indexed columns. """
+
+        where, params = ['custid = ?'], [custid]
+        if trackid is not None:
+            where.append('trackid = ?')
+            params.append(trackid)
+        if seasonid is not None:
+            where.append('seasonid = ?')
+            params.append(seasonid)
+        if date_range is not None:
+            where.append('start_time >= ? AND start_time < ?')
+            params.extend([_ms(date_range[0]), _ms(date_range[1])])
+        rows = self.query("SELECT * FROM results WHERE %s ORDER BY "
+                          "start_time DESC" % ' AND '.join(where), params)
+        for r in rows:
+            r.update(json.loads(r.pop('data')))
+        return rows
+
+    def field_strength(self, seasonid=None, seriesid=None):
+        """ Strength of field distribution per week: a row per season and
+            raceweek with the number of races and the min, average and max
+            SOF """
+
+        where, params = ['sof IS NOT NULL'], []
+        if seasonid is not None:
+            where.append('seasonid = ?')
+            params.append(seasonid)
+        if seriesid is not None:
+            where.append('seriesid = ?')
+            params.append(seriesid)
+        return self.query(
+            "SELECT seasonid, raceweek, COUNT(*) AS races, MIN(sof) AS min, "
+            "AVG(sof) AS avg, MAX(sof) AS max FROM races WHERE %s GROUP BY "
+            "seasonid, raceweek ORDER BY seasonid, raceweek" %
+            ' AND '.join(where), params)
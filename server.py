@@ -0,0 +1,227 @@
+#!/usr/bin/python
+""" Local JSON API server: keeps one logged in iRWebStats (session, catalog,
+    cache and rate limiter) warm and serves its public methods to any
+    number of local tools. Usage python server.py -h
+    API:
+        POST /call/<method>  body: JSON args, a dict (named) or a list
+            -> {"result": ..., "error": null}
+        GET /methods  -> public methods and their docs
+        GET /metrics  -> latency per API method and per site request (see
+            metrics.MetricsAggregator.dump), ?format=text for a table
+        GET /health  -> {"logged": true, "custid": ...} """
+
+import argparse as ap
+import inspect
+import json
+import os
+import sys
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer  # python3
+    from socketserver import ThreadingMixIn, UnixStreamServer
+    from urllib.parse import urlparse, parse_qsl
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer  # python2
+    from SocketServer import ThreadingMixIn, UnixStreamServer
+    from urlparse import urlparse, parse_qsl
+
+from ir_webstats import metrics
+from ir_webstats.client import iRWebStats  # Cheap, requests loads on use
+from ir_webstats.util import ParseError
+
+
+def methods():
+    """ Public methods of iRWebStats served by /call. iter_* are left out,
+        their generators can't be sent as JSON (the paginated methods they
+        wrap are served). """
+    return dict((name, f) for name, f in inspect.getmembers(iRWebStats,
+                                                            callable)
+                if not name.startswith(('_', 'iter_')) and
+                name not in ('login', 'logout', 'close', 'test'))
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'  # Keep-alive for repeated calls
+    disable_nagle_algorithm = True
+
+    def address_string(self):
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, fmt, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, fmt, *args)
+
+    def _send(self, code, body, content_type='application/json'):
+        if not isinstance(body, str):
+            body = json.dumps(body, default=str)
+        body = body.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        server = self.server
+        if url.path == '/methods':
+            return self._send(200, dict((n, inspect.getdoc(f)) for n, f in
+                                        methods().items()))
+        if url.path == '/metrics':
+            if dict(parse_qsl(url.query)).get('format') == 'text':
+                return self._send(200, 'API calls\n%s\n\nSite requests\n%s\n'
+                                  % (server.api.report(),
+                                     server.requests.report()), 'text/plain')
+            return self._send(200, {'api': server.api.dump(),
+                                    'requests': server.requests.dump()})
+        if url.path == '/health':
+            return self._send(200, {'logged': server.client.logged,
+                                    'custid': server.client.custid})
+        self._send(404, {'result': None, 'error': 'Not found'})
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        name = path[len('/call/'):] if path.startswith('/call/') else None
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        if name not in methods():
+            return self._send(404, {'result': None,
+                                    'error': 'Unknown method %s' % name})
+
+        record = metrics.new_record(name)
+        code, out = 200, {'result': None, 'error': None}
+        try:
+            try:
+                args = json.loads(body.decode('utf-8')) if body.strip() \
+                    else {}
+            except ValueError:
+                code = 400
+                raise
+            out['result'] = self.server.call(name, args)
+        except Exception as e:
+            if code == 200:
+                code = 400 if isinstance(e, TypeError) else 500
+            out['error'] = "%s: %s" % (e.__class__.__name__, e)
+            record['error'] = e.__class__.__name__
+        record['status'] = code
+        self.server.api.on_request(metrics.finish(record))
+        self._send(code, out)
+
+
+class UnixHandler(Handler):
+
+    disable_nagle_algorithm = False  # Not a TCP socket
+
+
+class _Server(ThreadingMixIn):
+
+    """ Threads per connection, all of them share client """
+
+    daemon_threads = True
+
+    def setup_api(self, client, verbose, credentials=('', '')):
+        self.client = client
+        self.verbose = verbose
+        self.credentials = credentials  # (username, password) to log in
+        self._login_lock = threading.Lock()
+        self.api = metrics.MetricsAggregator()  # Per API call
+        if client.observer is None:
+            client.observer = metrics.MetricsAggregator()
+        self.requests = client.observer  # Per site request
+
+    def call(self, name, args):
+        """ Calls the client method name with args (a list or a dict). If
+            the session expired (ParseError, the login page came instead of
+            the data) it logs in again and retries once. """
+        func = getattr(self.client, name)
+        cookie = self.client.last_cookie
+        try:
+            return func(*args) if isinstance(args, list) else func(**args)
+        except ParseError:
+            if not self.relogin(cookie):
+                raise
+        return func(*args) if isinstance(args, list) else func(**args)
+
+    def relogin(self, cookie):
+        """ Logs in again, unless another thread already did it since cookie
+            failed. The login is done by a fresh client (sharing the
+            connection pool, rate limiter, etc.) and its session copied,
+            so the shared client stays logged in meanwhile and concurrent
+            calls aren't refused. Returns True if the client is logged in.
+        """
+        client = self.client
+        with self._login_lock:
+            if client.last_cookie != cookie:
+                return client.logged
+            fresh = iRWebStats(verbose=self.verbose, session=client.session,
+                               limiter=client.limiter,
+                               catalog_file=client.catalog_file,
+                               sessions=client.sessions,
+                               retry_policy=client.retry_policy,
+                               breaker=client.breaker)
+            if not fresh.login(*self.credentials):
+                client.logged = False
+                return False
+            client.last_cookie, client.custid = fresh.last_cookie, \
+                fresh.custid
+            return True
+
+
+class APIServer(_Server, HTTPServer):
+
+    def __init__(self, client, host='127.0.0.1', port=8642, verbose=False,
+                 credentials=('', '')):
+        HTTPServer.__init__(self, (host, port), Handler)
+        self.setup_api(client, verbose, credentials)
+
+
+class UnixAPIServer(_Server, UnixStreamServer):
+
+    def __init__(self, client, path, verbose=False, credentials=('', '')):
+        if os.path.exists(path):
+            os.remove(path)  # Left by a previous run
+        UnixStreamServer.__init__(self, path, UnixHandler)
+        self.setup_api(client, verbose, credentials)
+
+
+if __name__ == '__main__':
+
+    parser = ap.ArgumentParser(description="Local JSON API for iRWebStats")
+    parser.add_argument("-u", "--user", help='iRacing user', required=False)
+    parser.add_argument("-p", "--passw", help='iRacing password', required=False)
+    parser.add_argument("--host", help='Address to listen on', default='127.0.0.1')
+    parser.add_argument("--port", help='TCP port to listen on', type=int, default=8642)
+    parser.add_argument("--unix", help='Listen on this Unix socket instead of TCP', required=False)
+    parser.add_argument("--cache", help='Response cache file (see cache.py)', required=False)
+    parser.add_argument("-v", "--verbose", action='store_true')
+    args = parser.parse_args()
+
+    cache = None
+    if args.cache:
+        from ir_webstats.cache import ResponseCache
+        cache = ResponseCache(args.cache)
+    irw = iRWebStats(verbose=args.verbose, cache=cache,
+                     observer=metrics.MetricsAggregator())
+    credentials = ('', '')  # No login provided, maybe there's a valid cookie
+    if args.user and args.passw:
+        credentials = (args.user, args.passw)
+    if not irw.login(*credentials):
+        sys.exit("Error: login failed")
+
+    if args.unix:
+        srv = UnixAPIServer(irw, args.unix, args.verbose, credentials)
+        print("Serving on %s" % args.unix)
+    else:
+        srv = APIServer(irw, args.host, args.port, args.verbose,
+                        credentials)
+        print("Serving on http://%s:%d" % srv.server_address[:2])
+    sys.stdout.flush()
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        srv.server_close()
+        irw.close()
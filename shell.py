@@ -1,14 +1,99 @@
 #!/usr/bin/python
-""" Command line shell interface. Usage python shell.py  -h """
+""" Command line shell interface. Usage python shell.py  -h
+    Batch mode runs many calls with one login: python shell.py -u U -p P
+    -b calls.jsonl [-w 4], one JSON call per line ({"method": "...",
+    "args": {...} or [...], "id": optional}), a JSON line per result is
+    written as soon as it's ready. """
 __author__ = "Jeyson Molina"
 __email__ = "jjmc82@gmail.com"
 __version__ = "1.0"
 
 import argparse as ap
+import inspect
+import sys
+import threading
 
-from ir_webstats.client import iRWebStats
+from ir_webstats.client import iRWebStats  # Cheap, requests loads on use
 from ir_webstats.util import *
 
+try:
+    getargspec = inspect.getfullargspec  # python3
+except AttributeError:
+    getargspec = inspect.getargspec  # python2
+
+
+def materialize(result):
+    """ Turns the generators returned by the iter_* methods (alone or in a
+        tuple, like iter_event_results) into lists, so they can be dumped
+        as JSON and their responses are consumed and released """
+    if inspect.isgenerator(result):
+        return list(result)
+    if isinstance(result, tuple):
+        return tuple(materialize(x) for x in result)
+    return result
+
+
+def run_call(irw, line):
+    """ Runs a batch call (a JSON line) and returns its result line """
+    out = {'id': None, 'method': None, 'result': None, 'error': None}
+    try:
+        call = json.loads(line)
+        out['id'], out['method'] = call.get('id'), call.get('method')
+        f = call['method']
+        if f.startswith('_') or not callable(getattr(iRWebStats, f, None)):
+            raise ValueError("%s is not a member of iRWebstat" % f)
+        a = call.get('args') or {}
+        func = getattr(irw, f)
+        out['result'] = materialize(func(*a) if isinstance(a, list) else
+                                    func(**a))
+    except Exception as e:
+        out['error'] = "%s: %s" % (e.__class__.__name__, e)
+    return json.dumps(out, default=str)
+
+
+def run_batch(irw, lines, workers=1, out=sys.stdout):
+    """ Runs the calls of lines (iterable of JSON lines) with workers
+        threads sharing irw (and its rate limiter) and writes each result to
+        out when it's done, so with workers > 1 they may come out of order
+        (use the id field). Returns the number of calls. """
+
+    lock = threading.Lock()
+
+    def write(result):
+        with lock:
+            out.write(result + '\n')
+            out.flush()
+
+    calls = (l for l in lines if l.strip())
+    if workers <= 1:
+        n = 0
+        for line in calls:
+            write(run_call(irw, line))
+            n += 1
+        return n
+
+    from concurrent.futures import ThreadPoolExecutor  # lazy, slow import
+    # Bounded so a long input isn't read (and queued) all at once
+    pending = threading.BoundedSemaphore(workers * 2)
+
+    def one(line):
+        try:
+            write(run_call(irw, line))
+        finally:
+            pending.release()
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    n = 0
+    try:
+        for line in calls:
+            pending.acquire()
+            executor.submit(one, line)
+            n += 1
+    finally:
+        executor.shutdown()
+    return n
+
+
 if __name__ == '__main__':
 
     parser = ap.ArgumentParser(description="Shell interface for iRWebStats")
@@ -17,21 +102,37 @@ if __name__ == '__main__':
     parser.add_argument("-m", "--method", help='Function to execute',required=False)
     parser.add_argument("-l", "--list", help='List of available functions to execute',required=False, action='store_true')
     parser.add_argument("-a", "--args", help='Named function arguments separated by semicolon ("p1=1;p2=2, ..., p5=\'String\'")',required=False)
+    parser.add_argument("-b", "--batch", help='Run the calls (JSON lines) of this file, - for stdin', nargs='?', const='-', required=False)
+    parser.add_argument("-w", "--workers", help='Calls run in parallel in batch mode', type=int, default=1)
     args = parser.parse_args()
 
-    irw = iRWebStats()
+    irw = iRWebStats(verbose=not args.batch)  # stdout is only JSON in batch
     
 
-    if args.list:
-        l = inspect.getmembers(iRWebStats)
-        o = '\n'.join(["%s: %s"%(f[0], inspect.getdoc(f[1])) for f in l[3:]])
+    if args.batch:
+        if args.user and args.passw:
+            ok = irw.login(username=args.user, password=args.passw)
+        else:
+            ok = irw.login()  # No login provided, maybe there's a valid cookie
+        if not ok:
+            sys.exit("Error: login failed")
+        src = sys.stdin if args.batch == '-' else open(args.batch)
+        try:
+            run_batch(irw, src, args.workers)
+        finally:
+            irw.close()
+
+    elif args.list:
+        l = [f for f in inspect.getmembers(iRWebStats, callable)
+             if not f[0].startswith('_')]
+        o = '\n'.join(["%s: %s"%(f[0], inspect.getdoc(f[1])) for f in l])
         print(o)
 
     elif args.method:
         f = args.method
         if hasattr(iRWebStats, f):
             func = getattr(irw, f)
-            a = inspect.getargspec(func)
+            a = getargspec(getattr(func, '__wrapped__', func))
             if args.args or len(a.args) == 1:
                 #extract args
                 try: 
@@ -44,7 +145,7 @@ if __name__ == '__main__':
                         irw.login(username=args.user, password=args.passw)
                     else:
                         irw.login() #No login provided, maybe there's a valid cookie
-                    r = func(**res) #execute
+                    r = materialize(func(**res)) #execute
                     print(json.dumps(r)) #Output result using json format
                 except Exception as e:
                     print("Error: ", e)
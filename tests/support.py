@@ -0,0 +1,45 @@
+#!/usr/bin/python
+""" Fake members site (see benchmarks/fakeserver.py) shared by the tests:
+    it's started once per process, the URL constants can only be pointed
+    to it once. """
+
+import os
+import sys
+import threading
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+sys.path.insert(0, os.path.join(HERE, '..', 'benchmarks'))
+
+from ir_webstats.client import iRWebStats
+from ir_webstats.ratelimit import TokenBucket
+from ir_webstats.sessions import SessionStore
+from fakeserver import FakeServer, point_to
+
+_server = None
+_lock = threading.Lock()
+
+
+def server():
+    """ The fake site, started on first use """
+    global _server
+    with _lock:
+        if _server is None:
+            _server = FakeServer()
+            t = threading.Thread(target=_server.serve_forever)
+            t.daemon = True
+            t.start()
+            point_to(_server.base)
+        return _server
+
+
+def client(tmp, **kw):
+    """ iRWebStats logged in to the fake site, keeping its files in tmp """
+    server()
+    kw.setdefault('limiter', TokenBucket(1e6, 1e6))
+    kw.setdefault('catalog_file', None)
+    kw.setdefault('sessions', SessionStore(os.path.join(tmp, 'sessions')))
+    irw = iRWebStats(verbose=False, **kw)
+    if not irw.login('user', 'pass'):
+        raise RuntimeError('Login to the fake server failed')
+    return irw
@@ -0,0 +1,86 @@
+#!/usr/bin/python
+""" Response cache against the fake members site: only responses that
+    parse fine are stored, and event results are only kept forever once
+    the subsession is finished.
+    Usage: python -m unittest discover tests """
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import support
+from ir_webstats import constants as ct
+from ir_webstats.cache import ResponseCache
+from ir_webstats.util import ParseError
+
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = support.server()
+        self.dir = tempfile.mkdtemp()
+        self.cache = ResponseCache(os.path.join(self.dir, 'cache.sqlite'))
+        self.irw = support.client(self.dir, cache=self.cache)
+        self.csv = self.server.data.csv
+
+    def tearDown(self):
+        self.server.data.csv = self.csv
+        self.server.validators = False
+        self.irw.close()
+        shutil.rmtree(self.dir)
+
+    def test_login_page_not_cached(self):
+        cookie = self.irw.last_cookie
+        self.irw.last_cookie = 'JSESSIONID=expired'  # Login page served
+        self.assertRaises(ParseError, self.irw.career_stats)
+        self.irw.last_cookie = cookie
+        self.assertTrue(self.irw.career_stats())
+        self.assertEqual(self.cache.stats()['entries'], 1)
+
+    def test_unfinished_event_not_cached(self):
+        info, results = self.csv.split('\r\n\r\n')
+        self.server.data.csv = info + '\r\n\r\n' + \
+            results.split('\r\n')[0] + '\r\n'
+        self.assertEqual(self.irw.event_results(1)[1], [])
+        self.server.data.csv = self.csv
+        self.assertTrue(self.irw.event_results(1)[1])
+        requests = self.server.requests
+        self.assertTrue(self.irw.event_results(1)[1])
+        self.assertEqual(self.server.requests, requests)  # Finished: cached
+
+    def test_revalidated(self):
+        self.server.validators = True
+        self.cache.ttls = {ct.URL_CAREER_STATS: 0}  # Revalidated every time
+        requests = self.server.requests
+        first = self.irw.career_stats()
+        size = self.cache.stats()['size']
+        self.cache.ttls[ct.URL_CAREER_STATS] = 3600
+        self.assertEqual(self.irw.career_stats(), first)  # 304
+        self.assertEqual(self.irw.career_stats(), first)  # Renewed: hit
+        stats = self.cache.stats()
+        self.assertEqual(self.server.requests - requests, 2)
+        self.assertEqual(stats['revalidated'], 1)
+        self.assertEqual(stats['bytes_saved'], size)
+        self.assertEqual(stats['hits'], 1)
+
+    def test_evicted_before_revalidation(self):
+        self.server.validators = True
+        self.cache.ttls = {ct.URL_CAREER_STATS: 0}
+        first = self.irw.career_stats()
+        revalidate = self.cache.revalidate
+
+        def evicted(key):
+            self.cache.clear()
+            return revalidate(key)
+
+        self.cache.revalidate = evicted
+        requests = self.server.requests
+        self.assertEqual(self.irw.career_stats(), first)  # 304, then 200
+        self.assertEqual(self.server.requests - requests, 2)
+        self.assertEqual(self.cache.stats()['revalidated'], 0)
+        self.assertEqual(self.cache.stats()['entries'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+#!/usr/bin/python
+""" Retries and circuit breaker (see retry.py), the requests against the
+    fake members site answering 429 and 5xx.
+    Usage: python -m unittest discover tests """
+
+import shutil
+import tempfile
+import time
+import unittest
+from email.utils import formatdate
+
+import support
+from ir_webstats import retry
+from ir_webstats.retry import CircuitBreaker, RetryPolicy
+from ir_webstats.util import CircuitOpenError, RateLimitedError, \
+    ServerError
+
+
+class RetryAfterTest(unittest.TestCase):
+
+    def test_seconds(self):
+        self.assertEqual(retry.retry_after('3'), 3.0)
+        self.assertEqual(retry.retry_after('-1'), 0.0)
+
+    def test_http_date(self):
+        after = retry.retry_after(formatdate(time.time() + 30, usegmt=True))
+        self.assertTrue(28 <= after <= 30, after)
+        past = formatdate(time.time() - 30, usegmt=True)
+        self.assertEqual(retry.retry_after(past), 0.0)
+
+    def test_invalid(self):
+        self.assertIsNone(retry.retry_after(None))
+        self.assertIsNone(retry.retry_after(''))
+        self.assertIsNone(retry.retry_after('soon'))
+
+    def test_delay(self):
+        policy = RetryPolicy(backoff=1, max_backoff=3, max_retry_after=10)
+        for attempt, high in ((1, 1), (2, 2), (3, 3), (8, 3)):
+            for _ in range(20):
+                self.assertTrue(0 <= policy.delay(attempt) <= high)
+        self.assertEqual(policy.delay(1, after=5), 5)
+        self.assertEqual(policy.delay(1, after=60), 10)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.breaker = CircuitBreaker(threshold=2, cooldown=0.05)
+
+    def open(self):
+        self.breaker.before()
+        self.breaker.failure()
+        self.breaker.before()
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+    def test_opens_after_threshold(self):
+        self.breaker.failure()
+        self.breaker.success()  # Only failures in a row count
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        with self.assertRaises(CircuitOpenError) as cm:
+            self.breaker.before()
+        self.assertTrue(0 < cm.exception.retry_in <= 0.05)
+        self.assertEqual(self.breaker.stats()['rejected'], 1)
+
+    def test_half_open_success_closes(self):
+        self.open()
+        time.sleep(0.06)
+        self.breaker.before()  # The trial
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        with self.assertRaises(CircuitOpenError) as cm:
+            self.breaker.before()  # Only one trial at a time
+        self.assertEqual(cm.exception.retry_in, 0.0)
+        self.breaker.success()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.breaker.before()
+
+    def test_half_open_failure_opens(self):
+        self.open()
+        time.sleep(0.06)
+        self.breaker.before()
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertEqual(self.breaker.stats()['trips'], 2)
+        self.assertRaises(CircuitOpenError, self.breaker.before)
+
+    def test_abort_lets_another_trial(self):
+        self.open()
+        time.sleep(0.06)
+        self.breaker.before()
+        self.breaker.abort()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.breaker.before()  # Cooldown already elapsed
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertEqual(self.breaker.stats()['trips'], 1)
+
+
+class ClientRetryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = support.server()
+        self.dir = tempfile.mkdtemp()
+        self.breaker = CircuitBreaker(threshold=3, cooldown=60)
+        self.irw = support.client(
+            self.dir, breaker=self.breaker,
+            retry_policy=RetryPolicy(retries=2, backoff=0.001))
+
+    def tearDown(self):
+        del self.server.failures[:]
+        self.irw.close()
+        shutil.rmtree(self.dir)
+
+    def test_retried(self):
+        self.server.fail(503)
+        self.server.fail(429, retry_after='0')
+        requests = self.server.requests
+        self.assertTrue(self.irw.career_stats())
+        self.assertEqual(self.server.requests - requests, 3)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_rate_limited(self):
+        self.server.fail(429, 3, retry_after='0')
+        with self.assertRaises(RateLimitedError) as cm:
+            self.irw.career_stats()
+        self.assertEqual(cm.exception.status, 429)
+        self.assertEqual(self.breaker.failures, 0)  # Not a site failure
+
+    def test_breaker_opens(self):
+        self.server.fail(500, 3)
+        with self.assertRaises(ServerError) as cm:
+            self.irw.career_stats()
+        self.assertEqual(cm.exception.status, 500)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        requests = self.server.requests
+        self.assertRaises(CircuitOpenError, self.irw.career_stats)
+        self.assertEqual(self.server.requests, requests)
+
+
+if __name__ == '__main__':
+    unittest.main()
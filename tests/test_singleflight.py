@@ -0,0 +1,82 @@
+#!/usr/bin/python
+""" Coalescing of identical requests in flight (see singleflight.py)
+    against the fake members site.
+    Usage: python -m unittest discover tests """
+
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import support
+from ir_webstats.singleflight import SingleFlight
+
+
+class Interrupted(BaseException):
+    pass
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = support.server()
+        self.dir = tempfile.mkdtemp()
+        self.irw = support.client(self.dir)
+
+    def tearDown(self):
+        self.server.latency = 0.0
+        self.irw.close()
+        shutil.rmtree(self.dir)
+
+    def run_threads(self, func, n):
+        results = [None] * n
+
+        def one(i):
+            try:
+                results[i] = func()
+            except BaseException as e:
+                results[i] = e
+
+        threads = [threading.Thread(target=one, args=(i,)) for i in range(n)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+    def test_coalesced(self):
+        self.server.latency = 0.2  # All of them start while it's in flight
+        requests = self.server.requests
+        before = self.irw.flights.stats()
+        results = self.run_threads(self.irw.career_stats, 8)
+        stats = self.irw.flights.stats()
+        self.assertEqual(self.server.requests - requests, 1)
+        self.assertEqual(stats['calls'] - before['calls'], 8)
+        self.assertEqual(stats['flights'] - before['flights'], 1)
+        self.assertEqual(stats['coalesced'] - before['coalesced'], 7)
+        self.assertEqual(stats['in_flight'], 0)
+        self.assertTrue(results[0])
+        self.assertTrue(all(r == results[0] for r in results))
+
+    def test_leader_interrupted(self):
+        flights, started = SingleFlight(), threading.Event()
+
+        def func():
+            started.set()
+            while flights.stats()['coalesced'] < 3:
+                time.sleep(0.001)  # Until every waiter joined
+            raise Interrupted()
+
+        leader = threading.Thread(target=lambda: self.assertRaises(
+            Interrupted, flights.do, 'key', func))
+        leader.start()
+        started.wait()
+        results = self.run_threads(
+            lambda: flights.do('key', lambda: 'not the leader'), 3)
+        leader.join()
+        self.assertTrue(all(isinstance(r, Interrupted) for r in results))
+
+
+if __name__ == '__main__':
+    unittest.main()